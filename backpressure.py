@@ -0,0 +1,168 @@
+"""消息队列准入控制模块：队列长度上限、单会话上限与过载丢弃策略"""
+
+import time
+import logging
+import itertools
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# 过载丢弃策略
+SHED_REJECT = "reject"  # 拒绝新消息
+SHED_DROP_OLDEST = "drop_oldest"  # 丢弃最早排队的消息，接收新消息
+
+
+class QueuedMessage:
+    """排队中的消息"""
+
+    __slots__ = ("seq", "data", "chat_id", "enqueued_at", "cancelled",
+                 "merged")
+
+    def __init__(self, seq: int, data, chat_id: str):
+        self.seq = seq
+        self.data = data
+        self.chat_id = chat_id
+        # 进入处理队列的时间（经过合并窗口的消息在窗口结束时重新设置）
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False  # 被丢弃的消息仍留在队列中，出队时跳过
+        self.merged: list = []  # 合并到本条消息中的更早消息（按到达顺序）
+
+
+class AdmissionController:
+    """
+    消息准入控制
+
+    记录所有已入队但尚未开始处理的消息。超过总长度上限 max_depth 或单个
+    会话上限 max_per_chat 时，按 policy 拒绝新消息或丢弃最早排队的消息。
+    上限为 0 表示不限制。同时统计消息在队列中的等待时间。
+    """
+
+    def __init__(self, max_depth: int = 0, max_per_chat: int = 0,
+                 policy: str = SHED_REJECT):
+        self.max_depth = max_depth
+        self.max_per_chat = max_per_chat
+        self.policy = policy
+        self._pending: OrderedDict = OrderedDict()  # seq -> QueuedMessage
+        self._per_chat: dict = {}  # chat_id -> OrderedDict(seq -> 消息)
+        self._seq = itertools.count()
+        self._lock = Lock()
+
+        self.admitted = 0  # 已接收的消息数
+        self.rejected = 0  # 因过载被拒绝的新消息数
+        self.dropped = 0  # 因过载被丢弃的排队消息数
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def admit(self, data, chat_id: str):
+        """
+        尝试接收一条消息
+
+        Args:
+            data: 飞书消息事件
+            chat_id: 消息所在会话ID
+
+        Returns:
+            tuple: (QueuedMessage 或 None, 被丢弃的排队消息列表)，
+                   第一个元素为 None 表示新消息被拒绝
+        """
+        dropped = []
+
+        with self._lock:
+            chat_pending = self._per_chat.get(chat_id)
+            if (self.max_per_chat and chat_pending
+                    and len(chat_pending) >= self.max_per_chat):
+                if self.policy != SHED_DROP_OLDEST:
+                    self.rejected += 1
+                    return None, dropped
+                dropped.append(self._drop(next(iter(chat_pending.values()))))
+
+            if self.max_depth and len(self._pending) >= self.max_depth:
+                if self.policy != SHED_DROP_OLDEST:
+                    self.rejected += 1
+                    return None, dropped
+                dropped.append(self._drop(next(iter(self._pending.values()))))
+
+            item = QueuedMessage(next(self._seq), data, chat_id)
+            self._pending[item.seq] = item
+            self._per_chat.setdefault(chat_id, OrderedDict())[item.seq] = item
+            self.admitted += 1
+
+        return item, dropped
+
+    def start(self, item: QueuedMessage) -> bool:
+        """
+        消息出队开始处理时调用
+
+        Returns:
+            bool: False 表示消息已被丢弃，应跳过
+        """
+        with self._lock:
+            if item.cancelled:
+                return False
+            self._remove(item)
+
+            wait = time.monotonic() - item.enqueued_at
+            self._wait_count += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+        return True
+
+    def depth(self) -> int:
+        """当前排队中的消息数"""
+        return len(self._pending)
+
+    def chat_depth(self, chat_id: str) -> int:
+        """某个会话排队中的消息数"""
+        with self._lock:
+            return len(self._per_chat.get(chat_id, ()))
+
+    def oldest_wait(self) -> float:
+        """最早排队消息已等待的时间（秒）"""
+        with self._lock:
+            if not self._pending:
+                return 0.0
+            oldest = next(iter(self._pending.values()))
+            return time.monotonic() - oldest.enqueued_at
+
+    def stats(self) -> dict:
+        """获取准入控制统计信息"""
+        with self._lock:
+            avg_wait = (self._wait_total / self._wait_count
+                        if self._wait_count else 0.0)
+            return {
+                "depth": len(self._pending),
+                "max_depth": self.max_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "wait_avg": avg_wait,
+                "wait_max": self._wait_max
+            }
+
+    def _drop(self, item: QueuedMessage) -> QueuedMessage:
+        """丢弃排队中的消息（调用方需持有 _lock）"""
+        item.cancelled = True
+        self._remove(item)
+        self.dropped += 1
+        return item
+
+    def _remove(self, item: QueuedMessage):
+        """从排队记录中移除消息（调用方需持有 _lock）"""
+        self._pending.pop(item.seq, None)
+        chat_pending = self._per_chat.get(item.chat_id)
+        if chat_pending is not None:
+            chat_pending.pop(item.seq, None)
+            if not chat_pending:
+                del self._per_chat[item.chat_id]
+
+
+def parse_shed_policy(value: str) -> str:
+    """解析过载丢弃策略配置，未知值按 reject 处理"""
+    value = (value or "").lower()
+    if value in (SHED_REJECT, SHED_DROP_OLDEST):
+        return value
+    logger.warning("⚠️ 未知的过载策略: %s，使用 %s", value, SHED_REJECT)
+    return SHED_REJECT
@@ -0,0 +1,166 @@
+"""多后端负载均衡模块：新会话按最少进行中请求分配，已有会话固定路由到所属后端"""
+
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 会话ID与所属后端标识之间的分隔符
+SESSION_NODE_SEPARATOR = "@"
+
+
+class BackendUnavailableError(Exception):
+    """会话所在的后端（或全部后端）不可用"""
+
+
+class Backend:
+    """单个后端节点"""
+
+    __slots__ = ("url", "node_id", "healthy", "outstanding", "requests")
+
+    def __init__(self, url: str):
+        self.url = url
+        # 由 URL 计算的稳定标识，调整列表顺序或增删其他节点不影响已有会话
+        self.node_id = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+        self.healthy = True  # 首次健康检查前视为健康
+        self.outstanding = 0  # 进行中的请求数
+        self.requests = 0  # 累计请求数
+
+
+class BackendBalancer:
+    """
+    后端负载均衡器
+
+    新会话分配给进行中请求最少的健康节点，返回给调用方的会话ID附加所属
+    节点标识（"<原会话ID>@<节点标识>"），之后的请求据此固定路由到同一节点。
+    不带节点标识的会话ID是配置多个后端之前创建的，路由到第一个后端（即
+    原来唯一的后端）。后台线程每 health_interval 秒检查一次所有节点，不健康
+    的节点不再分配新会话，发往其上已有会话的请求抛出
+    BackendUnavailableError，由调用方改用新会话。
+    """
+
+    def __init__(self, urls: list, health_check, health_interval: float = 10):
+        """
+        Args:
+            urls: 后端地址列表
+            health_check: 以 Backend 为参数、返回是否健康的函数
+            health_interval: 健康检查间隔（秒），0 表示不检查
+        """
+        if not urls:
+            raise ValueError("至少需要一个后端地址")
+        self.backends = [Backend(url) for url in urls]
+        self._by_id = {backend.node_id: backend for backend in self.backends}
+        self.health_check = health_check
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._next = 0  # 进行中请求数相同时轮流分配
+        self._thread = None
+
+    def start(self) -> None:
+        """启动后台健康检查线程（重复调用不会重复启动）"""
+        with self._lock:
+            if self._thread is not None or self.health_interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._health_loop,
+                                            name="backend-health",
+                                            daemon=True)
+            self._thread.start()
+
+    def pick(self, exclude: Backend = None) -> Backend:
+        """
+        为新会话选择进行中请求最少的健康节点
+
+        Args:
+            exclude: 尽量避开的节点（例如对冲请求避开第一次请求的节点），
+                     没有其他健康节点时仍可选择
+        """
+        with self._lock:
+            healthy = [b for b in self.backends if b.healthy]
+            if not healthy:
+                raise BackendUnavailableError("没有可用的 Claude Agent 后端")
+            others = [b for b in healthy if b is not exclude]
+            if others:
+                healthy = others
+            count = len(healthy)
+            start = self._next % count
+            self._next += 1
+            ordered = healthy[start:] + healthy[:start]
+            return min(ordered, key=lambda backend: backend.outstanding)
+
+    def route(self, session_id: str) -> tuple:
+        """
+        找到会话所属的节点
+
+        Returns:
+            tuple: (Backend, 后端原始会话ID)
+        """
+        raw_id, _, node_id = session_id.rpartition(SESSION_NODE_SEPARATOR)
+        backend = self._by_id.get(node_id) if raw_id else None
+        if backend is None:
+            # 配置多个后端之前创建的会话在第一个后端上
+            raw_id = session_id
+            backend = self.backends[0]
+        if not backend.healthy:
+            raise BackendUnavailableError(
+                f"会话所在的后端 {backend.url} 不可用")
+        return backend, raw_id
+
+    @staticmethod
+    def tag(backend: Backend, raw_id: str) -> str:
+        """为后端原始会话ID附加节点标识"""
+        return f"{raw_id}{SESSION_NODE_SEPARATOR}{backend.node_id}"
+
+    @contextmanager
+    def track(self, backend: Backend):
+        """统计一次发往 backend 的请求"""
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+
+    def check_all(self) -> bool:
+        """
+        立即检查所有节点并更新健康状态
+
+        Returns:
+            bool: 是否至少有一个健康节点
+        """
+        for backend in self.backends:
+            try:
+                healthy = bool(self.health_check(backend))
+            except Exception as e:
+                logger.warning("后端 %s 健康检查异常: %s", backend.url, e)
+                healthy = False
+
+            if healthy != backend.healthy:
+                if healthy:
+                    logger.info("✅ 后端 %s 已恢复", backend.url)
+                else:
+                    logger.warning("⚠️ 后端 %s 不可用，暂停分配新会话",
+                                   backend.url)
+            backend.healthy = healthy
+        return any(backend.healthy for backend in self.backends)
+
+    def stats(self) -> list:
+        """获取各节点状态"""
+        with self._lock:
+            return [{
+                "url": backend.url,
+                "node_id": backend.node_id,
+                "healthy": backend.healthy,
+                "outstanding": backend.outstanding,
+                "requests": backend.requests
+            } for backend in self.backends]
+
+    def _health_loop(self) -> None:
+        """后台线程：定期检查所有节点"""
+        while True:
+            time.sleep(self.health_interval)
+            self.check_all()
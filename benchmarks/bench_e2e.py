@@ -0,0 +1,293 @@
+"""端到端性能测试：合成飞书事件 -> 消息处理 -> 本地模拟 Claude Agent -> 模拟飞书回复
+
+用法:
+    python benchmarks/bench_e2e.py --messages 500 --workers 8 \
+        --agent-latency 0.5
+    python benchmarks/bench_e2e.py --mode async --stream --rate 50
+
+输出吞吐（msgs/sec）与端到端延迟（从事件回调到最终回复发出）的 p50/p95/p99。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from stub_agent import StubAgentConfig, start_stub_agent  # noqa: E402
+from fake_lark import (  # noqa: E402
+    BOT_APP_ID,
+    EventGenerator,
+    FakeLarkClient,
+    parse_mix
+)
+
+
+def percentile(values: list, pct: float) -> float:
+    """最近秩法计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1,
+                max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="飞书 Claude 机器人端到端性能测试")
+    parser.add_argument("--mode", choices=("workers", "async", "direct"),
+                        default="workers",
+                        help="workers: 工作线程池；async: 异步处理模式；"
+                             "direct: 单线程直接调用 process_single_message")
+    parser.add_argument("--messages", type=int, default=200,
+                        help="发送的消息总数")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="每秒注入的消息数，0 表示一次性全部注入")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="工作线程数（MESSAGE_WORKER_COUNT）")
+    parser.add_argument("--users", type=int, default=50, help="模拟用户数")
+    parser.add_argument("--groups", type=int, default=10, help="模拟群聊数")
+    parser.add_argument("--mix", default="p2p:5,group:3,thread:2",
+                        help="事件比例，例如 p2p:5,group:3,thread:2")
+    parser.add_argument("--stream", action="store_true",
+                        help="启用流式回复（STREAM_REPLY）")
+    parser.add_argument("--agents", type=int, default=1,
+                        help="模拟后端数量（多个时以逗号分隔写入 CLAUDE_AGENT_URL）")
+    parser.add_argument("--agent-latency", type=float, default=0.2,
+                        help="模拟 Claude 回复的基础延迟（秒）")
+    parser.add_argument("--agent-jitter", type=float, default=0.1,
+                        help="模拟 Claude 回复的随机抖动（秒）")
+    parser.add_argument("--agent-session-latency", type=float, default=0.0,
+                        help="模拟创建会话（create_session）的延迟（秒）")
+    parser.add_argument("--agent-session-slow-rate", type=float, default=0.0,
+                        help="创建会话偶尔变慢的比例（模拟长尾延迟）")
+    parser.add_argument("--agent-session-slow-latency", type=float,
+                        default=1.0, help="创建会话变慢时的延迟（秒）")
+    parser.add_argument("--agent-error-rate", type=float, default=0.0,
+                        help="模拟 Claude 接口返回 500 的比例")
+    parser.add_argument("--stream-chunks", type=int, default=5,
+                        help="流式回复的分片数")
+    parser.add_argument("--lark-latency", type=float, default=0.02,
+                        help="模拟飞书 API 每次调用的延迟（秒）")
+    parser.add_argument("--lark-error-rate", type=float, default=0.0,
+                        help="模拟飞书 API 调用失败的比例")
+    parser.add_argument("--coalesce-ms", type=int, default=0,
+                        help="消息合并窗口（毫秒，COALESCE_WINDOW_MS），"
+                             "0 表示不合并")
+    parser.add_argument("--session-pool", type=int, default=0,
+                        help="预创建的后端会话数（SESSION_POOL_SIZE），"
+                             "0 表示不预创建")
+    parser.add_argument("--hedge-percentile", type=float, default=0,
+                        help="请求对冲的分位耗时（HEDGE_PERCENTILE），"
+                             "0 表示不对冲")
+    parser.add_argument("--spool", action="store_true",
+                        help="启用入站消息暂存文件（INGRESS_SPOOL）")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="等待全部消息处理完成的最长时间（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--json", action="store_true",
+                        help="以 JSON 格式输出结果")
+    return parser.parse_args(argv)
+
+
+def configure_env(args, agent_url: str, store_dir: str):
+    """main.py 在导入时读取配置，必须在导入前设置环境变量"""
+    os.environ.update({
+        "APP_ID": BOT_APP_ID,
+        "APP_SECRET": "benchmark",
+        "CLAUDE_AGENT_URL": agent_url,
+        "SESSION_STORE_DIR": store_dir,
+        "MESSAGE_WORKER_COUNT": str(args.workers),
+        "ASYNC_PIPELINE": "true" if args.mode == "async" else "false",
+        "STREAM_REPLY": "true" if args.stream else "false",
+        "STREAM_UPDATE_INTERVAL": "0.1",
+        "MESSAGE_QUEUE_MAX": "0",
+        "MESSAGE_QUEUE_PER_CHAT_MAX": "0",
+        "RATE_LIMIT_USER_PER_MINUTE": "0",
+        "RATE_LIMIT_CHAT_PER_MINUTE": "0",
+        "DEDUP_PERSIST": "false",
+        "INGRESS_SPOOL": "true" if args.spool else "false",
+        "COALESCE_WINDOW_MS": str(args.coalesce_ms),
+        "SESSION_POOL_SIZE": str(args.session_pool),
+        "HEDGE_PERCENTILE": str(args.hedge_percentile),
+        "METRICS_PORT": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+class CompletionTracker:
+    """记录每条消息的注入时间与最终回复完成时间"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.started: dict = {}
+        self.latencies: list = []
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def start(self, message_id: str):
+        with self._lock:
+            self.started[message_id] = time.perf_counter()
+
+    def finish(self, message_id: str, failed: bool):
+        now = time.perf_counter()
+        with self._lock:
+            started = self.started.get(message_id)
+            if started is None:
+                return
+            self.latencies.append(now - started)
+            if failed:
+                self.errors += 1
+            if len(self.latencies) >= self.total:
+                self._done.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+
+def install_hooks(main, tracker: CompletionTracker):
+    """包装 finish_reply，在最终回复发出后记录完成时间"""
+    finish_reply = main.finish_reply
+
+    def tracked_finish_reply(ctx, claude_response, reply_message_id, result):
+        try:
+            finish_reply(ctx, claude_response, reply_message_id, result)
+        finally:
+            failed = bool(result.get('error')) or not result.get('session_id')
+            # 合并处理的消息随主消息的回复一起完成
+            for message_id in ctx['merged_message_ids'] + [ctx['message_id']]:
+                tracker.finish(message_id, failed)
+
+    main.finish_reply = tracked_finish_reply
+
+
+def run(args) -> dict:
+    stub_config = StubAgentConfig(
+        latency=args.agent_latency,
+        jitter=args.agent_jitter,
+        error_rate=args.agent_error_rate,
+        stream_chunks=args.stream_chunks,
+        session_latency=args.agent_session_latency,
+        session_slow_rate=args.agent_session_slow_rate,
+        session_slow_latency=args.agent_session_slow_latency
+    )
+    stubs = [start_stub_agent(stub_config) for _ in range(args.agents)]
+    store_dir = tempfile.mkdtemp(prefix="claude-lark-bench-")
+    configure_env(args, ",".join(stub.url for stub in stubs), store_dir)
+
+    import main
+    import handle
+
+    fake_client = FakeLarkClient(latency=args.lark_latency,
+                                 error_rate=args.lark_error_rate)
+    main.client = fake_client
+    main.init_session_store()
+    main.start_session_pool()
+
+    generator = EventGenerator(users=args.users, groups=args.groups,
+                               mix=parse_mix(args.mix), seed=args.seed)
+    events = [generator.next() for _ in range(args.messages)]
+    tracker = CompletionTracker(len(events))
+    install_hooks(main, tracker)
+
+    if args.mode == "workers":
+        main.start_worker_pool()
+    elif args.mode == "async":
+        threading.Thread(
+            target=lambda: asyncio.run(main.async_message_loop()),
+            name="message-async-loop",
+            daemon=True
+        ).start()
+
+    interval = 1 / args.rate if args.rate > 0 else 0
+    started = time.perf_counter()
+    for index, event in enumerate(events):
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        tracker.start(event.event.message.message_id)
+        if args.mode == "direct":
+            main.process_single_message(event)
+        else:
+            main.do_p2_im_message_receive_v1(event)
+
+    completed = tracker.wait(args.timeout)
+    elapsed = time.perf_counter() - started
+    main.flush_session_store()
+
+    latencies = tracker.latencies
+    return {
+        "mode": args.mode,
+        "workers": args.workers if args.mode == "workers" else None,
+        "stream": args.stream,
+        "coalesce_ms": args.coalesce_ms,
+        "messages": len(events),
+        "completed": len(latencies),
+        "timed_out": not completed,
+        "elapsed_sec": round(elapsed, 3),
+        "throughput_msgs_per_sec": round(len(latencies) / elapsed, 2)
+        if elapsed else 0.0,
+        "latency_sec": {
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(max(latencies), 4) if latencies else 0.0
+        },
+        "errors": tracker.errors,
+        "lark_replies": len(fake_client.replies),
+        "lark_updates": len(fake_client.updates),
+        "lark_reactions": len(fake_client.reactions),
+        "lark_failures": fake_client.failures,
+        "agent_requests": [dict(stub.counts) for stub in stubs],
+        "hedge": handle.agent_hedge.stats(),
+        "spool": main.ingress_spool.stats() if main.ingress_spool else None
+    }
+
+
+def print_report(result: dict):
+    latency = result["latency_sec"]
+    print("=" * 60)
+    print(f"模式: {result['mode']}"
+          + (f" (工作线程 {result['workers']})" if result['workers'] else "")
+          + (" + 流式回复" if result['stream'] else "")
+          + (f" + 合并窗口 {result['coalesce_ms']}ms"
+             if result['coalesce_ms'] else ""))
+    print(f"消息: {result['completed']}/{result['messages']} 完成"
+          + (" (超时)" if result['timed_out'] else "")
+          + f"，错误 {result['errors']}")
+    print(f"耗时: {result['elapsed_sec']} 秒")
+    print(f"吞吐: {result['throughput_msgs_per_sec']} msgs/sec")
+    print(f"延迟: p50 {latency['p50']}s  p95 {latency['p95']}s  "
+          f"p99 {latency['p99']}s  max {latency['max']}s")
+    print(f"飞书调用: 回复 {result['lark_replies']}，更新 "
+          f"{result['lark_updates']}，表情回应 {result['lark_reactions']}，"
+          f"失败 {result['lark_failures']}")
+    if result['hedge']['calls']:
+        hedge = result['hedge']
+        print(f"请求对冲: 调用 {hedge['calls']}，对冲 {hedge['hedged']}，"
+              f"对冲先返回 {hedge['wins']}，释放 {hedge['discarded']}")
+    if result['spool']:
+        spool = result['spool']
+        print(f"入站暂存: 写入 {spool['appended']}，完成 {spool['completed']}，"
+              f"未完成 {spool['pending']}，fsync {spool['syncs']}")
+    for index, counts in enumerate(result['agent_requests']):
+        print(f"后端 #{index} 请求: {counts}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = run(arguments)
+    if arguments.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,314 @@
+"""会话映射存储的微基准与规模测试（离线运行，不依赖任何服务）
+
+对每种存储后端与规模：
+1. populate: 在新目录中写入 N 个会话（每个会话一个 root 消息与若干普通消息），
+   统计 save_mapping 的单次延迟与总耗时，关闭后统计文件大小；
+2. measure: 在新进程中重新打开存储，统计加载耗时（快照 + 日志回放 + 重建
+   缓存）与加载后的常驻内存增量，再随机执行查询命中、查询未命中、向已有会话
+   追加消息、新建会话（触发容量淘汰）四类操作并统计延迟。
+
+两个阶段分别在独立子进程中运行，避免内存与缓存互相影响。
+
+用法:
+    python benchmarks/bench_session_store.py
+    python benchmarks/bench_session_store.py --scales 1000,100000 \
+        --backends json,sqlite
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from session_store import JsonSessionStore, SqliteSessionStore  # noqa: E402
+
+BACKENDS = ("json", "json-coalesce", "sqlite")
+
+
+def percentile(values: list, pct: float) -> float:
+    """最近秩法计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1,
+                max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list) -> dict:
+    """单次操作延迟统计（微秒）"""
+    if not latencies:
+        return {}
+    return {
+        "ops": len(latencies),
+        "mean_us": round(sum(latencies) / len(latencies) * 1e6, 2),
+        "p50_us": round(percentile(latencies, 50) * 1e6, 2),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 2),
+        "max_us": round(max(latencies) * 1e6, 2)
+    }
+
+
+def rss_bytes() -> int:
+    """当前进程的常驻内存（字节）"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # 无 /proc 时退化为峰值常驻内存（Linux 单位 KB，macOS 单位字节）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def dir_size(path: str) -> int:
+    """目录下所有文件的总大小（字节）"""
+    total = 0
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            total += os.path.getsize(file_path)
+    return total
+
+
+def open_store(backend: str, store_dir: str, max_sessions: int,
+               compact_records: int):
+    """按后端名称创建会话存储（不加载）"""
+    if backend == "sqlite":
+        return SqliteSessionStore(
+            os.path.join(store_dir, "session_mapping.db"),
+            max_sessions=max_sessions
+        )
+    return JsonSessionStore(
+        store_dir,
+        max_sessions=max_sessions,
+        compact_records=compact_records,
+        persist_mode="coalesce" if backend == "json-coalesce" else "journal"
+    )
+
+
+def session_key(index: int) -> str:
+    return f"sess_{index:08d}"
+
+
+def message_key(index: int, position: int) -> str:
+    return f"om_{index:08d}_{position}"
+
+
+def populate(backend: str, store_dir: str, sessions: int,
+             messages_per_session: int, compact_records: int) -> dict:
+    """写入 N 个会话并关闭存储"""
+    store = open_store(backend, store_dir, sessions, compact_records)
+    store.load()
+
+    latencies = []
+    started = time.perf_counter()
+    for index in range(sessions):
+        session_id = session_key(index)
+        for position in range(messages_per_session):
+            op_started = time.perf_counter()
+            store.save_mapping(message_key(index, position), session_id,
+                               is_root=(position == 0))
+            latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+
+    close_started = time.perf_counter()
+    store.close()
+    close_elapsed = time.perf_counter() - close_started
+
+    return {
+        "populate_sec": round(elapsed, 3),
+        "populate_ops_per_sec": round(len(latencies) / elapsed, 1),
+        "close_sec": round(close_elapsed, 3),
+        "save_new": summarize(latencies),
+        "file_bytes": dir_size(store_dir)
+    }
+
+
+def measure(backend: str, store_dir: str, sessions: int,
+            messages_per_session: int, compact_records: int,
+            ops: int, seed: int) -> dict:
+    """重新打开已有存储，统计加载耗时、内存与各类操作延迟"""
+    rng = random.Random(seed)
+    gc.collect()
+    rss_before = rss_bytes()
+
+    store = open_store(backend, store_dir, sessions, compact_records)
+    load_started = time.perf_counter()
+    store.load()
+    load_elapsed = time.perf_counter() - load_started
+    gc.collect()
+    rss_after = rss_bytes()
+    loaded_sessions = store.count()
+
+    def timed(func, *args, **kwargs) -> float:
+        op_started = time.perf_counter()
+        func(*args, **kwargs)
+        return time.perf_counter() - op_started
+
+    get_hit = []
+    get_miss = []
+    save_existing = []
+    save_evict = []
+    for op in range(ops):
+        index = rng.randrange(sessions)
+        position = rng.randrange(messages_per_session)
+        get_hit.append(timed(store.get_session_id,
+                             message_key(index, position)))
+        get_miss.append(timed(store.get_session_id, f"om_missing_{op}"))
+        save_existing.append(timed(store.save_mapping,
+                                   f"om_extra_{op}", session_key(index)))
+        # 新会话使总数超过容量，每次淘汰最久未使用的会话
+        save_evict.append(timed(store.save_mapping, f"om_new_{op}",
+                                session_key(sessions + op), is_root=True))
+
+    flush_started = time.perf_counter()
+    store.flush()
+    flush_elapsed = time.perf_counter() - flush_started
+    evicted = store.stats().get("evicted_capacity", 0)
+    store.close()
+
+    return {
+        "load_sec": round(load_elapsed, 3),
+        "loaded_sessions": loaded_sessions,
+        "rss_bytes": rss_after - rss_before,
+        "get_hit": summarize(get_hit),
+        "get_miss": summarize(get_miss),
+        "save_existing": summarize(save_existing),
+        "save_evict": summarize(save_evict),
+        "evicted": evicted,
+        "flush_sec": round(flush_elapsed, 3)
+    }
+
+
+def run_phase(args, phase: str, backend: str, store_dir: str,
+              sessions: int) -> dict:
+    """在子进程中运行一个阶段，返回其 JSON 结果"""
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--phase", phase,
+        "--backends", backend,
+        "--scales", str(sessions),
+        "--dir", store_dir,
+        "--messages-per-session", str(args.messages_per_session),
+        "--compact-records", str(args.compact_records),
+        "--ops", str(args.ops),
+        "--seed", str(args.seed)
+    ]
+    output = subprocess.run(command, check=True, capture_output=True,
+                            text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def format_bytes(value: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.1f}{unit}" if unit != "B" else f"{value}B"
+        value /= 1024
+    return f"{value}B"
+
+
+def print_report(results: list):
+    header = (f"{'backend':<14}{'sessions':>10}{'populate/s':>12}"
+              f"{'load':>9}{'file':>10}{'rss':>10}"
+              f"{'get p50/p99 (us)':>20}{'miss p50':>10}"
+              f"{'save p50/p99 (us)':>20}{'evict p50/p99 (us)':>21}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        def pair(stats):
+            return f"{stats['p50_us']:.0f}/{stats['p99_us']:.0f}"
+
+        print(f"{r['backend']:<14}{r['sessions']:>10}"
+              f"{r['populate_ops_per_sec']:>12.0f}"
+              f"{r['load_sec']:>8.2f}s"
+              f"{format_bytes(r['file_bytes']):>10}"
+              f"{format_bytes(r['rss_bytes']):>10}"
+              f"{pair(r['get_hit']):>20}"
+              f"{r['get_miss']['p50_us']:>10.0f}"
+              f"{pair(r['save_existing']):>20}"
+              f"{pair(r['save_evict']):>21}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="会话映射存储微基准与规模测试")
+    parser.add_argument("--scales", default="1000,100000,1000000",
+                        help="会话数量列表，逗号分隔")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help=f"存储后端列表，可选 {', '.join(BACKENDS)}")
+    parser.add_argument("--messages-per-session", type=int, default=2,
+                        help="每个会话写入的消息数（第一条为 root）")
+    parser.add_argument("--compact-records", type=int, default=5000,
+                        help="json 日志压缩阈值（同 SESSION_JOURNAL_COMPACT_RECORDS）")
+    parser.add_argument("--ops", type=int, default=2000,
+                        help="measure 阶段每类操作的执行次数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--json", action="store_true",
+                        help="以 JSON 格式输出结果")
+    parser.add_argument("--keep", action="store_true",
+                        help="保留生成的存储文件")
+    parser.add_argument("--phase", choices=("populate", "measure"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    for backend in backends:
+        if backend not in BACKENDS:
+            raise SystemExit(f"未知的存储后端: {backend}")
+
+    if args.phase:
+        # 子进程：只运行一个阶段，最后一行输出 JSON 结果
+        backend, sessions = backends[0], scales[0]
+        if args.phase == "populate":
+            result = populate(backend, args.dir, sessions,
+                              args.messages_per_session, args.compact_records)
+        else:
+            result = measure(backend, args.dir, sessions,
+                             args.messages_per_session, args.compact_records,
+                             args.ops, args.seed)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for sessions in scales:
+        for backend in backends:
+            store_dir = tempfile.mkdtemp(prefix=f"bench-{backend}-{sessions}-")
+            print(f"▶ {backend} / {sessions} 个会话 ...", file=sys.stderr)
+            try:
+                result = {"backend": backend, "sessions": sessions}
+                result.update(run_phase(args, "populate", backend, store_dir,
+                                        sessions))
+                result.update(run_phase(args, "measure", backend, store_dir,
+                                        sessions))
+                results.append(result)
+            finally:
+                if args.keep:
+                    print(f"  存储文件保留在 {store_dir}", file=sys.stderr)
+                else:
+                    shutil.rmtree(store_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
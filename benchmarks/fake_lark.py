@@ -0,0 +1,185 @@
+"""模拟飞书客户端与合成的 P2ImMessageReceiveV1 事件，用于性能测试"""
+
+import itertools
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from lark_oapi.api.im.v1 import (
+    EventMessage,
+    EventSender,
+    MentionEvent,
+    P2ImMessageReceiveV1,
+    P2ImMessageReceiveV1Data,
+    UserId
+)
+from lark_oapi.event.context import EventHeader
+
+BOT_APP_ID = "cli_benchmark"
+MENTION_KEY = "@_user_1"
+
+
+class FakeLarkClient:
+    """
+    模拟 lark.Client：只实现 im.v1.message.reply / update 与
+    im.v1.message_reaction.create / delete，记录所有调用
+
+    可配置每次调用的延迟与失败率，用于模拟飞书 API 的耗时与偶发失败。
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.replies: list = []  # (原消息ID, 回复文本, 时间)
+        self.updates: list = []  # (回复消息ID, 新文本, 时间)
+        self.reactions: list = []  # (消息ID, 表情类型, 时间)
+        self.reactions_removed = 0
+        self.failures = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.im = SimpleNamespace(v1=SimpleNamespace(
+            message=SimpleNamespace(reply=self._reply, update=self._update),
+            message_reaction=SimpleNamespace(create=self._add_reaction,
+                                             delete=self._remove_reaction)
+        ))
+
+    def _respond(self, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.failures += 1
+            return SimpleNamespace(success=lambda: False, code=500,
+                                   msg="fake failure", data=None)
+        return SimpleNamespace(success=lambda: True, code=0, msg="",
+                               data=data)
+
+    def _reply(self, request):
+        response = self._respond(SimpleNamespace(
+            message_id=f"om_bot_{next(self._ids)}"))
+        if response.success():
+            text = json.loads(request.request_body.content)["text"]
+            with self._lock:
+                self.replies.append((request.message_id, text, time.time()))
+        return response
+
+    def _update(self, request):
+        response = self._respond()
+        if response.success():
+            text = json.loads(request.request_body.content)["text"]
+            with self._lock:
+                self.updates.append((request.message_id, text, time.time()))
+        return response
+
+    def _add_reaction(self, request):
+        response = self._respond(SimpleNamespace(
+            reaction_id=f"reaction_{next(self._ids)}"))
+        if response.success():
+            emoji_type = request.request_body.reaction_type.emoji_type
+            with self._lock:
+                self.reactions.append((request.message_id, emoji_type,
+                                       time.time()))
+        return response
+
+    def _remove_reaction(self, request):
+        response = self._respond()
+        if response.success():
+            with self._lock:
+                self.reactions_removed += 1
+        return response
+
+
+def make_event(message_id: str, text: str, chat_id: str, user_id: str,
+               chat_type: str = "p2p", mention_bot: bool = False,
+               root_id: str = None) -> P2ImMessageReceiveV1:
+    """
+    构造一条文本消息事件
+
+    Args:
+        message_id: 消息ID
+        text: 消息文本
+        chat_id: 会话ID
+        user_id: 发送者 open_id
+        chat_type: p2p 或 group
+        mention_bot: 是否@机器人（群聊）
+        root_id: 回复链的根消息ID（话题回复）
+    """
+    mentions = None
+    if mention_bot:
+        mention = MentionEvent({"key": MENTION_KEY, "name": "bot"})
+        # main.py 通过 mention.id.app_id 判断是否@了本机器人
+        mention.id = SimpleNamespace(app_id=BOT_APP_ID)
+        mentions = [mention]
+        text = f"{MENTION_KEY} {text}"
+
+    message = EventMessage({
+        "message_id": message_id,
+        "root_id": root_id,
+        "parent_id": root_id,
+        "chat_id": chat_id,
+        "chat_type": chat_type,
+        "message_type": "text",
+        "content": json.dumps({"text": text})
+    })
+    message.mentions = mentions
+
+    event = P2ImMessageReceiveV1()
+    event.header = EventHeader({"event_id": f"ev_{message_id}"})
+    event.event = P2ImMessageReceiveV1Data()
+    event.event.message = message
+    event.event.sender = EventSender()
+    event.event.sender.sender_id = UserId({"open_id": user_id})
+    return event
+
+
+class EventGenerator:
+    """
+    按比例生成私聊、群聊@机器人与话题回复三类事件
+
+    话题回复挂在同一群聊中之前生成的消息下，用于模拟多轮对话。
+    """
+
+    KINDS = ("p2p", "group", "thread")
+
+    def __init__(self, users: int = 50, groups: int = 10, mix: dict = None,
+                 seed: int = 0):
+        self.users = [f"ou_bench_{i}" for i in range(max(1, users))]
+        self.groups = [f"oc_group_{i}" for i in range(max(1, groups))]
+        self.mix = mix or {"p2p": 0.5, "group": 0.3, "thread": 0.2}
+        self._random = random.Random(seed)
+        self._ids = itertools.count()
+        self._roots: dict = {}  # 群聊ID -> 可回复的消息ID列表
+
+    def next(self) -> P2ImMessageReceiveV1:
+        kind = self._random.choices(
+            list(self.mix.keys()), weights=list(self.mix.values()))[0]
+        user = self._random.choice(self.users)
+        message_id = f"om_bench_{next(self._ids)}"
+        text = f"question {message_id}"
+
+        if kind == "p2p":
+            return make_event(message_id, text, f"oc_p2p_{user}", user)
+
+        group = self._random.choice(self.groups)
+        roots = self._roots.setdefault(group, [])
+        if kind == "thread" and roots:
+            root_id = self._random.choice(roots)
+            return make_event(message_id, text, group, user, "group",
+                              mention_bot=True, root_id=root_id)
+
+        roots.append(message_id)
+        return make_event(message_id, text, group, user, "group",
+                          mention_bot=True)
+
+
+def parse_mix(value: str) -> dict:
+    """解析事件比例配置，例如 "p2p:5,group:3,thread:2" """
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.strip().partition(":")
+        if kind not in EventGenerator.KINDS:
+            raise ValueError(f"未知的事件类型: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
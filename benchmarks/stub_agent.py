@@ -0,0 +1,180 @@
+"""本地 claude-agent-http 模拟服务，用于性能测试
+
+实现机器人用到的接口（/health、/api/v1/sessions、/api/v1/chat、
+/api/v1/chat/stream），可配置回复延迟、抖动、流式分片与错误率，
+以及创建会话的延迟与偶发的慢请求。
+只接受本服务创建的会话，发往其他会话的对话请求返回 404，
+可用于检查多后端时的会话路由是否正确。
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubAgentConfig:
+    """模拟服务的行为配置"""
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0,
+                 error_rate: float = 0.0, stream_chunks: int = 5,
+                 reply_size: int = 200, session_latency: float = 0.0,
+                 session_slow_rate: float = 0.0,
+                 session_slow_latency: float = 1.0):
+        self.latency = latency  # 每次对话的基础延迟（秒）
+        self.jitter = jitter  # 延迟的随机抖动上限（秒）
+        self.error_rate = error_rate  # 对话请求返回 500 的比例
+        self.stream_chunks = max(1, stream_chunks)  # 流式回复的分片数
+        self.reply_size = reply_size  # 回复文本长度（字符）
+        self.session_latency = session_latency  # 创建会话的延迟（秒）
+        # 创建会话偶尔变慢的比例与变慢时的延迟（秒），用于模拟长尾
+        self.session_slow_rate = session_slow_rate
+        self.session_slow_latency = session_slow_latency
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def session_delay(self) -> float:
+        if random.random() < self.session_slow_rate:
+            return self.session_slow_latency
+        return self.session_latency
+
+
+class StubAgentServer(ThreadingHTTPServer):
+    """模拟服务，记录收到的请求数"""
+
+    daemon_threads = True
+
+    def __init__(self, address, config: StubAgentConfig):
+        super().__init__(address, _StubAgentHandler)
+        self.config = config
+        self.counts: dict = {}
+        self.sessions: set = set()  # 本服务创建的会话ID
+        self._lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _StubAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, code: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _reply_text(self, message: str) -> str:
+        text = f"echo: {message} "
+        size = self.server.config.reply_size
+        return (text * (size // len(text) + 1))[:size]
+
+    def _should_fail(self) -> bool:
+        return random.random() < self.server.config.error_rate
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+            return
+        if self.path.startswith("/api/v1/sessions/"):
+            session_id = self.path.rsplit("/", 1)[-1]
+            self._send_json(200, {"session_id": session_id})
+            return
+        self._send_json(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        self.server.count("close_session")
+        self._send_json(200, {"status": "closed"})
+
+    def do_POST(self):
+        payload = self._read_json()
+
+        if self.path == "/api/v1/sessions":
+            self.server.count("create_session")
+            time.sleep(self.server.config.session_delay())
+            session_id = uuid.uuid4().hex
+            with self.server._lock:
+                self.server.sessions.add(session_id)
+            self._send_json(200, {"session_id": session_id})
+            return
+
+        if (self.path.startswith("/api/v1/chat")
+                and payload.get("session_id") not in self.server.sessions):
+            self.server.count("unknown_session")
+            self._send_json(404, {"error": "session not found"})
+            return
+
+        if self.path == "/api/v1/chat":
+            self.server.count("chat")
+            time.sleep(self.server.config.delay())
+            if self._should_fail():
+                self.server.count("chat_error")
+                self._send_json(500, {"error": "stub failure"})
+                return
+            self._send_json(200, {
+                "text": self._reply_text(payload.get("message", "")),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+            })
+            return
+
+        if self.path == "/api/v1/chat/stream":
+            self.server.count("chat_stream")
+            self._stream(payload.get("message", ""))
+            return
+
+        self._send_json(404, {"error": "not found"})
+
+    def _stream(self, message: str):
+        config = self.server.config
+        if self._should_fail():
+            time.sleep(config.delay())
+            self.server.count("chat_error")
+            self._send_json(500, {"error": "stub failure"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        text = self._reply_text(message)
+        step = max(1, len(text) // config.stream_chunks)
+        pause = config.delay() / config.stream_chunks
+        for start in range(0, len(text), step):
+            time.sleep(pause)
+            event = {"type": "text", "text": text[start:start + step]}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b'data: {"type": "done"}\n\n')
+        self.close_connection = True
+
+
+def start_stub_agent(config: StubAgentConfig, host: str = "127.0.0.1",
+                     port: int = 0) -> StubAgentServer:
+    """在后台线程中启动模拟服务（port 为 0 时自动选择端口）"""
+    server = StubAgentServer((host, port), config)
+    threading.Thread(
+        target=server.serve_forever,
+        name="stub-agent",
+        daemon=True
+    ).start()
+    return server
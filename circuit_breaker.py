@@ -0,0 +1,181 @@
+"""熔断器模块：后端故障时快速失败，后台探测恢复"""
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"  # 正常放行
+OPEN = "open"  # 熔断中，直接拒绝
+HALF_OPEN = "half_open"  # 正在探测后端是否恢复，仍拒绝调用
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时拒绝的调用"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"{name}暂时不可用，请约 "
+                         f"{max(1, int(retry_after + 0.999))} 秒后再试")
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    统计最近 window 次调用的结果，不少于 min_calls 次且失败比例达到
+    failure_rate 时打开熔断：之后的调用立即抛出 CircuitOpenError，不再等待
+    后端超时。打开 open_seconds 秒后由后台线程调用 probe 探测（半开），
+    探测成功则关闭熔断恢复放行，失败则继续保持打开，等待时间加倍（最长
+    max_open_seconds）。failure_rate 为 0 表示不启用。
+
+    只有 is_failure 判定为后端故障的异常计为失败（默认所有异常），请求本身
+    有误等其他异常不计入统计；设置 slow_call_seconds 时，耗时达到该值的
+    成功调用也计为失败，后端持续变慢时同样会打开熔断。
+    """
+
+    def __init__(self, probe, name: str = "后端服务",
+                 failure_rate: float = 0.5, window: int = 20,
+                 min_calls: int = 5, open_seconds: float = 30,
+                 max_open_seconds: float = 300, is_failure=None,
+                 slow_call_seconds: float = 0):
+        self.probe = probe
+        self.name = name
+        self.failure_rate = failure_rate
+        self.is_failure = is_failure or (lambda error: True)
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = max(1, min_calls)
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max(open_seconds, max_open_seconds)
+        self._results: deque = deque(maxlen=max(self.min_calls, window))
+        self._state = CLOSED
+        self._retry_at = 0.0  # 下一次探测的时间
+        self._lock = threading.Lock()
+
+        self.opened = 0  # 打开熔断的次数
+        self.rejected = 0  # 熔断期间拒绝的调用数
+        self.slow = 0  # 因耗时过长计为失败的调用数
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_rate > 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @contextmanager
+    def guard(self):
+        """
+        保护一次后端调用：熔断打开时抛出 CircuitOpenError，
+        代码块正常结束按耗时记为成功，抛出的后端故障异常记为失败
+        """
+        self.before_call()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e)
+            raise
+        self.record_success(time.monotonic() - started)
+
+    def before_call(self) -> None:
+        """调用前检查，熔断打开时抛出 CircuitOpenError"""
+        if not self.enabled or self._state == CLOSED:
+            return
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            self.rejected += 1
+            retry_after = max(0.0, self._retry_at - time.monotonic())
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self, seconds: float = None) -> None:
+        """
+        记录一次成功调用
+
+        Args:
+            seconds: 调用耗时（秒），达到 slow_call_seconds 时计为失败
+        """
+        if not self.enabled:
+            return
+        if (self.slow_call_seconds > 0 and seconds is not None
+                and seconds >= self.slow_call_seconds):
+            with self._lock:
+                self.slow += 1
+            logger.warning("%s调用耗时 %.1f 秒，计为慢调用", self.name, seconds)
+            self.record_failure()
+            return
+        with self._lock:
+            if self._state == CLOSED:
+                self._results.append(True)
+
+    def record_error(self, error: Exception) -> None:
+        """记录一次抛出异常的调用：只有后端故障计为失败"""
+        if self.enabled and self.is_failure(error):
+            self.record_failure()
+
+    def record_failure(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state != CLOSED:
+                return
+            self._results.append(False)
+            failures = self._results.count(False)
+            if (len(self._results) < self.min_calls
+                    or failures < self.failure_rate * len(self._results)):
+                return
+            self._state = OPEN
+            self._retry_at = time.monotonic() + self.open_seconds
+            self.opened += 1
+            total = len(self._results)
+
+        logger.error("⚠️ %s最近 %d 次调用失败 %d 次，熔断 %.0f 秒",
+                     self.name, total, failures, self.open_seconds)
+        threading.Thread(target=self._recover, name="circuit-probe",
+                         daemon=True).start()
+
+    def stats(self) -> dict:
+        """获取熔断器统计信息"""
+        with self._lock:
+            return {
+                "state": self._state,
+                "failures": self._results.count(False),
+                "calls": len(self._results),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "slow": self.slow
+            }
+
+    def _recover(self) -> None:
+        """后台线程：等待后探测后端，恢复后关闭熔断"""
+        open_seconds = self.open_seconds
+        while True:
+            time.sleep(max(0.0, self._retry_at - time.monotonic()))
+
+            with self._lock:
+                self._state = HALF_OPEN
+            try:
+                healthy = bool(self.probe())
+            except Exception as e:
+                logger.warning("%s探测异常: %s", self.name, e)
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    self._state = CLOSED
+                    self._results.clear()
+                else:
+                    open_seconds = min(self.max_open_seconds, open_seconds * 2)
+                    self._state = OPEN
+                    self._retry_at = time.monotonic() + open_seconds
+
+            if healthy:
+                logger.info("✅ %s已恢复，关闭熔断", self.name)
+                return
+            logger.warning("%s探测失败，%.0f 秒后再次探测",
+                           self.name, open_seconds)
@@ -0,0 +1,117 @@
+"""消息合并模块：同一对话、同一用户短时间内连续发送的多条消息合并为一次处理"""
+
+import time
+import logging
+import threading
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    """同一合并键下暂存的消息"""
+
+    __slots__ = ("items", "first_at", "last_at")
+
+    def __init__(self, now: float):
+        self.items: list = []
+        self.first_at = now
+        self.last_at = now
+
+
+class MessageCoalescer:
+    """
+    消息合并器
+
+    按合并键（对话键 + 发送者）暂存消息：最后一条消息之后 window 秒内没有
+    新消息时，将暂存的全部消息按到达顺序一次性交给 on_flush。为避免持续发送
+    导致无限等待，从第一条消息起最多等待 max_wait 秒；暂存达到 max_messages
+    条时立即交出。on_flush 在合并器的后台线程中调用，该线程在首条消息
+    到达时启动。
+    """
+
+    def __init__(self, window: float, on_flush, max_wait: float = 0,
+                 max_messages: int = 0):
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.max_messages = max_messages
+        self.on_flush = on_flush
+        self._batches: dict = {}  # 合并键 -> _Batch
+        self._cond = Condition()
+        self._thread = None
+
+        self.batches = 0  # 交出的批次数
+        self.merged = 0  # 被合并到其他消息中的消息数
+
+    def add(self, key: str, item) -> None:
+        """
+        暂存一条消息
+
+        Args:
+            key: 合并键，相同键的消息会被合并
+            item: 排队消息
+        """
+        now = time.monotonic()
+        with self._cond:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = _Batch(now)
+                self._batches[key] = batch
+            batch.items.append(item)
+            batch.last_at = now
+            if self._thread is None:
+                # 首条消息到达时才启动后台线程
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="message-coalescer",
+                    daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def is_open(self, key: str) -> bool:
+        """该合并键下是否有尚未交出的批次（新消息会合并进去）"""
+        with self._cond:
+            return key in self._batches
+
+    def pending(self) -> int:
+        """暂存中的消息数"""
+        with self._cond:
+            return sum(len(batch.items) for batch in self._batches.values())
+
+    def _deadline(self, batch: _Batch) -> float:
+        if self.max_messages and len(batch.items) >= self.max_messages:
+            return batch.last_at
+        return min(batch.last_at + self.window,
+                   batch.first_at + self.max_wait)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = []
+                    next_deadline = None
+                    for key, batch in self._batches.items():
+                        deadline = self._deadline(batch)
+                        if deadline <= now:
+                            ready.append(key)
+                        elif next_deadline is None or deadline < next_deadline:
+                            next_deadline = deadline
+                    if ready:
+                        batches = [self._batches.pop(key) for key in ready]
+                        break
+                    self._cond.wait(None if next_deadline is None
+                                    else next_deadline - now)
+
+            for batch in batches:
+                self._emit(batch)
+
+    def _emit(self, batch: _Batch) -> None:
+        with self._cond:
+            self.batches += 1
+            self.merged += len(batch.items) - 1
+        try:
+            self.on_flush(batch.items)
+        except Exception as e:
+            logger.exception("合并消息交出失败: %s", e)
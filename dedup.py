@@ -0,0 +1,166 @@
+"""飞书事件去重模块"""
+
+import os
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """
+    事件去重缓存
+
+    按 message_id / event_id 记录已接收的事件，TTL 内重复投递的事件会被识别。
+    缓存容量有上限，按插入顺序淘汰最旧的记录。指定 persist_file 时，每个新键
+    在释放缓存锁之后追加写入文件，文件中的记录数达到 compact_records（默认
+    max_entries 的两倍）时只保留缓存中的记录重写文件；重启后加载仍在 TTL
+    内的记录。
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 10000,
+                 persist_file: Optional[str] = None,
+                 compact_records: Optional[int] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist_file = persist_file
+        self.compact_records = compact_records or 2 * max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict()  # key -> 接收时间
+        self._lock = Lock()
+        self._pending: list = []  # 等待写入文件的行（由 _lock 保护）
+        self._records = 0  # 文件中的记录数（由 _io_lock 保护）
+        self._file = None
+        self._io_lock = Lock()  # 串行化文件写入与重写
+        self.hits = 0  # 识别出的重复事件数
+        self.misses = 0  # 首次接收的事件数
+
+        if persist_file:
+            self._load()
+
+    def check_and_add(self, *keys: str) -> bool:
+        """
+        检查事件是否重复，不重复时记录所有键
+
+        Args:
+            keys: 事件的标识（message_id、event_id 等），空值会被忽略
+
+        Returns:
+            bool: 任一键已存在时返回 True（重复事件）
+        """
+        keys = [key for key in keys if key]
+        if not keys:
+            return False
+
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+
+            if any(key in self._entries for key in keys):
+                self.hits += 1
+                return True
+
+            for key in keys:
+                self._entries[key] = now
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.misses += 1
+
+            if self.persist_file:
+                self._pending.extend(f"{key}\t{now}\n" for key in keys)
+
+        if self.persist_file:
+            self._flush()
+        return False
+
+    def size(self) -> int:
+        """当前缓存的键数量"""
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """获取去重统计信息"""
+        return {
+            "size": self.size(),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def _expire(self, now: float):
+        """淘汰超过 TTL 的记录（调用方需持有 _lock）"""
+        cutoff = now - self.ttl
+        while self._entries:
+            key, received = next(iter(self._entries.items()))
+            if received >= cutoff:
+                break
+            self._entries.popitem(last=False)
+
+    def _flush(self):
+        """在缓存锁之外追加写入新键，记录数达到上限时重写文件"""
+        with self._io_lock:
+            with self._lock:
+                lines = self._pending
+                self._pending = []
+                snapshot = None
+                if self._records + len(lines) >= self.compact_records:
+                    # 缓存快照已包含本批新键
+                    snapshot = list(self._entries.items())
+            if not lines and snapshot is None:
+                return
+
+            try:
+                if snapshot is not None:
+                    self._rewrite(snapshot)
+                    return
+                if self._file is None:
+                    self._file = open(self.persist_file, 'a', encoding='utf-8')
+                self._file.write(''.join(lines))
+                self._file.flush()
+                self._records += len(lines)
+            except Exception as e:
+                logger.error("⚠️ 写入去重记录失败: %s", e)
+
+    def _rewrite(self, entries: list):
+        """只保留给定的记录重写文件（调用方需持有 _io_lock）"""
+        tmp_file = self.persist_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(''.join(f"{key}\t{received}\n"
+                            for key, received in entries))
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_file, self.persist_file)
+        self._records = len(entries)
+
+    def _load(self):
+        """加载仍在 TTL 内的记录，并重写文件去掉过期记录"""
+        Path(os.path.dirname(self.persist_file) or ".").mkdir(
+            parents=True, exist_ok=True)
+
+        if not os.path.exists(self.persist_file):
+            return
+
+        cutoff = time.time() - self.ttl
+        try:
+            with open(self.persist_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    key, _, received = line.rstrip('\n').partition('\t')
+                    try:
+                        received = float(received)
+                    except ValueError:
+                        continue
+                    if key and received >= cutoff:
+                        self._entries[key] = received
+                        self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._rewrite(list(self._entries.items()))
+        except Exception as e:
+            logger.warning("⚠️ 加载去重记录失败: %s", e)
+            return
+
+        logger.info("📦 已加载 %d 条去重记录", len(self._entries))
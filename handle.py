@@ -2,267 +2,484 @@
 
 import os
 import json
+import time
+import random
+import asyncio
+import atexit
+import inspect
+import socket
+import logging
+import contextlib
 import requests
-from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from queue import Queue
+from threading import BoundedSemaphore, Lock, Thread
 from typing import Optional
-from pathlib import Path
+from session_store import SessionStore, JsonSessionStore, SqliteSessionStore
+from session_pool import SessionPool
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from balancer import BackendBalancer, BackendUnavailableError
+from hedge import HedgePolicy
+import metrics
+
+try:
+    import aiohttp
+except ImportError:  # 仅异步模式需要
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
 
 # HTTP 后端配置
+# 多个后端用逗号分隔：新会话分配给进行中请求最少的节点，已有会话固定路由到所属节点
 CLAUDE_AGENT_URL = os.getenv("CLAUDE_AGENT_URL", "http://localhost:8000")
+CLAUDE_AGENT_URLS = [
+    url.strip().rstrip('/') for url in CLAUDE_AGENT_URL.split(",")
+    if url.strip()
+]
+# 多后端时的健康检查间隔（秒），不健康的节点不再分配新会话
+CLAUDE_AGENT_HEALTH_INTERVAL = float(
+    os.getenv("CLAUDE_AGENT_HEALTH_INTERVAL", "10")
+)
 CLAUDE_AGENT_TIMEOUT = int(os.getenv("CLAUDE_AGENT_TIMEOUT", "120"))
+# 建立连接的超时（秒），与等待回复的读取超时 CLAUDE_AGENT_TIMEOUT 分开
+CLAUDE_AGENT_CONNECT_TIMEOUT = float(
+    os.getenv("CLAUDE_AGENT_CONNECT_TIMEOUT", "5")
+)
+# 连接池已满时等待空闲连接的最长时间（秒），默认与连接超时相同
+CLAUDE_AGENT_POOL_TIMEOUT = float(os.getenv(
+    "CLAUDE_AGENT_POOL_TIMEOUT", str(CLAUDE_AGENT_CONNECT_TIMEOUT)
+))
+
+
+# 熔断：最近 CIRCUIT_WINDOW 次调用中失败比例达到该值时快速失败（0 表示不启用）
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+# 统计窗口内至少有这么多次调用才判断是否熔断
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+# 熔断后首次探测（health_check）前的等待时间与探测失败后的最长等待时间（秒）
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", "300"))
+# 慢调用阈值（秒）：耗时达到该值的调用也计为失败（流式调用按收到首个事件的耗时），
+# 0 表示不按耗时判断
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "0"))
+
+# 请求对冲：幂等调用（创建/查询会话、健康检查）超过近期该分位耗时仍未返回时再发一次，
+# 取先返回的结果（0 表示不启用，建议 95）
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0"))
+# 每种调用至少积累这么多次耗时样本后才开始对冲
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# 对冲请求数占调用总数的比例上限
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+# 发出对冲请求前的最短等待时间（毫秒）
+HEDGE_MIN_DELAY_MS = int(os.getenv("HEDGE_MIN_DELAY_MS", "20"))
+
+# 每个后端的连接池大小。默认覆盖所有同时占用连接的调用方：消息工作线程（含流式
+# 读取）、会话预创建池补充线程、健康检查与熔断探测各一个；启用对冲时以上调用
+# 各可能多占一个连接；另加后台会话关闭线程
+_POOL_CALLERS = int(os.getenv("MESSAGE_WORKER_COUNT", "4")) + 1 + 2
+CLAUDE_AGENT_POOL_SIZE = int(os.getenv(
+    "CLAUDE_AGENT_POOL_SIZE",
+    str(_POOL_CALLERS * (2 if HEDGE_PERCENTILE > 0 else 1)
+        + int(os.getenv("SESSION_CLOSE_CONCURRENCY", "4")))
+))
+# 异步客户端每个后端的连接池大小：默认覆盖异步模式的并发上限 ASYNC_MAX_INFLIGHT，
+# 启用对冲时翻倍，并发请求不会在 aiohttp 内部排队等待连接
+CLAUDE_AGENT_ASYNC_POOL_SIZE = int(os.getenv(
+    "CLAUDE_AGENT_ASYNC_POOL_SIZE",
+    str(int(os.getenv("ASYNC_MAX_INFLIGHT", "200"))
+        * (2 if HEDGE_PERCENTILE > 0 else 1))
+))
 
 # 会话映射存储配置
 SESSION_STORE_DIR = os.getenv("SESSION_STORE_DIR", "/tmp/lark")
 SESSION_STORE_FILE = os.path.join(SESSION_STORE_DIR, "session_mapping.json")
-_MAX_SESSIONS = 1000  # 最多保存1000个会话
-STORAGE_VERSION = "2.0"  # 存储格式版本号
-_MAX_RECENT_MESSAGES = 3  # 每个会话保留的最近消息数
-
-# 新的会话存储结构
-# {
-#   "version": "2.0",
-#   "sessions": {
-#     "session_id": {
-#       "root_id": "om_xxx",
-#       "recent": ["om_yyy", "om_zzz"]
-#     }
-#   }
-# }
-_session_store: dict = {"version": STORAGE_VERSION, "sessions": {}}
-_message_to_session_cache: dict = {}  # 内存缓存: message_id -> session_id
-_session_lock = Lock()
-_initialized = False
-
-
-def _ensure_store_dir():
-    """确保存储目录存在"""
-    Path(SESSION_STORE_DIR).mkdir(parents=True, exist_ok=True)
-
-
-def _migrate_old_format(old_data: dict) -> dict:
+# 存储后端：json（快照 + 追加日志）或 sqlite
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "json").lower()
+SESSION_STORE_DB = os.path.join(SESSION_STORE_DIR, "session_mapping.db")
+# 最多保存的会话数
+_MAX_SESSIONS = int(os.getenv(
+    "SESSION_MAX_COUNT",
+    "100000" if SESSION_STORE_BACKEND == "sqlite" else "1000"
+))
+# 会话空闲超过该时间（秒）后淘汰，0 表示不按空闲时间淘汰
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "0"))
+
+# json 后端持久化模式：journal（追加日志）或 coalesce（合并写入快照）
+SESSION_PERSIST_MODE = os.getenv("SESSION_PERSIST_MODE", "journal").lower()
+# coalesce 模式下两次写入快照的最小间隔（毫秒）
+SESSION_FLUSH_INTERVAL_MS = int(os.getenv("SESSION_FLUSH_INTERVAL_MS", "1000"))
+
+# 会话映射追加日志压缩阈值（仅 json 后端）
+# 日志记录数达到该值时触发压缩
+SESSION_JOURNAL_COMPACT_RECORDS = int(
+    os.getenv("SESSION_JOURNAL_COMPACT_RECORDS", "5000")
+)
+# 距上次压缩超过该时间（秒）且有新记录时触发压缩
+SESSION_JOURNAL_COMPACT_INTERVAL = int(
+    os.getenv("SESSION_JOURNAL_COMPACT_INTERVAL", "600")
+)
+
+# 后台关闭被淘汰后端会话的并发数与重试次数
+SESSION_CLOSE_CONCURRENCY = max(
+    1, int(os.getenv("SESSION_CLOSE_CONCURRENCY", "4"))
+)
+SESSION_CLOSE_RETRIES = int(os.getenv("SESSION_CLOSE_RETRIES", "3"))
+
+# 后端会话预创建池：保持的预创建会话数（0 表示不预创建）
+SESSION_POOL_SIZE = int(os.getenv("SESSION_POOL_SIZE", "0"))
+# 预创建方式：generic（所有用户共用）或 user（按用户分别预创建）
+SESSION_POOL_MODE = os.getenv("SESSION_POOL_MODE", "generic").lower()
+# generic 模式下创建会话使用的 user_id
+SESSION_POOL_USER = os.getenv("SESSION_POOL_USER", "default")
+# user 模式下最多维护的用户数（按最近使用淘汰）
+SESSION_POOL_MAX_USERS = int(os.getenv("SESSION_POOL_MAX_USERS", "100"))
+# 预创建会话未被使用时的最长保留时间（秒），过期后关闭，0 表示不过期
+SESSION_POOL_MAX_AGE = float(os.getenv("SESSION_POOL_MAX_AGE", "600"))
+
+_session_store: Optional[SessionStore] = None
+_session_store_lock = Lock()
+
+
+class SessionCloser:
     """
-    迁移旧格式到新格式
-    旧格式: {"mappings": [["msg_id", "session_id"], ...]}
-    新格式: {"version": "2.0", "sessions": {...}}
+    后台会话关闭器
+
+    被淘汰的会话ID入队后立即返回，由固定数量的后台线程并发调用
+    close_session，失败时按指数退避重试，不阻塞会话存储的读写。
     """
-    print("🔄 检测到旧格式数据，开始迁移...")
 
-    # 备份旧文件
-    backup_file = SESSION_STORE_FILE + ".backup"
-    try:
-        with open(backup_file, 'w', encoding='utf-8') as f:
-            json.dump(old_data, f, ensure_ascii=False, indent=2)
-        print(f"✅ 已备份旧数据到: {backup_file}")
-    except Exception as e:
-        print(f"⚠️ 备份失败: {str(e)}")
-
-    # 转换数据结构
-    new_store = {"version": STORAGE_VERSION, "sessions": {}}
-    mappings = old_data.get('mappings', [])
-
-    # 按 session_id 分组
-    session_messages = {}
-    for msg_id, sess_id in mappings:
-        if sess_id not in session_messages:
-            session_messages[sess_id] = []
-        session_messages[sess_id].append(msg_id)
-
-    # 构建新格式
-    for sess_id, msg_ids in session_messages.items():
-        # 第一条消息作为 root_id（保守策略）
-        root_id = msg_ids[0] if msg_ids else None
-        # 最后3条作为 recent
-        recent = msg_ids[-_MAX_RECENT_MESSAGES:] if len(msg_ids) > 0 else []
-
-        new_store["sessions"][sess_id] = {
-            "root_id": root_id,
-            "recent": recent
-        }
+    def __init__(self, concurrency: int = 4, max_retries: int = 3):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._queue: Queue = Queue()
+        self._threads: list = []
+        self._lock = Lock()
+        self.closed = 0  # 成功关闭的会话数
+        self.failed = 0  # 重试后仍失败的会话数
+
+    def submit(self, session_id: str) -> None:
+        """将会话加入关闭队列"""
+        self._start()
+        self._queue.put(session_id)
+
+    def pending(self) -> int:
+        """等待关闭的会话数"""
+        return self._queue.qsize()
+
+    def drain(self, timeout: float) -> bool:
+        """
+        等待已提交的会话全部处理完成
 
-    total_sessions = len(new_store["sessions"])
-    total_messages = sum(len(msgs) for msgs in session_messages.values())
-    saved_messages = sum(
-        1 + len(s["recent"]) for s in new_store["sessions"].values()
+        Returns:
+            bool: 超时前全部处理完成返回 True
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _start(self):
+        """按需启动后台线程"""
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.concurrency):
+                thread = Thread(target=self._worker,
+                                name=f"session-closer-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        """后台线程：逐个关闭队列中的会话"""
+        while True:
+            session_id = self._queue.get()
+            try:
+                self._close(session_id)
+            finally:
+                self._queue.task_done()
+
+    def _close(self, session_id: str):
+        """关闭单个后端会话，失败时带抖动的指数退避重试"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                if get_client().close_session(session_id):
+                    with self._lock:
+                        self.closed += 1
+                    return
+            except Exception as e:
+                logger.warning("关闭会话异常: %s", e)
+
+            if attempt < self.max_retries:
+                time.sleep((2 ** attempt) * (0.5 + random.random()))
+
+        with self._lock:
+            self.failed += 1
+        logger.error("⚠️ 关闭会话 %s 最终失败，已重试 %d 次",
+                     session_id, self.max_retries)
+
+
+_session_closer = SessionCloser(
+    concurrency=SESSION_CLOSE_CONCURRENCY,
+    max_retries=SESSION_CLOSE_RETRIES
+)
+
+
+def _close_evicted_session(session_id: str):
+    """会话被淘汰时交给后台关闭器关闭后端会话"""
+    _session_closer.submit(session_id)
+
+
+def _create_pooled_session(user_id: str) -> str:
+    """为预创建池创建一个后端会话（熔断期间不创建）"""
+    with agent_breaker.guard():
+        return get_client().create_session(user_id=user_id)["session_id"]
+
+
+_session_pool = SessionPool(
+    create=_create_pooled_session,
+    close=_close_evicted_session,
+    size=SESSION_POOL_SIZE,
+    per_user=SESSION_POOL_MODE == "user",
+    pool_user=SESSION_POOL_USER,
+    max_users=SESSION_POOL_MAX_USERS,
+    max_age=SESSION_POOL_MAX_AGE
+)
+
+
+def _create_session_store() -> SessionStore:
+    """根据 SESSION_STORE_BACKEND 创建会话存储"""
+    if SESSION_STORE_BACKEND == "sqlite":
+        return SqliteSessionStore(
+            SESSION_STORE_DB,
+            max_sessions=_MAX_SESSIONS,
+            on_evict=_close_evicted_session,
+            idle_ttl=SESSION_IDLE_TTL,
+            legacy_json_dir=SESSION_STORE_DIR
+        )
+
+    if SESSION_STORE_BACKEND != "json":
+        logger.warning("⚠️ 未知的会话存储后端: %s，使用 json",
+                       SESSION_STORE_BACKEND)
+
+    persist_mode = SESSION_PERSIST_MODE
+    if persist_mode not in ("journal", "coalesce"):
+        logger.warning("⚠️ 未知的持久化模式: %s，使用 journal", persist_mode)
+        persist_mode = "journal"
+
+    return JsonSessionStore(
+        SESSION_STORE_DIR,
+        max_sessions=_MAX_SESSIONS,
+        on_evict=_close_evicted_session,
+        idle_ttl=SESSION_IDLE_TTL,
+        compact_records=SESSION_JOURNAL_COMPACT_RECORDS,
+        compact_interval=SESSION_JOURNAL_COMPACT_INTERVAL,
+        persist_mode=persist_mode,
+        flush_interval=SESSION_FLUSH_INTERVAL_MS / 1000
     )
-    print(f"📊 迁移完成: {total_sessions} 个会话, "
-          f"{total_messages} 条消息 -> {saved_messages} 条消息")
-
-    return new_store
-
-
-def _rebuild_cache():
-    """重建内存缓存"""
-    global _message_to_session_cache
-    _message_to_session_cache.clear()
 
-    sessions = _session_store.get("sessions", {})
-    for session_id, session_data in sessions.items():
-        # 缓存 root_id
-        root_id = session_data.get("root_id")
-        if root_id:
-            _message_to_session_cache[root_id] = session_id
 
-        # 缓存 recent 消息
-        recent = session_data.get("recent", [])
-        for msg_id in recent:
-            _message_to_session_cache[msg_id] = session_id
+def get_session_store() -> SessionStore:
+    """获取全局会话存储实例（首次调用时加载）"""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                store = _create_session_store()
+                store.load()
+                atexit.register(store.close)
+                _session_store = store
+    return _session_store
 
 
-def _load_session_store():
-    """从文件加载会话映射"""
-    global _session_store, _initialized
-
-    if _initialized:
-        return
-
-    _ensure_store_dir()
-
-    try:
-        if os.path.exists(SESSION_STORE_FILE):
-            with open(SESSION_STORE_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-            # 检测格式版本
-            if 'version' in data and data['version'] == STORAGE_VERSION:
-                # 新格式
-                _session_store = data
-                session_count = len(_session_store.get("sessions", {}))
-                print(f"✅ 已加载 {session_count} 个会话 (v{STORAGE_VERSION})")
-            elif 'mappings' in data:
-                # 旧格式，需要迁移
-                _session_store = _migrate_old_format(data)
-                # 迁移后立即保存
-                _save_session_store()
-            else:
-                # 未知格式
-                print("⚠️ 未知的存储格式，使用新格式")
-                _session_store = {"version": STORAGE_VERSION, "sessions": {}}
-        else:
-            print("📁 会话映射文件不存在，将创建新文件")
-            _session_store = {"version": STORAGE_VERSION, "sessions": {}}
-
-    except Exception as e:
-        print(f"⚠️ 加载会话映射失败: {str(e)}，使用空映射")
-        _session_store = {"version": STORAGE_VERSION, "sessions": {}}
-
-    # 构建内存缓存
-    _rebuild_cache()
-    cache_size = len(_message_to_session_cache)
-    print(f"📦 内存缓存已构建: {cache_size} 条消息映射")
-
-    _initialized = True
-
-
-def _save_session_store():
-    """保存会话映射到文件"""
-    _ensure_store_dir()
-
-    try:
-        with open(SESSION_STORE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(_session_store, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠️ 保存会话映射失败: {str(e)}")
-
-
-def _add_recent_message(session_id: str, message_id: str):
+class AgentRequestError(Exception):
     """
-    添加消息到 recent 数组，保持最多 _MAX_RECENT_MESSAGES 条
+    调用 Claude Agent HTTP 失败
 
-    Args:
-        session_id: 会话ID
-        message_id: 消息ID
+    transient 表示后端故障（连接失败、超时或 5xx 响应），请求本身有误
+    （4xx 等）时为 False，熔断器只统计前者
     """
-    sessions = _session_store.get("sessions", {})
 
-    if session_id not in sessions:
-        sessions[session_id] = {"root_id": None, "recent": []}
+    def __init__(self, message: str, cause: Exception = None):
+        super().__init__(message)
+        self.transient = cause is not None and is_backend_failure(cause)
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """异常是否表示后端故障：连接失败、超时、5xx 响应或没有可用后端"""
+    if isinstance(error, AgentRequestError):
+        return error.transient
+    if isinstance(error, BackendUnavailableError):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        return response is None or response.status_code >= 500
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if aiohttp is not None and isinstance(error, aiohttp.ClientError):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500
+        return True
+    return False
+
+
+def _session_payload(user_id: str, subdir: str = None,
+                     metadata: dict = None) -> dict:
+    """创建会话的请求体"""
+    payload = {"user_id": user_id}
+    if subdir:
+        payload["subdir"] = subdir
+    if metadata:
+        payload["metadata"] = metadata
+    return payload
+
+
+class PoolTimeoutError(requests.exceptions.RequestException):
+    """连接池已满，等待 pool_timeout 秒仍没有空闲连接（本地过载，不计为后端故障）"""
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """开启 TCP keep-alive 的连接池适配器，避免长时间等待回复时连接被中间设备断开"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+if aiohttp is not None:
+    class _KeepAliveConnector(aiohttp.TCPConnector):
+        """开启 TCP keep-alive 并统计已建立连接数的 aiohttp 连接器"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.connections_created = 0
+
+        async def _wrap_create_connection(self, *args, **kwargs):
+            transport, protocol = await super()._wrap_create_connection(
+                *args, **kwargs)
+            sock = transport.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.connections_created += 1
+            return transport, protocol
+
+        def idle_connections(self) -> int:
+            """连接池中的空闲连接数"""
+            return sum(len(conns) for conns in list(self._conns.values()))
+
+
+# 所有客户端共用的请求对冲策略（同步与异步、各后端共享耗时统计）
+agent_hedge = HedgePolicy(
+    percentile=HEDGE_PERCENTILE,
+    min_samples=HEDGE_MIN_SAMPLES,
+    min_delay=HEDGE_MIN_DELAY_MS / 1000,
+    max_ratio=HEDGE_MAX_RATIO
+)
 
-    recent = sessions[session_id].get("recent", [])
 
-    # 如果消息已存在，移到末尾
-    if message_id in recent:
-        recent.remove(message_id)
-        recent.append(message_id)
-    else:
-        # 添加到末尾
-        recent.append(message_id)
-        # 保持最多 N 条
-        if len(recent) > _MAX_RECENT_MESSAGES:
-            recent.pop(0)
-
-    sessions[session_id]["recent"] = recent
-    _session_store["sessions"] = sessions
-
-    # 更新内存缓存
-    _message_to_session_cache[message_id] = session_id
-
-
-def _set_root_id(session_id: str, root_id: str):
+class ClaudeAgentClient:
     """
-    设置会话的 root_id
+    Claude Agent HTTP 客户端
 
-    Args:
-        session_id: 会话ID
-        root_id: 根消息ID
+    多个工作线程共享同一个实例：底层 urllib3 连接池是线程安全的，池大小为
+    pool_size，池满时请求等待空闲连接而不是新建后丢弃连接，最多等待
+    pool_timeout 秒，超时抛出 PoolTimeoutError。
+    create_session、get_session 与 health_check 按 hedge 策略对冲。
     """
-    sessions = _session_store.get("sessions", {})
-
-    if session_id not in sessions:
-        sessions[session_id] = {"root_id": root_id, "recent": []}
-    else:
-        sessions[session_id]["root_id"] = root_id
-
-    _session_store["sessions"] = sessions
-
-    # 更新内存缓存
-    _message_to_session_cache[root_id] = session_id
-
-
-def _cleanup_old_sessions():
-    """清理过期的会话，保持最多 _MAX_SESSIONS 个"""
-    sessions = _session_store.get("sessions", {})
-
-    if len(sessions) <= _MAX_SESSIONS:
-        return
-
-    # 简单策略：删除最旧的会话（按session_id排序）
-    session_ids = sorted(sessions.keys())
-    to_remove = len(sessions) - _MAX_SESSIONS
-
-    for i in range(to_remove):
-        sess_id = session_ids[i]
-        session_data = sessions[sess_id]
-
-        # 从缓存中删除相关消息
-        root_id = session_data.get("root_id")
-        if root_id and root_id in _message_to_session_cache:
-            del _message_to_session_cache[root_id]
 
-        for msg_id in session_data.get("recent", []):
-            if msg_id in _message_to_session_cache:
-                del _message_to_session_cache[msg_id]
-
-        # 删除会话
-        del sessions[sess_id]
+    def __init__(self, base_url: str = None, timeout: int = None,
+                 connect_timeout: float = None, pool_size: int = None,
+                 pool_timeout: float = None, hedge: HedgePolicy = None):
+        self.base_url = (base_url or CLAUDE_AGENT_URLS[0]).rstrip('/')
+        self.hedge = hedge or agent_hedge
+        self.timeout = timeout or CLAUDE_AGENT_TIMEOUT
+        self.connect_timeout = connect_timeout or CLAUDE_AGENT_CONNECT_TIMEOUT
+        self.pool_size = pool_size or CLAUDE_AGENT_POOL_SIZE
+        self.pool_timeout = (CLAUDE_AGENT_POOL_TIMEOUT if pool_timeout is None
+                             else pool_timeout)
+        # 占用连接的请求数不超过池大小：requests 不支持设置 urllib3 的
+        # pool_timeout，在发出请求前按池大小限流并限定等待时间
+        self._slots = BoundedSemaphore(self.pool_size)
 
-        # 尝试关闭后端会话
+        self.session = requests.Session()
+        adapter = _KeepAliveAdapter(pool_connections=1,
+                                    pool_maxsize=self.pool_size,
+                                    pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._adapter = adapter
+
+        self._stats_lock = Lock()
+        self._active_requests = 0
+        self._total_requests = 0
+        self._peak_active = 0
+        self._pool_timeouts = 0
+
+    def _request(self, method: str, url: str, read_timeout: float = None,
+                 **kwargs) -> requests.Response:
+        """发送请求，连接超时与读取超时分开设置，并统计并发请求数"""
+        timeout = (self.connect_timeout, read_timeout or self.timeout)
+        self._begin_request()
         try:
-            client = get_client()
-            client.close_session(sess_id)
-        except Exception:
-            pass
-
-    _session_store["sessions"] = sessions
-    print(f"🧹 已清理 {to_remove} 个旧会话")
-
-
-class ClaudeAgentClient:
-    """Claude Agent HTTP 客户端"""
+            return self.session.request(method, url, timeout=timeout,
+                                        **kwargs)
+        finally:
+            self._end_request()
+
+    def _begin_request(self):
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            with self._stats_lock:
+                self._pool_timeouts += 1
+            raise PoolTimeoutError(
+                f"连接池已满（{self.pool_size}），等待 {self.pool_timeout:g} "
+                f"秒仍无空闲连接")
+        with self._stats_lock:
+            self._active_requests += 1
+            self._total_requests += 1
+            self._peak_active = max(self._peak_active, self._active_requests)
+
+    def _end_request(self):
+        with self._stats_lock:
+            self._active_requests -= 1
+        self._slots.release()
+
+    def pool_stats(self) -> dict:
+        """
+        获取连接池使用情况
 
-    def __init__(self, base_url: str = None, timeout: int = None):
-        self.base_url = (base_url or CLAUDE_AGENT_URL).rstrip('/')
-        self.timeout = timeout or CLAUDE_AGENT_TIMEOUT
-        self.session = requests.Session()
+        Returns:
+            dict: 池大小、当前/峰值并发请求数、累计请求数、等待连接超时次数、
+                  已建立连接数、空闲连接数
+        """
+        connections = 0
+        idle = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            idle += sum(1 for conn in list(pool.pool.queue)
+                        if conn is not None)
+
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "active_requests": self._active_requests,
+                "peak_active_requests": self._peak_active,
+                "total_requests": self._total_requests,
+                "pool_timeouts": self._pool_timeouts,
+                "connections_created": connections,
+                "idle_connections": idle
+            }
 
     def create_session(self, user_id: str, subdir: str = None,
                        metadata: dict = None) -> dict:
@@ -277,22 +494,22 @@ class ClaudeAgentClient:
         Returns:
             dict: 会话信息
         """
-        url = f"{self.base_url}/api/v1/sessions"
-        payload = {"user_id": user_id}
+        payload = _session_payload(user_id, subdir, metadata)
 
-        if subdir:
-            payload["subdir"] = subdir
-        if metadata:
-            payload["metadata"] = metadata
+        # 对冲时落后的一次也会创建会话，需要关闭
+        return self.hedge.call(
+            "create_session", lambda: self._create_session(payload),
+            discard=lambda info: self.close_session(info["session_id"]))
 
+    def _create_session(self, payload: dict) -> dict:
+        """创建一次会话（不对冲）"""
+        url = f"{self.base_url}/api/v1/sessions"
         try:
-            response = self.session.post(
-                url, json=payload, timeout=self.timeout
-            )
+            response = self._request("POST", url, json=payload)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            raise Exception(f"创建会话失败: {str(e)}")
+            raise AgentRequestError(f"创建会话失败: {str(e)}", e)
 
     def get_session(self, session_id: str) -> dict:
         """
@@ -306,12 +523,15 @@ class ClaudeAgentClient:
         """
         url = f"{self.base_url}/api/v1/sessions/{session_id}"
 
-        try:
-            response = self.session.get(url, timeout=self.timeout)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"获取会话失败: {str(e)}")
+        def fetch() -> dict:
+            try:
+                response = self._request("GET", url)
+                response.raise_for_status()
+                return response.json()
+            except requests.exceptions.RequestException as e:
+                raise AgentRequestError(f"获取会话失败: {str(e)}", e)
+
+        return self.hedge.call("get_session", fetch)
 
     def resume_session(self, session_id: str) -> dict:
         """
@@ -326,11 +546,11 @@ class ClaudeAgentClient:
         url = f"{self.base_url}/api/v1/sessions/{session_id}/resume"
 
         try:
-            response = self.session.post(url, timeout=self.timeout)
+            response = self._request("POST", url)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            raise Exception(f"恢复会话失败: {str(e)}")
+            raise AgentRequestError(f"恢复会话失败: {str(e)}", e)
 
     def close_session(self, session_id: str) -> bool:
         """
@@ -345,11 +565,11 @@ class ClaudeAgentClient:
         url = f"{self.base_url}/api/v1/sessions/{session_id}"
 
         try:
-            response = self.session.delete(url, timeout=self.timeout)
+            response = self._request("DELETE", url)
             response.raise_for_status()
             return True
         except requests.exceptions.RequestException as e:
-            print(f"关闭会话失败: {str(e)}")
+            logger.warning("关闭会话失败: %s", e)
             return False
 
     def chat(self, session_id: str, message: str) -> dict:
@@ -370,13 +590,11 @@ class ClaudeAgentClient:
         }
 
         try:
-            response = self.session.post(
-                url, json=payload, timeout=self.timeout
-            )
+            response = self._request("POST", url, json=payload)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            raise Exception(f"发送消息失败: {str(e)}")
+            raise AgentRequestError(f"发送消息失败: {str(e)}", e)
 
     def chat_stream(self, session_id: str, message: str):
         """
@@ -395,11 +613,14 @@ class ClaudeAgentClient:
             "message": message
         }
 
+        # 流式读取期间连接一直被占用，读取结束后才计为请求完成
+        self._begin_request()
+        response = None
         try:
             response = self.session.post(
                 url,
                 json=payload,
-                timeout=self.timeout,
+                timeout=(self.connect_timeout, self.timeout),
                 stream=True
             )
             response.raise_for_status()
@@ -411,7 +632,11 @@ class ClaudeAgentClient:
                         data = json.loads(line[6:])
                         yield data
         except requests.exceptions.RequestException as e:
-            raise Exception(f"流式发送消息失败: {str(e)}")
+            raise AgentRequestError(f"流式发送消息失败: {str(e)}", e)
+        finally:
+            if response is not None:
+                response.close()
+            self._end_request()
 
     def health_check(self) -> bool:
         """
@@ -422,28 +647,454 @@ class ClaudeAgentClient:
         """
         url = f"{self.base_url}/health"
 
-        try:
-            response = self.session.get(url, timeout=5)
-            return response.status_code == 200
-        except requests.exceptions.RequestException:
-            return False
+        def check() -> bool:
+            try:
+                response = self._request("GET", url, read_timeout=5)
+                return response.status_code == 200
+            except requests.exceptions.RequestException:
+                return False
+
+        return self.hedge.call("health_check", check)
+
+
+class RoutedAgentClient:
+    """
+    多后端 Claude Agent HTTP 客户端（方法与 ClaudeAgentClient 一致）
+
+    每个后端一个 ClaudeAgentClient，由 BackendBalancer 为新会话选择节点，
+    返回的会话ID附加节点标识，之后的请求固定发往该节点。创建会话的对冲
+    请求发往另一个健康节点。
+    """
+
+    def __init__(self, urls: list, hedge: HedgePolicy = None):
+        self.hedge = hedge or agent_hedge
+        self.clients: dict = {}  # 节点标识 -> ClaudeAgentClient
+        self.balancer = BackendBalancer(
+            urls,
+            health_check=lambda backend: (
+                self.clients[backend.node_id].health_check()),
+            health_interval=CLAUDE_AGENT_HEALTH_INTERVAL
+        )
+        for backend in self.balancer.backends:
+            self.clients[backend.node_id] = ClaudeAgentClient(
+                base_url=backend.url)
+        self.balancer.start()
+
+    def _call(self, backend, method: str, *args, **kwargs):
+        with self.balancer.track(backend):
+            return getattr(self.clients[backend.node_id], method)(
+                *args, **kwargs)
+
+    def create_session(self, user_id: str, subdir: str = None,
+                       metadata: dict = None) -> dict:
+        """在进行中请求最少的健康节点上创建会话，对冲请求发往另一个节点"""
+        payload = _session_payload(user_id, subdir, metadata)
+        backend = self.balancer.pick()
+        return self.hedge.call(
+            "create_session", lambda: self._create_on(backend, payload),
+            discard=lambda info: self.close_session(info["session_id"]),
+            hedge_func=lambda: self._create_on(
+                self.balancer.pick(exclude=backend), payload))
+
+    def _create_on(self, backend, payload: dict) -> dict:
+        session_info = dict(self._call(backend, "_create_session", payload))
+        session_info["session_id"] = self.balancer.tag(
+            backend, session_info["session_id"])
+        return session_info
+
+    def get_session(self, session_id: str) -> dict:
+        backend, raw_id = self.balancer.route(session_id)
+        return self._call(backend, "get_session", raw_id)
+
+    def resume_session(self, session_id: str) -> dict:
+        backend, raw_id = self.balancer.route(session_id)
+        return self._call(backend, "resume_session", raw_id)
+
+    def close_session(self, session_id: str) -> bool:
+        backend, raw_id = self.balancer.route(session_id)
+        return self._call(backend, "close_session", raw_id)
+
+    def chat(self, session_id: str, message: str) -> dict:
+        backend, raw_id = self.balancer.route(session_id)
+        return self._call(backend, "chat", raw_id, message)
+
+    def chat_stream(self, session_id: str, message: str):
+        """调用时即完成路由（节点不可用时立即抛出），返回事件迭代器"""
+        backend, raw_id = self.balancer.route(session_id)
+        return self._stream(backend, raw_id, message)
+
+    def _stream(self, backend, raw_id: str, message: str):
+        with self.balancer.track(backend):
+            yield from self.clients[backend.node_id].chat_stream(raw_id,
+                                                                 message)
+
+    def health_check(self) -> bool:
+        """立即检查所有节点，至少一个健康时返回 True"""
+        return self.balancer.check_all()
+
+    def pool_stats(self) -> dict:
+        """各节点连接池统计之和"""
+        totals: dict = {}
+        for client in self.clients.values():
+            for field, value in client.pool_stats().items():
+                totals[field] = totals.get(field, 0) + value
+        return totals
 
 
 # 全局客户端实例
-_client: Optional[ClaudeAgentClient] = None
+_client = None
+# 异步模式下最近创建的异步客户端（仅用于连接池指标）
+_async_client = None
+_client_lock = Lock()
 
 
-def get_client() -> ClaudeAgentClient:
-    """获取全局客户端实例"""
+def get_client():
+    """
+    获取全局客户端实例（线程安全）
+
+    Returns:
+        ClaudeAgentClient 或 RoutedAgentClient（配置了多个后端时）
+    """
     global _client
     if _client is None:
-        _client = ClaudeAgentClient()
+        with _client_lock:
+            if _client is None:
+                if len(CLAUDE_AGENT_URLS) > 1:
+                    _client = RoutedAgentClient(CLAUDE_AGENT_URLS)
+                else:
+                    _client = ClaudeAgentClient()
     return _client
 
 
+agent_breaker = CircuitBreaker(
+    probe=lambda: get_client().health_check(),
+    name="Claude Agent 服务",
+    failure_rate=CIRCUIT_FAILURE_RATE,
+    window=CIRCUIT_WINDOW,
+    min_calls=CIRCUIT_MIN_CALLS,
+    open_seconds=CIRCUIT_OPEN_SECONDS,
+    max_open_seconds=CIRCUIT_MAX_OPEN_SECONDS,
+    is_failure=is_backend_failure,
+    slow_call_seconds=CIRCUIT_SLOW_CALL_SECONDS
+)
+
+
+class AsyncClaudeAgentClient:
+    """
+    Claude Agent HTTP 异步客户端（基于 aiohttp，方法与 ClaudeAgentClient 一致）
+
+    连接池与同步客户端一致：池大小为 pool_size，池满时最多等待 pool_timeout
+    秒空闲连接，超时抛出 AgentRequestError（不计为后端故障）；开启 TCP
+    keep-alive；pool_stats() 提供同样的连接池统计。
+    """
+
+    def __init__(self, base_url: str = None, timeout: int = None,
+                 connect_timeout: float = None, pool_size: int = None,
+                 pool_timeout: float = None, hedge: HedgePolicy = None):
+        if aiohttp is None:
+            raise RuntimeError("异步客户端需要安装 aiohttp: pip install aiohttp")
+        self.base_url = (base_url or CLAUDE_AGENT_URLS[0]).rstrip('/')
+        self.hedge = hedge or agent_hedge
+        self.timeout = timeout or CLAUDE_AGENT_TIMEOUT
+        self.connect_timeout = connect_timeout or CLAUDE_AGENT_CONNECT_TIMEOUT
+        self.pool_size = pool_size or CLAUDE_AGENT_ASYNC_POOL_SIZE
+        self.pool_timeout = (CLAUDE_AGENT_POOL_TIMEOUT if pool_timeout is None
+                             else pool_timeout)
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._connector: Optional["_KeepAliveConnector"] = None
+        # 与同步客户端一样在发出请求前按池大小限流，限定等待连接的时间
+        self._slots = asyncio.Semaphore(self.pool_size)
+        self._active_requests = 0
+        self._total_requests = 0
+        self._peak_active = 0
+        self._pool_timeouts = 0
+        self._connections_closed = 0
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        """
+        获取 aiohttp 会话（需在事件循环中调用）
+
+        连接数上限为 pool_size。不设置总超时：等待连接与流式读取整个回复
+        的时间不计入请求超时，只限制建立连接（sock_connect）与两次读到
+        数据之间的间隔（sock_read）。
+        """
+        if self._session is None or self._session.closed:
+            if self._connector is not None:
+                self._connections_closed += self._connector.connections_created
+            self._connector = _KeepAliveConnector(
+                limit=self.pool_size, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=self._connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=self.connect_timeout,
+                    sock_read=self.timeout)
+            )
+        return self._session
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        """占用一个连接池名额直到请求（含流式读取）结束，并统计并发请求数"""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.pool_timeout)
+        except asyncio.TimeoutError:
+            self._pool_timeouts += 1
+            raise PoolTimeoutError(
+                f"连接池已满（{self.pool_size}），等待 {self.pool_timeout:g} "
+                f"秒仍无空闲连接") from None
+        self._active_requests += 1
+        self._total_requests += 1
+        self._peak_active = max(self._peak_active, self._active_requests)
+        try:
+            yield
+        finally:
+            self._active_requests -= 1
+            self._slots.release()
+
+    def pool_stats(self) -> dict:
+        """获取连接池使用情况（字段与 ClaudeAgentClient.pool_stats 相同）"""
+        connector = self._connector
+        return {
+            "pool_size": self.pool_size,
+            "active_requests": self._active_requests,
+            "peak_active_requests": self._peak_active,
+            "total_requests": self._total_requests,
+            "pool_timeouts": self._pool_timeouts,
+            "connections_created": self._connections_closed + (
+                connector.connections_created if connector else 0),
+            "idle_connections": (connector.idle_connections()
+                                 if connector and not connector.closed else 0)
+        }
+
+    async def _request_json(self, method: str, url: str, error_msg: str,
+                            payload: dict = None) -> dict:
+        """发送请求并解析 JSON 响应"""
+        try:
+            async with self._slot(), self._get_session().request(
+                    method, url, json=payload) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                PoolTimeoutError) as e:
+            raise AgentRequestError(
+                f"{error_msg}: {str(e) or type(e).__name__}", e)
+
+    async def create_session(self, user_id: str, subdir: str = None,
+                             metadata: dict = None) -> dict:
+        """创建新会话"""
+        payload = _session_payload(user_id, subdir, metadata)
+        return await self.hedge.call_async(
+            "create_session", lambda: self._create_session(payload),
+            discard=lambda info: self.close_session(info["session_id"]))
+
+    async def _create_session(self, payload: dict) -> dict:
+        """创建一次会话（不对冲）"""
+        return await self._request_json(
+            "POST", f"{self.base_url}/api/v1/sessions", "创建会话失败",
+            payload)
+
+    async def get_session(self, session_id: str) -> dict:
+        """获取会话信息"""
+        return await self.hedge.call_async(
+            "get_session",
+            lambda: self._request_json(
+                "GET", f"{self.base_url}/api/v1/sessions/{session_id}",
+                "获取会话失败"))
+
+    async def close_session(self, session_id: str) -> bool:
+        """关闭会话"""
+        url = f"{self.base_url}/api/v1/sessions/{session_id}"
+
+        try:
+            async with self._slot(), self._get_session().delete(
+                    url) as response:
+                response.raise_for_status()
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                PoolTimeoutError) as e:
+            logger.warning("关闭会话失败: %s", e)
+            return False
+
+    async def chat(self, session_id: str, message: str) -> dict:
+        """发送消息（非流式）"""
+        payload = {"session_id": session_id, "message": message}
+        return await self._request_json(
+            "POST", f"{self.base_url}/api/v1/chat", "发送消息失败", payload)
+
+    async def chat_stream(self, session_id: str, message: str):
+        """
+        发送消息（流式）
+
+        Yields:
+            dict: SSE 事件
+        """
+        url = f"{self.base_url}/api/v1/chat/stream"
+        payload = {"session_id": session_id, "message": message}
+
+        # 流式读取期间连接一直被占用，读取结束后才计为请求完成
+        try:
+            async with self._slot(), self._get_session().post(
+                    url, json=payload) as response:
+                response.raise_for_status()
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if line.startswith('data: '):
+                        yield json.loads(line[6:])
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                PoolTimeoutError) as e:
+            raise AgentRequestError(
+                f"流式发送消息失败: {str(e) or type(e).__name__}", e)
+
+    async def health_check(self) -> bool:
+        """健康检查"""
+        url = f"{self.base_url}/health"
+
+        async def check() -> bool:
+            try:
+                timeout = aiohttp.ClientTimeout(
+                    total=None, sock_connect=self.connect_timeout,
+                    sock_read=5)
+                async with self._slot(), self._get_session().get(
+                        url, timeout=timeout) as response:
+                    return response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    PoolTimeoutError):
+                return False
+
+        return await self.hedge.call_async("health_check", check)
+
+    async def close(self) -> None:
+        """关闭底层连接"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class RoutedAsyncAgentClient:
+    """
+    多后端异步客户端（方法与 AsyncClaudeAgentClient 一致），与同步客户端共用
+    负载均衡器，创建会话的对冲请求发往另一个健康节点
+    """
+
+    def __init__(self, balancer: BackendBalancer, hedge: HedgePolicy = None):
+        self.balancer = balancer
+        self.hedge = hedge or agent_hedge
+        self.clients = {
+            backend.node_id: AsyncClaudeAgentClient(base_url=backend.url)
+            for backend in balancer.backends
+        }
+
+    async def _call(self, backend, method: str, *args):
+        with self.balancer.track(backend):
+            return await getattr(self.clients[backend.node_id], method)(*args)
+
+    async def create_session(self, user_id: str, subdir: str = None,
+                             metadata: dict = None) -> dict:
+        """在进行中请求最少的健康节点上创建会话，对冲请求发往另一个节点"""
+        payload = _session_payload(user_id, subdir, metadata)
+        backend = self.balancer.pick()
+        return await self.hedge.call_async(
+            "create_session", lambda: self._create_on(backend, payload),
+            discard=lambda info: self.close_session(info["session_id"]),
+            hedge_func=lambda: self._create_on(
+                self.balancer.pick(exclude=backend), payload))
+
+    async def _create_on(self, backend, payload: dict) -> dict:
+        session_info = dict(await self._call(backend, "_create_session",
+                                             payload))
+        session_info["session_id"] = self.balancer.tag(
+            backend, session_info["session_id"])
+        return session_info
+
+    async def get_session(self, session_id: str) -> dict:
+        backend, raw_id = self.balancer.route(session_id)
+        return await self._call(backend, "get_session", raw_id)
+
+    async def close_session(self, session_id: str) -> bool:
+        backend, raw_id = self.balancer.route(session_id)
+        return await self._call(backend, "close_session", raw_id)
+
+    async def chat(self, session_id: str, message: str) -> dict:
+        backend, raw_id = self.balancer.route(session_id)
+        return await self._call(backend, "chat", raw_id, message)
+
+    def chat_stream(self, session_id: str, message: str):
+        """调用时即完成路由（节点不可用时立即抛出），返回异步事件迭代器"""
+        backend, raw_id = self.balancer.route(session_id)
+        return self._stream(backend, raw_id, message)
+
+    async def _stream(self, backend, raw_id: str, message: str):
+        with self.balancer.track(backend):
+            async for event in self.clients[backend.node_id].chat_stream(
+                    raw_id, message):
+                yield event
+
+    async def health_check(self) -> bool:
+        """立即检查所有节点，至少一个健康时返回 True"""
+        return await asyncio.to_thread(self.balancer.check_all)
+
+    def pool_stats(self) -> dict:
+        """各节点连接池统计之和"""
+        totals: dict = {}
+        for client in self.clients.values():
+            for field, value in client.pool_stats().items():
+                totals[field] = totals.get(field, 0) + value
+        return totals
+
+    async def close(self) -> None:
+        """关闭所有节点的底层连接"""
+        for client in self.clients.values():
+            await client.close()
+
+
+def create_async_client():
+    """
+    创建异步客户端（需在事件循环中使用）
+
+    Returns:
+        AsyncClaudeAgentClient 或 RoutedAsyncAgentClient（配置了多个后端时）
+    """
+    global _async_client
+    client = get_client()
+    if isinstance(client, RoutedAgentClient):
+        _async_client = RoutedAsyncAgentClient(client.balancer)
+    else:
+        _async_client = AsyncClaudeAgentClient()
+    return _async_client
+
+
 def init_session_store():
     """初始化会话存储（程序启动时调用）"""
-    _load_session_store()
+    get_session_store()
+
+
+def flush_session_store():
+    """将尚未持久化的会话映射变更立即写入磁盘"""
+    if _session_store is not None:
+        _session_store.flush()
+
+
+def start_session_pool():
+    """启动后端会话预创建池（程序启动时调用，SESSION_POOL_SIZE 为 0 时不启动）"""
+    if SESSION_POOL_SIZE <= 0:
+        return
+    if SESSION_POOL_MODE not in ("generic", "user"):
+        logger.warning("⚠️ 未知的预创建方式: %s，使用 generic",
+                       SESSION_POOL_MODE)
+    _session_pool.start()
+    atexit.register(close_session_pool)
+
+
+def close_session_pool(timeout: float = 5):
+    """关闭全部未使用的预创建会话，最多等待 timeout 秒"""
+    _session_pool.close_all()
+    _session_closer.drain(timeout)
+
+
+def _take_pooled_session(user_id: str) -> Optional[str]:
+    """取出一个预创建的会话，池为空时返回 None"""
+    session_id = _session_pool.acquire(user_id)
+    if session_id:
+        logger.info("使用预创建会话: %s", session_id)
+    return session_id
 
 
 def get_or_create_session(message_id: str, user_id: str) -> str:
@@ -459,8 +1110,6 @@ def get_or_create_session(message_id: str, user_id: str) -> str:
     Returns:
         str: claude-agent-http 的 session_id
     """
-    _load_session_store()
-
     # 尝试从缓存获取
     session_id = get_session_id(message_id)
 
@@ -499,8 +1148,6 @@ def link_session(new_message_id: str,
     Returns:
         str: 关联的 session_id，如果没有则返回 None
     """
-    _load_session_store()
-
     session_id = get_session_id(parent_message_id)
     if session_id:
         save_session_mapping(new_message_id, session_id, is_root=False)
@@ -519,14 +1166,8 @@ def get_session_id(message_id: str) -> Optional[str]:
     Returns:
         str: session_id，如果没有则返回 None
     """
-    _load_session_store()
-
-    with _session_lock:
-        # 优先从内存缓存查找
-        if message_id in _message_to_session_cache:
-            return _message_to_session_cache[message_id]
-
-    return None
+    with SESSION_STORE_SECONDS.time(op="get"):
+        return get_session_store().get_session_id(message_id)
 
 
 def save_session_mapping(message_id: str, session_id: str,
@@ -539,33 +1180,125 @@ def save_session_mapping(message_id: str, session_id: str,
         session_id: claude-agent-http 的 session_id
         is_root: 是否为 root_id（对话根消息）
     """
-    _load_session_store()
+    with SESSION_STORE_SECONDS.time(op="save"):
+        get_session_store().save_mapping(message_id, session_id,
+                                         is_root=is_root)
 
-    with _session_lock:
-        # 检查是否已经在缓存中
-        existing_session = _message_to_session_cache.get(message_id)
 
-        if existing_session == session_id and not is_root:
-            # 映射已存在且相同，跳过
-            return
-
-        # 更新会话数据
-        if is_root:
-            _set_root_id(session_id, message_id)
-        else:
-            _add_recent_message(session_id, message_id)
-
-        # 清理旧会话
-        _cleanup_old_sessions()
+def get_session_count() -> int:
+    """获取当前会话数量"""
+    return get_session_store().count()
 
-        # 保存到文件
-        _save_session_store()
 
+def get_session_stats() -> dict:
+    """
+    获取会话存储统计信息
 
-def get_session_count() -> int:
-    """获取当前会话数量"""
-    _load_session_store()
-    return len(_session_store.get("sessions", {}))
+    Returns:
+        dict: 会话数量、容量配置、淘汰统计（evicted_capacity / evicted_idle）
+              及后端会话关闭统计（close_pending / close_succeeded / close_failed）
+    """
+    stats = get_session_store().stats()
+    stats["close_pending"] = _session_closer.pending()
+    stats["close_succeeded"] = _session_closer.closed
+    stats["close_failed"] = _session_closer.failed
+    return stats
+
+
+def _session_metric(field: str):
+    """创建从 get_session_stats() 读取单个字段的指标回调"""
+    def read():
+        return get_session_stats()[field]
+    return read
+
+
+def _evicted_metric() -> dict:
+    """按淘汰原因读取累计淘汰数"""
+    stats = get_session_stats()
+    return {("capacity",): stats["evicted_capacity"],
+            ("idle",): stats["evicted_idle"]}
+
+
+def _pool_metric(field: str):
+    """创建读取单个连接池统计字段的指标回调（同步与异步客户端之和）"""
+    def read():
+        return sum(client.pool_stats()[field]
+                   for client in (_client, _async_client)
+                   if client is not None)
+    return read
+
+
+def _backend_metric(field: str):
+    """创建按后端读取负载均衡器单个字段的指标回调（单后端时无数据）"""
+    def read():
+        if not isinstance(_client, RoutedAgentClient):
+            return {}
+        return {(node["url"],): int(node[field])
+                for node in _client.balancer.stats()}
+    return read
+
+
+# 运行指标
+SESSION_STORE_SECONDS = metrics.histogram(
+    "lark_session_store_seconds",
+    "Session store operation latency in seconds", ("op",))
+metrics.gauge("lark_sessions", "Sessions held in the session store",
+              callback=_session_metric("sessions"))
+metrics.callback_counter(
+    "lark_sessions_evicted_total", "Sessions evicted from the store",
+    callback=_evicted_metric, labels=("reason",))
+metrics.gauge("lark_session_close_pending",
+              "Evicted sessions waiting to be closed on the backend",
+              callback=_session_metric("close_pending"))
+metrics.callback_counter(
+    "lark_session_close_failed_total",
+    "Backend session closes that failed after all retries",
+    callback=_session_metric("close_failed"))
+metrics.gauge("lark_session_pool_available",
+              "Pre-created backend sessions ready to hand out",
+              callback=_session_pool.available)
+metrics.callback_counter(
+    "lark_session_pool_total", "Session pool lookups by outcome",
+    callback=lambda: {("hit",): _session_pool.hits,
+                      ("miss",): _session_pool.misses},
+    labels=("outcome",))
+metrics.gauge("lark_agent_circuit_state",
+              "Agent circuit breaker state (0 closed, 1 half-open, 2 open)",
+              callback=lambda: {"closed": 0, "half_open": 1,
+                                "open": 2}[agent_breaker.state])
+metrics.callback_counter(
+    "lark_agent_circuit_rejected_total",
+    "Agent calls failed fast while the circuit was open",
+    callback=lambda: agent_breaker.rejected)
+metrics.gauge("lark_agent_backend_healthy",
+              "Whether each agent backend passed its last health check",
+              callback=_backend_metric("healthy"), labels=("backend",))
+metrics.gauge("lark_agent_backend_outstanding",
+              "In-flight requests per agent backend",
+              callback=_backend_metric("outstanding"), labels=("backend",))
+metrics.callback_counter(
+    "lark_agent_hedge_total", "Hedged agent requests by outcome",
+    callback=lambda: {("sent",): agent_hedge.hedged,
+                      ("won",): agent_hedge.wins,
+                      ("discarded",): agent_hedge.discarded},
+    labels=("outcome",))
+metrics.gauge("lark_agent_active_requests",
+              "In-flight requests on the agent HTTP clients",
+              callback=_pool_metric("active_requests"))
+metrics.gauge("lark_agent_idle_connections",
+              "Idle pooled connections to the agent backend",
+              callback=_pool_metric("idle_connections"))
+metrics.callback_counter(
+    "lark_agent_pool_timeouts_total",
+    "Agent requests that gave up waiting for a pooled connection",
+    callback=_pool_metric("pool_timeouts"))
+
+
+def _replace_session(session_info: dict, error: Exception) -> str:
+    """已有会话所在的后端不可用，记录并返回新建的会话ID"""
+    session_id = session_info["session_id"]
+    logger.warning("%s，改用新会话: %s", error, session_id)
+    return session_id
 
 
 def ask_claude_sync(user_prompt: str, user_id: str = "default",
@@ -595,28 +1328,271 @@ def ask_claude_sync(user_prompt: str, user_id: str = "default",
     }
 
     try:
+        # 熔断期间直接失败，不等待后端超时
+        agent_breaker.before_call()
+        started = time.monotonic()
         client = get_client()
 
-        # 如果没有提供 session_id，创建新会话
+        # 如果没有提供 session_id，优先使用预创建会话，否则创建新会话
+        if not session_id:
+            session_id = _take_pooled_session(user_id)
         if not session_id:
             session_info = client.create_session(user_id=user_id)
             session_id = session_info["session_id"]
-            print(f"创建新会话: {session_id}")
+            logger.info("创建新会话: %s", session_id)
 
         result['session_id'] = session_id
 
-        # 发送消息
-        response = client.chat(session_id=session_id, message=user_prompt)
+        # 发送消息；会话所在的后端不可用时改用健康后端上的新会话
+        try:
+            response = client.chat(session_id=session_id, message=user_prompt)
+        except BackendUnavailableError as e:
+            session_id = _replace_session(client.create_session(
+                user_id=user_id), e)
+            result['session_id'] = session_id
+            response = client.chat(session_id=session_id, message=user_prompt)
 
         result['content'] = response.get('text', '')
         result['timestamp'] = response.get('timestamp')
+        agent_breaker.record_success(time.monotonic() - started)
 
         # 如果有 tool_calls，可以记录下来
         tool_calls = response.get('tool_calls', [])
         if tool_calls:
-            print(f"工具调用: {len(tool_calls)} 次")
+            logger.debug("工具调用: %d 次", len(tool_calls))
+
+    except CircuitOpenError as e:
+        result['error'] = str(e)
+        result['content'] = str(e)
+    except Exception as e:
+        agent_breaker.record_error(e)
+        result['error'] = str(e)
+        result['content'] = f"调用 Claude Agent HTTP 时出错: {str(e)}"
+
+    return result
+
+
+def _extract_stream_text(event: dict) -> str:
+    """
+    从 SSE 事件中提取增量文本
+
+    Args:
+        event: chat_stream 产生的事件
+
+    Returns:
+        str: 增量文本，非文本事件返回空字符串
+    """
+    if event.get('type') not in (None, 'text', 'text_delta', 'content',
+                                 'assistant', 'message'):
+        return ''
+    text = event.get('text')
+    if text is None:
+        text = event.get('content', '')
+    return text if isinstance(text, str) else ''
+
+
+def _apply_stream_event(event: dict, chunks: list, result: dict) -> bool:
+    """
+    处理一条 SSE 事件，增量文本追加到 chunks
 
+    Args:
+        event: chat_stream 产生的事件
+        chunks: 已收到的文本片段
+        result: 结果字典（结束事件中的 timestamp 写入此处）
+
+    Returns:
+        bool: 是否追加了新的增量文本
+    """
+    event_type = event.get('type')
+
+    if event_type == 'error':
+        raise Exception(event.get('error') or event.get('message')
+                        or '流式响应返回错误')
+
+    if event_type in ('done', 'result', 'end'):
+        if event.get('timestamp'):
+            result['timestamp'] = event['timestamp']
+        # 部分后端在结束事件中携带完整文本
+        if not chunks and isinstance(event.get('text'), str):
+            chunks.append(event['text'])
+        return False
+
+    text = _extract_stream_text(event)
+    if not text:
+        return False
+
+    chunks.append(text)
+    return True
+
+
+def ask_claude_stream(user_prompt: str, user_id: str = "default",
+                      session_id: str = None, on_chunk=None) -> dict:
+    """
+    流式调用 Claude Agent HTTP 接口
+
+    Args:
+        user_prompt: 用户的问题
+        user_id: 用户ID（用于创建会话）
+        session_id: 已有的会话ID（可选，如果不提供则创建新会话）
+        on_chunk: 回调函数，每收到增量文本时以累计文本调用（可选）
+
+    Returns:
+        dict: 与 ask_claude_sync 相同结构的结果字典
+    """
+    result = {
+        'content': '',
+        'session_id': None,
+        'timestamp': None,
+        'error': None
+    }
+
+    try:
+        # 熔断期间直接失败，不等待后端超时
+        agent_breaker.before_call()
+        started = time.monotonic()
+        first_event = None  # 收到首个事件的时间，用于判断慢调用
+        client = get_client()
+
+        # 如果没有提供 session_id，优先使用预创建会话，否则创建新会话
+        if not session_id:
+            session_id = _take_pooled_session(user_id)
+        if not session_id:
+            session_info = client.create_session(user_id=user_id)
+            session_id = session_info["session_id"]
+            logger.info("创建新会话: %s", session_id)
+
+        result['session_id'] = session_id
+
+        # 会话所在的后端不可用时改用健康后端上的新会话
+        try:
+            events = client.chat_stream(session_id=session_id,
+                                        message=user_prompt)
+        except BackendUnavailableError as e:
+            session_id = _replace_session(client.create_session(
+                user_id=user_id), e)
+            result['session_id'] = session_id
+            events = client.chat_stream(session_id=session_id,
+                                        message=user_prompt)
+
+        chunks = []
+        for event in events:
+            if first_event is None:
+                first_event = time.monotonic()
+            if not _apply_stream_event(event, chunks, result):
+                continue
+
+            if on_chunk:
+                try:
+                    on_chunk(''.join(chunks))
+                except Exception as e:
+                    logger.warning("流式回调出错: %s", e)
+
+        result['content'] = ''.join(chunks)
+        agent_breaker.record_success(
+            (first_event or time.monotonic()) - started)
+
+    except CircuitOpenError as e:
+        result['error'] = str(e)
+        result['content'] = str(e)
+    except Exception as e:
+        agent_breaker.record_error(e)
+        result['error'] = str(e)
+        result['content'] = f"调用 Claude Agent HTTP 时出错: {str(e)}"
+
+    return result
+
+
+async def ask_claude_async(client: AsyncClaudeAgentClient, user_prompt: str,
+                           user_id: str = "default", session_id: str = None,
+                           stream: bool = False, on_chunk=None) -> dict:
+    """
+    异步调用 Claude Agent HTTP 接口
+
+    Args:
+        client: 异步客户端
+        user_prompt: 用户的问题
+        user_id: 用户ID（用于创建会话）
+        session_id: 已有的会话ID（可选，如果不提供则创建新会话）
+        stream: 是否使用流式接口
+        on_chunk: 流式模式下收到增量文本时以累计文本调用，可返回 awaitable
+
+    Returns:
+        dict: 与 ask_claude_sync 相同结构的结果字典
+    """
+    result = {
+        'content': '',
+        'session_id': None,
+        'timestamp': None,
+        'error': None
+    }
+
+    try:
+        # 熔断期间直接失败，不等待后端超时
+        agent_breaker.before_call()
+        started = time.monotonic()
+        first_event = None  # 流式调用收到首个事件的时间
+
+        # 如果没有提供 session_id，优先使用预创建会话，否则创建新会话
+        if not session_id:
+            session_id = _take_pooled_session(user_id)
+        if not session_id:
+            session_info = await client.create_session(user_id=user_id)
+            session_id = session_info["session_id"]
+            logger.info("创建新会话: %s", session_id)
+
+        result['session_id'] = session_id
+
+        if stream:
+            chunks = []
+            try:
+                events = client.chat_stream(session_id=session_id,
+                                            message=user_prompt)
+            except BackendUnavailableError as e:
+                session_id = _replace_session(
+                    await client.create_session(user_id=user_id), e)
+                result['session_id'] = session_id
+                events = client.chat_stream(session_id=session_id,
+                                            message=user_prompt)
+            async for event in events:
+                if first_event is None:
+                    first_event = time.monotonic()
+                if not _apply_stream_event(event, chunks, result):
+                    continue
+
+                if on_chunk:
+                    try:
+                        ret = on_chunk(''.join(chunks))
+                        if inspect.isawaitable(ret):
+                            await ret
+                    except Exception as e:
+                        logger.warning("流式回调出错: %s", e)
+
+            result['content'] = ''.join(chunks)
+        else:
+            try:
+                response = await client.chat(session_id=session_id,
+                                             message=user_prompt)
+            except BackendUnavailableError as e:
+                session_id = _replace_session(
+                    await client.create_session(user_id=user_id), e)
+                result['session_id'] = session_id
+                response = await client.chat(session_id=session_id,
+                                             message=user_prompt)
+            result['content'] = response.get('text', '')
+            result['timestamp'] = response.get('timestamp')
+
+            tool_calls = response.get('tool_calls', [])
+            if tool_calls:
+                logger.debug("工具调用: %d 次", len(tool_calls))
+
+        agent_breaker.record_success(
+            (first_event or time.monotonic()) - started)
+
+    except CircuitOpenError as e:
+        result['error'] = str(e)
+        result['content'] = str(e)
     except Exception as e:
+        agent_breaker.record_error(e)
         result['error'] = str(e)
         result['content'] = f"调用 Claude Agent HTTP 时出错: {str(e)}"
 
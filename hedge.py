@@ -0,0 +1,295 @@
+"""请求对冲模块：幂等调用超过近期分位耗时仍未返回时再发一次，取先返回的结果"""
+
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from threading import Condition, Lock
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _AttemptRunner:
+    """
+    执行对冲调用的常驻线程
+
+    有空闲线程时复用，没有时才新建；空闲超过 idle_timeout 秒的线程退出。
+    同时进行的调用数通常只有工作线程数的量级，线程数随之而定。
+    """
+
+    def __init__(self, idle_timeout: float = 60):
+        self.idle_timeout = idle_timeout
+        self._tasks: deque = deque()
+        self._idle = 0  # 正在等待任务的线程数
+        self._started = 0  # 累计新建的线程数
+        self._cond = Condition()
+
+    def submit(self, task) -> None:
+        """执行无参数的 task"""
+        with self._cond:
+            self._tasks.append(task)
+            if self._idle >= len(self._tasks):
+                self._cond.notify()
+                return
+            self._started += 1
+            index = self._started
+        threading.Thread(target=self._worker, name=f"hedge-{index}",
+                         daemon=True).start()
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.idle_timeout
+                while not self._tasks:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._idle += 1
+                    self._cond.wait(remaining)
+                    self._idle -= 1
+                task = self._tasks.popleft()
+            task()
+
+
+class HedgePolicy:
+    """
+    请求对冲策略
+
+    按操作名分别记录最近 window 次成功调用的耗时。调用超过该操作的
+    percentile 分位耗时（不低于 min_delay 秒）仍未返回时，再发出一次相同的
+    调用（提供 hedge_func 时改为调用它，例如发往另一个后端），取先成功返回
+    的结果。已发出的 HTTP 请求无法中途撤回：落后的调用完成后若成功，结果
+    交给 discard 释放（例如关闭多创建的会话）；异步调用没有 discard 时直接
+    取消。
+
+    同步调用不能对冲时（样本不足或额度不够）直接在调用方线程执行；可以对冲
+    时两次调用都交给常驻线程执行，调用方只负责等待，才能在对冲请求先返回时
+    立即返回，不必等待落后的调用。
+
+    样本不足 min_samples 时不对冲。对冲次数受预算限制：每次调用积累
+    max_ratio 次对冲额度（最多积累 max_ratio * window 次），额度用完时不再
+    对冲，避免后端整体变慢时请求量翻倍。只能用于幂等调用。percentile 为 0
+    表示不启用。
+    """
+
+    def __init__(self, percentile: float = 95, window: int = 200,
+                 min_samples: int = 20, min_delay: float = 0.02,
+                 max_ratio: float = 0.1):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = max(1, min_samples)
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self._samples: dict = {}  # 操作名 -> deque(耗时)
+        self._budget = 0.0  # 剩余的对冲额度
+        self._budget_cap = max(1.0, max_ratio * window)
+        self._lock = Lock()
+        self._runner = _AttemptRunner()
+
+        self.calls = 0  # 调用次数
+        self.hedged = 0  # 发出对冲请求的次数
+        self.wins = 0  # 对冲请求先返回的次数
+        self.discarded = 0  # 落后调用成功后被释放的结果数
+
+    @property
+    def enabled(self) -> bool:
+        return self.percentile > 0
+
+    def delay(self, name: str) -> Optional[float]:
+        """
+        操作 name 发出对冲请求前的等待时间（秒）
+
+        Returns:
+            float: 近期耗时的 percentile 分位，样本不足时返回 None
+        """
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1,
+                    int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def record(self, name: str, seconds: float) -> None:
+        """记录一次成功调用的耗时"""
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = deque(maxlen=self.window)
+                self._samples[name] = samples
+            samples.append(seconds)
+
+    def stats(self) -> dict:
+        """获取对冲统计信息"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "wins": self.wins,
+                "discarded": self.discarded
+            }
+
+    def call(self, name: str, func, discard=None, hedge_func=None):
+        """
+        执行一次可对冲的同步调用
+
+        Args:
+            name: 操作名，按操作分别统计耗时
+            func: 无参数的幂等调用
+            discard: 以落后调用的成功结果为参数、负责释放它的函数（可选）
+            hedge_func: 对冲请求使用的无参数调用（可选，默认与 func 相同）
+
+        Returns:
+            先成功返回的结果；全部失败时抛出最先失败的调用的异常
+        """
+        wait = self._begin(name)
+        if wait is None or not self._can_hedge():
+            return self._timed(name, func)
+
+        cond = Condition()
+        outcomes: list = []  # (序号, 是否成功, 结果或异常)
+        state = {"winner": None, "value": None}
+
+        def attempt(index: int):
+            try:
+                value, ok = self._timed(
+                    name, hedge_func if index and hedge_func else func), True
+            except Exception as e:
+                value, ok = e, False
+            with cond:
+                outcomes.append((index, ok, value))
+                late = ok and state["winner"] is not None
+                if ok and not late:
+                    state["winner"] = index
+                    state["value"] = value
+                cond.notify_all()
+            if late:
+                self._discard(name, discard, value)
+
+        def spawn(index: int):
+            self._runner.submit(lambda: attempt(index))
+
+        started = 1
+        with cond:
+            spawn(0)
+            cond.wait_for(lambda: outcomes, timeout=wait)
+            if not outcomes and self._admit():
+                spawn(1)
+                started = 2
+            cond.wait_for(lambda: state["winner"] is not None
+                          or len(outcomes) == started)
+            winner = state["winner"]
+            if winner is None:
+                raise outcomes[0][2]
+
+        if winner == 1:
+            with self._lock:
+                self.wins += 1
+        return state["value"]
+
+    async def call_async(self, name: str, func, discard=None,
+                         hedge_func=None):
+        """
+        执行一次可对冲的异步调用（参数同 call，func、hedge_func 与 discard
+        返回协程）
+        """
+        wait = self._begin(name)
+        if wait is None:
+            return await self._timed_async(name, func)
+
+        first = asyncio.ensure_future(self._timed_async(name, func))
+        done, _ = await asyncio.wait({first}, timeout=wait)
+        if done or not self._admit():
+            return await first
+
+        second = asyncio.ensure_future(
+            self._timed_async(name, hedge_func or func))
+        pending = {first, second}
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in (first, second)
+                           if task in done and task.exception() is None),
+                          None)
+        if winner is None:
+            errors = [first.exception(), second.exception()]
+            raise errors[0]
+
+        loser = second if winner is first else first
+        if discard is None and not loser.done():
+            loser.cancel()
+        else:
+            loser.add_done_callback(
+                lambda task: self._discard_async(name, discard, task))
+        if winner is second:
+            with self._lock:
+                self.wins += 1
+        return winner.result()
+
+    def _begin(self, name: str) -> Optional[float]:
+        """登记一次调用，返回对冲前的等待时间（不对冲时为 None）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.calls += 1
+            self._budget = min(self._budget_cap,
+                               self._budget + self.max_ratio)
+        return self.delay(name)
+
+    def _can_hedge(self) -> bool:
+        """当前额度是否足够发出一次对冲（不扣除额度）"""
+        with self._lock:
+            return self._budget >= 1
+
+    def _admit(self) -> bool:
+        """对冲额度足够时扣除一次额度并登记对冲"""
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            self.hedged += 1
+        return True
+
+    def _timed(self, name: str, func):
+        started = time.monotonic()
+        result = func()
+        if self.enabled:
+            self.record(name, time.monotonic() - started)
+        return result
+
+    async def _timed_async(self, name: str, func):
+        started = time.monotonic()
+        result = await func()
+        if self.enabled:
+            self.record(name, time.monotonic() - started)
+        return result
+
+    def _discard(self, name: str, discard, value) -> None:
+        with self._lock:
+            self.discarded += 1
+        if discard is None:
+            return
+        try:
+            discard(value)
+        except Exception as e:
+            logger.warning("释放落后的 %s 结果失败: %s", name, e)
+
+    def _discard_async(self, name: str, discard, task) -> None:
+        if task.cancelled() or task.exception() is not None:
+            return
+        with self._lock:
+            self.discarded += 1
+        if discard is None:
+            return
+
+        async def release():
+            try:
+                await discard(task.result())
+            except Exception as e:
+                logger.warning("释放落后的 %s 结果失败: %s", name, e)
+
+        asyncio.ensure_future(release())
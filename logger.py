@@ -0,0 +1,181 @@
+"""结构化日志模块：非阻塞队列输出、消息关联ID、消息内容脱敏/截断"""
+
+import os
+import sys
+import json
+import atexit
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+
+# 日志级别：DEBUG / INFO / WARNING / ERROR
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 输出格式：text（便于阅读）或 json（每行一个 JSON 对象，便于采集）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# 消息内容的记录方式：full（完整）、truncate（截断）或 redact（只记录长度）
+LOG_CONTENT = os.getenv("LOG_CONTENT", "truncate").lower()
+# truncate 模式下保留的最大字符数
+LOG_CONTENT_MAX = int(os.getenv("LOG_CONTENT_MAX", "200"))
+# 日志队列容量，写出跟不上时丢弃新日志而不阻塞业务线程
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 飞书 SDK（WebSocket 客户端）的日志级别
+LARK_LOG_LEVEL = os.getenv("LARK_LOG_LEVEL", "INFO").upper()
+
+# 当前处理消息的关联ID（线程与 asyncio 任务各自独立）
+_correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+_listener = None
+
+
+def get_correlation_id() -> str:
+    """获取当前上下文的关联ID"""
+    return _correlation_id.get()
+
+
+@contextmanager
+def correlation(correlation_id: str):
+    """在代码块内为日志附加关联ID（通常为飞书消息ID）"""
+    token = _correlation_id.set(correlation_id or "-")
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def content(text) -> str:
+    """
+    按 LOG_CONTENT 处理需要写入日志的用户消息或回复内容
+
+    Args:
+        text: 原始内容
+
+    Returns:
+        str: 完整、截断或脱敏后的内容
+    """
+    if text is None:
+        return ""
+    text = str(text)
+    if LOG_CONTENT == "full":
+        return text
+    if LOG_CONTENT == "redact":
+        return f"<{len(text)} chars>"
+    if len(text) > LOG_CONTENT_MAX:
+        return f"{text[:LOG_CONTENT_MAX]}...<{len(text)} chars>"
+    return text
+
+
+class _CorrelationFilter(logging.Filter):
+    """为日志记录附加关联ID"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """队列已满时丢弃日志并计数，不阻塞调用线程"""
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "cid": getattr(record, "correlation_id", "-"),
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _BlockingSentinelListener(QueueListener):
+    """停止时阻塞等待放入结束标记，避免队列已满时结束标记丢失"""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+def _parse_level(value: str, default: int = logging.INFO) -> int:
+    level = logging.getLevelName(value)
+    return level if isinstance(level, int) else default
+
+
+def lark_log_level():
+    """飞书 SDK 的日志级别（lark.LogLevel）"""
+    import lark_oapi as lark
+
+    try:
+        return lark.LogLevel[LARK_LOG_LEVEL]
+    except KeyError:
+        return lark.LogLevel.INFO
+
+
+def dropped_count() -> int:
+    """因队列已满被丢弃的日志条数"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _NonBlockingQueueHandler):
+            return handler.dropped
+    return 0
+
+
+def setup_logging() -> None:
+    """
+    配置根日志记录器：业务线程只把日志放入队列，由后台线程写到 stdout
+
+    重复调用不会重复配置。飞书 SDK 自带的 stdout 输出也改为经过该队列。
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(name)s] "
+            "[%(correlation_id)s] %(message)s"
+        )
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(_CorrelationFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(_parse_level(LOG_LEVEL))
+
+    lark_logger = logging.getLogger("Lark")
+    lark_logger.handlers = []
+    lark_logger.propagate = True
+
+    _listener = _BlockingSentinelListener(log_queue, stream_handler,
+                                          respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """写出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
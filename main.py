@@ -2,25 +2,339 @@
 
 import lark_oapi as lark
 from lark_oapi.api.im.v1 import *
+import asyncio
 import json
+import logging
 import os
+import signal
+import sys
 import threading
 import time
-from queue import Queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from dedup import EventDeduplicator
+from backpressure import (
+    AdmissionController,
+    QueuedMessage,
+    parse_shed_policy
+)
+from scheduler import FairScheduler, parse_weights
+from rate_limit import RateLimiter
+from coalesce import MessageCoalescer
+from retry import RetryScheduler
+from spool import IngressSpool
+import metrics
+from logger import (
+    setup_logging,
+    correlation,
+    lark_log_level,
+    dropped_count as log_dropped_count,
+    content as log_content
+)
 from handle import (
     ask_claude_sync,
+    ask_claude_stream,
+    ask_claude_async,
+    AsyncClaudeAgentClient,
+    create_async_client,
     get_session_id,
     save_session_mapping,
     get_client,
     init_session_store,
+    start_session_pool,
     get_session_count,
-    SESSION_STORE_DIR
+    flush_session_store,
+    SESSION_STORE_DIR,
+    SESSION_STORE_BACKEND
 )
 
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # 消息处理队列
 message_queue = Queue()
 
+# 工作线程数量：同一会话的消息逐条按顺序处理，不同会话并行处理
+MESSAGE_WORKER_COUNT = max(1, int(os.getenv("MESSAGE_WORKER_COUNT", "4")))
+
+# 异步处理模式：所有 Claude 调用在同一个事件循环线程中并发等待
+ASYNC_PIPELINE = os.getenv("ASYNC_PIPELINE", "false").lower() == "true"
+# 异步模式下同时进行的消息处理数上限
+ASYNC_MAX_INFLIGHT = max(1, int(os.getenv("ASYNC_MAX_INFLIGHT", "200")))
+
+# 流式回复：先发送占位消息，再随增量内容更新该消息
+STREAM_REPLY = os.getenv("STREAM_REPLY", "false").lower() == "true"
+# 流式回复时两次更新消息的最小间隔（秒），避免触发飞书频率限制
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", "1.5"))
+# 单条消息最多可编辑的次数（飞书限制），流式更新始终为最终回复保留一次
+STREAM_MAX_EDITS = max(1, int(os.getenv("STREAM_MAX_EDITS", "20")))
+# 每更新这么多次后更新间隔加倍，长回复也不会在生成结束前用完编辑次数
+STREAM_BACKOFF_EDITS = max(1, int(os.getenv("STREAM_BACKOFF_EDITS", "5")))
+STREAM_PLACEHOLDER = "🤔 Claude正在思考中，请稍候..."
+
+# 群聊"思考中"提示：reply（回复提示消息，完成后编辑为最终回复）、
+# reaction（在用户消息上添加表情回应，完成后移除）或 off（不提示）
+THINKING_INDICATOR = os.getenv("THINKING_INDICATOR", "reply").lower()
+# 回复超过该时间（秒）仍未完成时才显示提示，0 表示立即显示
+THINKING_INDICATOR_DELAY = float(os.getenv("THINKING_INDICATOR_DELAY", "0"))
+# reaction 模式使用的表情类型
+THINKING_REACTION_EMOJI = os.getenv("THINKING_REACTION_EMOJI", "Typing")
+THINKING_REPLY = "🤔 Claude正在思考中，请稍候..."
+
+# 事件去重：飞书在重连或响应慢时可能重复投递同一消息
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "3600"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+# 是否将去重记录持久化到 SESSION_STORE_DIR，重启后仍可识别重复投递
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "false").lower() == "true"
+
+event_deduplicator = EventDeduplicator(
+    ttl=DEDUP_TTL,
+    max_entries=DEDUP_MAX_ENTRIES,
+    persist_file=(os.path.join(SESSION_STORE_DIR, "dedup_events.log")
+                  if DEDUP_PERSIST else None)
+)
+
+# 入站消息暂存：已确认收到的消息写入磁盘，处理完成前崩溃或重新部署时，重启后恢复处理
+INGRESS_SPOOL = os.getenv("INGRESS_SPOOL", "false").lower() == "true"
+INGRESS_SPOOL_FILE = os.getenv(
+    "INGRESS_SPOOL_FILE",
+    os.path.join(SESSION_STORE_DIR, "ingress_spool.log")
+)
+# 两次 fsync 之间的最短间隔（毫秒），由后台线程批量执行，0 表示每批写入后 fsync
+INGRESS_SPOOL_FSYNC_INTERVAL_MS = int(
+    os.getenv("INGRESS_SPOOL_FSYNC_INTERVAL_MS", "200")
+)
+# 暂存文件记录数达到该值时只保留未处理完成的消息重写文件
+INGRESS_SPOOL_COMPACT_RECORDS = int(
+    os.getenv("INGRESS_SPOOL_COMPACT_RECORDS", "10000")
+)
+
+ingress_spool = IngressSpool(
+    INGRESS_SPOOL_FILE,
+    fsync_interval=INGRESS_SPOOL_FSYNC_INTERVAL_MS / 1000,
+    compact_records=INGRESS_SPOOL_COMPACT_RECORDS
+) if INGRESS_SPOOL else None
+
+# 队列过载保护：排队消息总数上限与单个会话上限（0 表示不限制）
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "200"))
+MESSAGE_QUEUE_PER_CHAT_MAX = int(os.getenv("MESSAGE_QUEUE_PER_CHAT_MAX", "20"))
+# 过载策略：reject（拒绝新消息）或 drop_oldest（丢弃最早排队的消息）
+MESSAGE_SHED_POLICY = parse_shed_policy(
+    os.getenv("MESSAGE_SHED_POLICY", "reject")
+)
+BUSY_REPLY = "🚦 当前请求较多，请稍后再试"
+
+admission = AdmissionController(
+    max_depth=MESSAGE_QUEUE_MAX,
+    max_per_chat=MESSAGE_QUEUE_PER_CHAT_MAX,
+    policy=MESSAGE_SHED_POLICY
+)
+
+# 调度优先级：白名单会话最优先，其次私聊（可关闭），最后群聊
+MESSAGE_PRIORITY_CHATS = {
+    chat_id.strip()
+    for chat_id in os.getenv("MESSAGE_PRIORITY_CHATS", "").split(",")
+    if chat_id.strip()
+}
+MESSAGE_PRIORITY_P2P_FIRST = (
+    os.getenv("MESSAGE_PRIORITY_P2P_FIRST", "true").lower() == "true"
+)
+# 公平调度的份额键：user（按发送者）或 chat（按会话）
+FAIR_SHARE_KEY = os.getenv("FAIR_SHARE_KEY", "user").lower()
+# 份额权重，例如 "ou_xxx:3,oc_yyy:2"，未配置的键权重为 1
+FAIR_SHARE_WEIGHTS = parse_weights(os.getenv("FAIR_SHARE_WEIGHTS", ""))
+
+scheduler = FairScheduler(weights=FAIR_SHARE_WEIGHTS)
+
+# 调用频率限制（令牌桶）：每分钟可调用次数与突发上限（0 表示不限制，默认不限制）
+RATE_LIMIT_USER_PER_MINUTE = float(
+    os.getenv("RATE_LIMIT_USER_PER_MINUTE", "0"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+RATE_LIMIT_CHAT_PER_MINUTE = float(
+    os.getenv("RATE_LIMIT_CHAT_PER_MINUTE", "0"))
+RATE_LIMIT_CHAT_BURST = float(os.getenv("RATE_LIMIT_CHAT_BURST", "10"))
+RATE_LIMIT_REPLY = "⏳ 消息发送过于频繁，请约 {seconds} 秒后再试"
+
+rate_limiter = RateLimiter(
+    user_per_minute=RATE_LIMIT_USER_PER_MINUTE,
+    user_burst=RATE_LIMIT_USER_BURST,
+    chat_per_minute=RATE_LIMIT_CHAT_PER_MINUTE,
+    chat_burst=RATE_LIMIT_CHAT_BURST
+)
+
+# 消息合并：同一对话中同一用户在窗口内连续发送的消息合并为一次 Claude 调用
+# 窗口（毫秒）从最后一条消息起算，0 表示不合并
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "0"))
+# 从第一条消息起最长等待时间（毫秒），避免持续发送时一直不处理
+COALESCE_MAX_WAIT_MS = int(os.getenv("COALESCE_MAX_WAIT_MS", "5000"))
+# 单次最多合并的消息数，达到后立即处理
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+
+coalescer = MessageCoalescer(
+    window=COALESCE_WINDOW_MS / 1000,
+    on_flush=lambda items: enqueue_coalesced(items),
+    max_wait=COALESCE_MAX_WAIT_MS / 1000,
+    max_messages=COALESCE_MAX_MESSAGES
+)
+
+# 回复发送失败后的后台重试：最多尝试次数（含首次）、退避基准与上限（秒）
+SEND_RETRY_MAX_ATTEMPTS = max(
+    1, int(os.getenv("SEND_RETRY_MAX_ATTEMPTS", "3")))
+SEND_RETRY_BASE_DELAY = float(os.getenv("SEND_RETRY_BASE_DELAY", "1"))
+SEND_RETRY_MAX_DELAY = float(os.getenv("SEND_RETRY_MAX_DELAY", "30"))
+SEND_RETRY_WORKERS = max(1, int(os.getenv("SEND_RETRY_WORKERS", "2")))
+# 最终发送失败的回复写入该文件（每行一个 JSON），为空表示只记录日志
+SEND_DEAD_LETTER_FILE = os.getenv(
+    "SEND_DEAD_LETTER_FILE",
+    os.path.join(SESSION_STORE_DIR, "reply_dead_letter.log")
+)
+
+reply_retry = RetryScheduler(
+    base_delay=SEND_RETRY_BASE_DELAY,
+    max_delay=SEND_RETRY_MAX_DELAY,
+    workers=SEND_RETRY_WORKERS
+)
+_dead_letter_lock = threading.Lock()
+
+# 指标服务：以 Prometheus 文本格式提供 /metrics（端口为 0 表示不启动）
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "lark_queue_wait_seconds",
+    "Time messages spend queued before processing starts")
+CLAUDE_SECONDS = metrics.histogram(
+    "lark_claude_request_seconds",
+    "Latency of Claude agent calls in seconds", ("mode",))
+MESSAGE_SECONDS = metrics.histogram(
+    "lark_message_process_seconds",
+    "Time to process a message after it leaves the queue")
+SEND_RESPONSE_SECONDS = metrics.histogram(
+    "lark_send_response_seconds",
+    "Latency of sending a Lark reply, including retries", ("outcome",))
+SEND_RESPONSE_RETRIES = metrics.counter(
+    "lark_send_response_retries_total",
+    "Lark reply attempts that were retried")
+ERRORS = metrics.counter(
+    "lark_errors_total", "Errors by processing stage", ("stage",))
+SEND_DEAD_LETTERS = metrics.counter(
+    "lark_send_dead_letter_total",
+    "Replies that still failed after all background retries")
+THINKING_INDICATORS = metrics.counter(
+    "lark_thinking_indicator_total",
+    "Thinking indicators by outcome (sent, or skipped because the answer "
+    "arrived first)", ("outcome",))
+metrics.gauge("lark_queue_depth", "Messages admitted but not yet started",
+              callback=admission.depth)
+metrics.gauge("lark_scheduler_queued", "Messages waiting in the scheduler",
+              callback=scheduler.qsize)
+metrics.gauge("lark_dedup_cache_entries", "Keys held in the dedup cache",
+              callback=event_deduplicator.size)
+metrics.callback_counter(
+    "lark_dedup_duplicates_total", "Redelivered events that were dropped",
+    callback=lambda: event_deduplicator.hits)
+metrics.callback_counter(
+    "lark_admission_total", "Admission decisions by outcome",
+    callback=lambda: {
+        (outcome,): admission.stats()[outcome]
+        for outcome in ("admitted", "rejected", "dropped")
+    }, labels=("outcome",))
+metrics.callback_counter(
+    "lark_log_dropped_total", "Log records dropped because the queue was full",
+    callback=log_dropped_count)
+metrics.gauge("lark_ingress_spool_pending",
+              "Received messages in the ingress spool not yet completed",
+              callback=lambda: ingress_spool.pending() if ingress_spool else 0)
+metrics.gauge("lark_send_retry_pending",
+              "Failed replies waiting for a background retry",
+              callback=reply_retry.pending)
+metrics.gauge("lark_coalesce_pending",
+              "Messages held in the coalescing window",
+              callback=coalescer.pending)
+metrics.callback_counter(
+    "lark_coalesced_messages_total",
+    "Messages merged into another message's Claude call",
+    callback=lambda: coalescer.merged)
+metrics.callback_counter(
+    "lark_rate_limited_total", "Messages throttled by the rate limiter",
+    callback=lambda: {
+        (scope,): rate_limiter.stats()[f"throttled_{scope}"]
+        for scope in ("user", "chat")
+    }, labels=("scope",))
+
+
+def get_conversation_key(data: P2ImMessageReceiveV1) -> str:
+    """
+    计算消息所属的对话键，同一对话内的消息按顺序逐条处理
+
+    回复消息使用 root_id（整个回复链），其次 parent_id；不是回复的消息
+    会开启一个新会话，使用自身的 message_id，与之后回复它的消息落在同一
+    对话键上。因此话题的根消息调用 Claude、保存会话映射之前，话题内的
+    回复不会开始处理；同一会话中彼此独立的新消息则并行处理。
+
+    Args:
+        data: 飞书消息事件
+
+    Returns:
+        str: 对话键
+    """
+    msg = data.event.message
+    root_id = msg.root_id if hasattr(msg, 'root_id') else None
+    if root_id:
+        return root_id
+
+    parent_id = msg.parent_id if hasattr(msg, 'parent_id') else None
+    if parent_id:
+        return parent_id
+
+    return msg.message_id
+
+
+def get_sender_id(data: P2ImMessageReceiveV1) -> str:
+    """获取发送者ID（优先使用 open_id，其次 union_id，最后使用 unknown）"""
+    sender_id = data.event.sender.sender_id
+    if hasattr(sender_id, 'open_id') and sender_id.open_id:
+        return sender_id.open_id
+    if hasattr(sender_id, 'union_id') and sender_id.union_id:
+        return sender_id.union_id
+    if hasattr(sender_id, 'user_id') and sender_id.user_id:
+        return sender_id.user_id
+    return "unknown"
+
+
+def get_message_priority(data: P2ImMessageReceiveV1) -> int:
+    """
+    计算消息的调度优先级（数值越小越优先）
+
+    Returns:
+        int: 0 白名单会话，1 私聊，2 群聊
+    """
+    msg = data.event.message
+    if msg.chat_id in MESSAGE_PRIORITY_CHATS:
+        return 0
+    if MESSAGE_PRIORITY_P2P_FIRST and msg.chat_type == "p2p":
+        return 1
+    return 2
+
+
+def get_share_key(data: P2ImMessageReceiveV1) -> str:
+    """获取公平调度的份额键"""
+    if FAIR_SHARE_KEY == "chat":
+        return data.event.message.chat_id or get_sender_id(data)
+    return get_sender_id(data)
+
+
+def get_coalesce_key(data: P2ImMessageReceiveV1) -> str:
+    """
+    获取消息合并键：同一回复链（不是回复的消息按会话）中同一发送者的
+    消息可以合并
+    """
+    msg = data.event.message
+    thread_key = (getattr(msg, 'root_id', None)
+                  or getattr(msg, 'parent_id', None) or msg.chat_id)
+    return f"{thread_key}:{get_sender_id(data)}"
+
 
 def do_p2_im_message_receive_v1(data: P2ImMessageReceiveV1) -> None:
     """立即响应飞书，将消息放入处理队列"""
@@ -28,40 +342,208 @@ def do_p2_im_message_receive_v1(data: P2ImMessageReceiveV1) -> None:
         # 基本消息类型检查
         if data.event.message.message_type != "text":
             msg_id = data.event.message.message_id
-            print(f"消息 {msg_id} 不是文本消息，跳过")
+            logger.debug("消息 %s 不是文本消息，跳过", msg_id)
             return
 
-        # 立即将消息放入队列，不阻塞响应
-        message_queue.put(data)
+        # 丢弃重复投递的事件，避免重复调用 Claude 和重复回复
         msg_id = data.event.message.message_id
-        queue_size = message_queue.qsize()
-        print(f"消息 {msg_id} 已加入处理队列，队列长度: {queue_size}")
+        header = data.header if hasattr(data, 'header') else None
+        event_id = header.event_id if header else None
+        if event_deduplicator.check_and_add(msg_id, event_id):
+            logger.info("消息 %s 重复投递，已忽略 (累计 %d 次)",
+                        msg_id, event_deduplicator.hits)
+            return
+
+        admit_message(data)
 
         # 函数立即返回，飞书收到200响应，避免重复发送
 
     except Exception as e:
-        print(f"消息队列入队失败: {str(e)}")
+        ERRORS.inc(stage="enqueue")
+        logger.exception("消息队列入队失败: %s", e)
 
 
-def process_single_message(data: P2ImMessageReceiveV1) -> None:
-    """实际的消息处理逻辑"""
-    message_id = data.event.message.message_id
+def admit_message(data: P2ImMessageReceiveV1, replayed: bool = False) -> None:
+    """
+    过载保护后写入暂存文件，再放入合并窗口或处理队列
+
+    Args:
+        data: 飞书消息事件
+        replayed: 是否为从暂存文件恢复的消息（已在暂存文件中）
+    """
+    msg_id = data.event.message.message_id
+    chat_id = data.event.message.chat_id
+
+    # 限流：用户或会话超出调用频率时礼貌提示，消息不进入队列；
+    # 群聊中未@本机器人的消息不会调用 Claude，不占用额度。合并窗口内的
+    # 消息只调用一次 Claude，按批次计费：只有开启新窗口的消息占用额度，
+    # 并入已有窗口的消息不再扣减（检查后窗口恰好结束时少计一次）
+    coalesce_key = get_coalesce_key(data) if COALESCE_WINDOW_MS > 0 else None
+    if (not replayed
+            and (data.event.message.chat_type != "group"
+                 or mentions_bot(data))
+            and not (coalesce_key and coalescer.is_open(coalesce_key))):
+        user_id = get_sender_id(data)
+        allowed, retry_after = rate_limiter.acquire(user_id, chat_id)
+        if not allowed:
+            stats = rate_limiter.stats()
+            logger.warning("消息 %s 触发限流 (用户: %s, 约 %.0f 秒后恢复，"
+                           "累计 用户 %d 次 / 会话 %d 次)",
+                           msg_id, user_id, retry_after,
+                           stats['throttled_user'], stats['throttled_chat'])
+            reply_in_background(data, RATE_LIMIT_REPLY.format(
+                seconds=max(1, int(retry_after + 0.999))))
+            return
+
+    # 过载保护：超出队列上限时拒绝新消息或丢弃最早排队的消息
+    item, dropped = admission.admit(data, chat_id)
+    for dropped_item in dropped:
+        dropped_id = dropped_item.data.event.message.message_id
+        logger.warning("队列已满，丢弃排队中的消息 %s", dropped_id)
+        complete_spooled([dropped_item])
+        reply_busy(dropped_item.data)
+    if item is None:
+        logger.warning("队列已满，拒绝消息 %s", msg_id)
+        if replayed and ingress_spool is not None:
+            ingress_spool.done(msg_id)
+        reply_busy(data)
+        return
+
+    # 暂存后再入队：只排队写入，由后台线程落盘，不阻塞事件回调
+    if ingress_spool is not None and not replayed:
+        ingress_spool.add(msg_id, encode_spooled_event(data))
+
+    # 消息合并：暂存到合并窗口，窗口结束后与同一用户的后续消息一起入队
+    if COALESCE_WINDOW_MS > 0:
+        coalescer.add(coalesce_key, item)
+        logger.debug("消息 %s 已加入合并窗口", msg_id)
+        return
+
+    # 立即将消息放入队列，不阻塞响应
+    message_queue.put(item)
+    logger.debug("消息 %s 已加入处理队列，队列长度: %d",
+                 msg_id, admission.depth())
+
+
+def encode_spooled_event(data: P2ImMessageReceiveV1) -> dict:
+    """提取处理消息所需的字段，写入暂存文件"""
     msg = data.event.message
-    parent_id = msg.parent_id if hasattr(msg, 'parent_id') else None
-    root_id = msg.root_id if hasattr(msg, 'root_id') else None
+    sender_id = data.event.sender.sender_id
+    header = data.header if hasattr(data, 'header') else None
+    mentions = (msg.mentions if hasattr(msg, 'mentions') else None) or []
+    return {
+        "event_id": header.event_id if header else None,
+        "message_id": msg.message_id,
+        "root_id": msg.root_id if hasattr(msg, 'root_id') else None,
+        "parent_id": msg.parent_id if hasattr(msg, 'parent_id') else None,
+        "chat_id": msg.chat_id,
+        "chat_type": msg.chat_type,
+        "message_type": msg.message_type,
+        "content": msg.content,
+        # 只保留判断是否@本机器人与移除@标记所需的字段
+        "mentions": [{
+            "key": mention.key if hasattr(mention, 'key') else None,
+            "app_id": getattr(getattr(mention, 'id', None), 'app_id', None)
+        } for mention in mentions],
+        "sender": {
+            field: getattr(sender_id, field, None)
+            for field in ("open_id", "union_id", "user_id")
+        }
+    }
+
+
+def decode_spooled_event(record: dict) -> P2ImMessageReceiveV1:
+    """由暂存记录还原飞书消息事件"""
+    message = {
+        field: record.get(field)
+        for field in ("message_id", "root_id", "parent_id", "chat_id",
+                      "chat_type", "message_type", "content")
+    }
+    message["mentions"] = [{"key": mention["key"], "id": {}}
+                           for mention in record.get("mentions") or []]
+    data = P2ImMessageReceiveV1({
+        "header": {"event_id": record.get("event_id")},
+        "event": {
+            "sender": {"sender_id": record.get("sender") or {}},
+            "message": message
+        }
+    })
+    # 飞书的 UserId 模型不含 app_id，还原后单独设置
+    for mention, spooled in zip(data.event.message.mentions or [],
+                                record.get("mentions") or []):
+        mention.id.app_id = spooled.get("app_id")
+    return data
+
+
+def complete_spooled(items: list) -> None:
+    """消息处理完成（或被丢弃）后从暂存文件中移除"""
+    if ingress_spool is None:
+        return
+    for item in items:
+        for queued in item.merged + [item]:
+            ingress_spool.done(queued.data.event.message.message_id)
 
-    print(f"开始处理消息: {message_id}")
-    print(f"  - parent_id: {parent_id}")
-    print(f"  - root_id: {root_id}")
 
+def replay_spooled_messages() -> int:
+    """
+    重新处理上次运行时已收到但未处理完成的消息（启动时、开始接收事件前调用）
+
+    Returns:
+        int: 恢复的消息数
+    """
+    if ingress_spool is None:
+        return 0
+
+    replayed = 0
+    for record in ingress_spool.open():
+        try:
+            data = decode_spooled_event(record)
+        except Exception as e:
+            logger.warning("暂存的消息 %s 无法还原，已跳过: %s",
+                           record.get("message_id"), e)
+            ingress_spool.done(record.get("message_id"))
+            continue
+
+        # 确保飞书重新投递同一消息时被去重
+        event_deduplicator.check_and_add(data.event.message.message_id,
+                                         data.header.event_id)
+        admit_message(data, replayed=True)
+        replayed += 1
+    return replayed
+
+
+def mentions_bot(data: P2ImMessageReceiveV1) -> bool:
+    """消息是否@了本机器人"""
+    mentions = (data.event.message.mentions
+                if hasattr(data.event.message, 'mentions') else None)
+    for mention in mentions or []:
+        # mention.id 包含机器人的 ID
+        if hasattr(mention, 'id') and mention.id:
+            mention_id = (mention.id.app_id
+                          if hasattr(mention.id, 'app_id') else None)
+            if mention_id == lark.APP_ID:
+                return True
+    return False
+
+
+def parse_user_message(data: P2ImMessageReceiveV1):
+    """
+    解析消息文本：群聊只处理@了本机器人的消息，并移除@标记
+
+    Args:
+        data: 飞书消息事件
+
+    Returns:
+        str: 用户消息文本，无需处理的消息返回 None
+    """
     # 解析消息
     if data.event.message.message_type == "text":
         user_message = json.loads(data.event.message.content)["text"]
     else:
         send_response(data, "请发送文本消息")
-        return
+        return None
 
-    print(f"收到消息内容: {user_message}")
+    logger.debug("收到消息内容: %s", log_content(user_message))
 
     # 判断是否为群聊消息
     chat_type = data.event.message.chat_type
@@ -72,27 +554,11 @@ def process_single_message(data: P2ImMessageReceiveV1) -> None:
         mentions = (data.event.message.mentions
                     if hasattr(data.event.message, 'mentions') else None)
 
-        if not mentions:
-            print("群聊消息未@机器人，忽略")
-            return
-
-        # 检查是否@了当前机器人
-        bot_mentioned = False
-        for mention in mentions:
-            # mention.id 包含机器人的 ID
-            if hasattr(mention, 'id') and mention.id:
-                # 获取机器人自己的 ID
-                mention_id = (mention.id.app_id
-                              if hasattr(mention.id, 'app_id') else None)
-                if mention_id == lark.APP_ID:
-                    bot_mentioned = True
-                    break
-
-        if not bot_mentioned:
-            print("群聊消息未@本机器人，忽略")
-            return
+        if not mentions_bot(data):
+            logger.debug("群聊消息未@本机器人，忽略")
+            return None
 
-        print("检测到@机器人，开始处理...")
+        logger.debug("检测到@机器人，开始处理...")
 
         # 移除消息中的@标记，只保留实际问题内容
         if mentions:
@@ -106,19 +572,54 @@ def process_single_message(data: P2ImMessageReceiveV1) -> None:
 
     # 私聊消息直接处理（保持原有逻辑）
     elif chat_type == "p2p":
-        print("私聊消息，直接处理")
+        logger.debug("私聊消息，直接处理")
+
+    return user_message
+
+
+def prepare_message(data: P2ImMessageReceiveV1, merged: list = None):
+    """
+    解析消息并关联历史会话
+
+    Args:
+        data: 飞书消息事件
+        merged: 合并窗口内同一用户更早发送的消息事件（按到达顺序），
+                其文本按顺序拼接在本条消息之前，只调用一次 Claude
+
+    Returns:
+        dict: 消息上下文（message_id、root_id、chat_type、user_message、
+              user_id、session_id、merged_message_ids 等），
+              无需处理的消息返回 None
+    """
+    parsed = []
+    for event in (merged or []) + [data]:
+        text = parse_user_message(event)
+        if text is not None:
+            parsed.append((event, text))
+    if not parsed:
+        return None
+
+    # 以最后一条需要处理的消息作为回复对象
+    data, user_message = parsed[-1]
+    merged_message_ids = [event.event.message.message_id
+                          for event, _ in parsed[:-1]]
+
+    message_id = data.event.message.message_id
+    msg = data.event.message
+    parent_id = msg.parent_id if hasattr(msg, 'parent_id') else None
+    root_id = msg.root_id if hasattr(msg, 'root_id') else None
+    chat_type = msg.chat_type
+
+    logger.info("开始处理消息 (parent_id: %s, root_id: %s)",
+                parent_id, root_id)
+
+    if merged_message_ids:
+        user_message = "\n".join(text for _, text in parsed if text)
+        logger.info("合并 %d 条连续消息为一次调用 (更早的消息: %s)",
+                    len(parsed), ", ".join(merged_message_ids))
 
     # 获取用户ID（优先使用 open_id，其次 union_id，最后使用 unknown）
-    sender_id = data.event.sender.sender_id
-    user_id = None
-    if hasattr(sender_id, 'open_id') and sender_id.open_id:
-        user_id = sender_id.open_id
-    elif hasattr(sender_id, 'union_id') and sender_id.union_id:
-        user_id = sender_id.union_id
-    elif hasattr(sender_id, 'user_id') and sender_id.user_id:
-        user_id = sender_id.user_id
-    else:
-        user_id = "unknown"
+    user_id = get_sender_id(data)
 
     # 获取或关联会话
     # 优先使用 root_id（整个回复链的根消息），其次使用 parent_id
@@ -127,159 +628,698 @@ def process_single_message(data: P2ImMessageReceiveV1) -> None:
     if root_id:
         session_id = get_session_id(root_id)
         if session_id:
-            print(f"使用 root_id 关联的会话: {session_id}")
+            logger.debug("使用 root_id 关联的会话: %s", session_id)
 
     if not session_id and parent_id:
         session_id = get_session_id(parent_id)
         if session_id:
-            print(f"使用 parent_id 关联的会话: {session_id}")
+            logger.debug("使用 parent_id 关联的会话: %s", session_id)
 
     if session_id:
-        print(f"找到历史会话: {session_id}")
-        # 将当前消息也关联到这个会话（作为普通消息）
-        save_session_mapping(message_id, session_id, is_root=False)
+        logger.info("找到历史会话: %s", session_id)
+        # 将当前消息（及合并的消息）也关联到这个会话（作为普通消息）
+        for linked_id in merged_message_ids + [message_id]:
+            save_session_mapping(linked_id, session_id, is_root=False)
+    else:
+        logger.info("未找到历史会话，将创建新会话")
+
+    return {
+        'data': data,
+        'message_id': message_id,
+        'parent_id': parent_id,
+        'root_id': root_id,
+        'chat_type': chat_type,
+        'user_message': user_message,
+        'user_id': user_id,
+        'session_id': session_id,
+        'merged_message_ids': merged_message_ids
+    }
+
+
+def start_reply(ctx: dict):
+    """
+    调用 Claude 前的提示：流式模式发送占位消息，群聊在后台发送思考中提示
+
+    Returns:
+        str: 流式模式下的占位消息ID，其他情况返回 None
+    """
+    data = ctx['data']
+
+    if STREAM_REPLY:
+        # 流式模式：立即发送占位消息，后续更新为实际回复
+        # 占位消息不重试，失败时直接在完成后发送最终回复
+        return send_response(data, STREAM_PLACEHOLDER, max_retries=1)
+
+    # 群聊的"思考中"提示在后台发送，不推迟 Claude 调用
+    if ctx['chat_type'] == "group" and THINKING_INDICATOR in ("reply",
+                                                              "reaction"):
+        indicator = ThinkingIndicator(data, THINKING_INDICATOR,
+                                      THINKING_INDICATOR_DELAY)
+        indicator.start()
+        ctx['indicator'] = indicator
+
+    return None
+
+
+def handle_claude_result(ctx: dict, result: dict) -> str:
+    """
+    处理 Claude 调用结果并保存会话映射
+
+    Returns:
+        str: 需要回复给用户的文本
+    """
+    if result['error']:
+        ERRORS.inc(stage="claude")
+        logger.error("Claude 调用出错: %s", result['error'])
+        return f"抱歉，AI 处理出现错误：{result['error']}"
+
+    claude_response = result['content']
+    logger.debug("Claude 回复: %s", log_content(claude_response))
+
+    # 保存会话映射
+    if result['session_id']:
+        root_id = ctx['root_id']
+        message_id = ctx['message_id']
+
+        # 如果有 root_id，先更新 root_id 的会话映射
+        if root_id:
+            # root_id 是对话的根消息
+            save_session_mapping(root_id, result['session_id'],
+                                 is_root=True)
+
+        # 将当前消息ID（及合并的消息ID）与会话ID关联（作为最近消息）
+        for linked_id in ctx['merged_message_ids'] + [message_id]:
+            if linked_id != root_id:
+                save_session_mapping(linked_id, result['session_id'],
+                                     is_root=False)
+
+        logger.debug("会话映射已保存，session_id: %s", result['session_id'])
+
+    return claude_response
+
+
+def finish_reply(ctx: dict, claude_response: str, reply_message_id: str,
+                 result: dict) -> None:
+    """发送最终回复，并保存机器人回复消息的会话映射"""
+    data = ctx['data']
+
+    # 思考中提示已发出时将其编辑为最终回复，尚未发出时取消
+    indicator = ctx.get('indicator')
+    if indicator is not None:
+        reply_message_id = indicator.finish()
+
+    def save_reply_mapping(reply_id: str) -> None:
+        # 保存机器人回复消息的会话映射（用户可能会直接回复机器人的消息）
+        if result.get('session_id'):
+            save_session_mapping(reply_id, result['session_id'],
+                                 is_root=False)
+            logger.debug("机器人回复消息ID %s 的会话映射已保存", reply_id)
+
+    # 发送回复（使用引用回复）；已有占位消息时将其更新为最终内容。
+    # 发送失败时在后台重试，成功后再保存映射
+    if reply_message_id:
+        if not update_response(reply_message_id, claude_response):
+            reply_message_id = send_response(data, claude_response,
+                                             on_sent=save_reply_mapping)
     else:
-        print("未找到历史会话，将创建新会话")
+        reply_message_id = send_response(data, claude_response,
+                                         on_sent=save_reply_mapping)
+
+    if reply_message_id:
+        save_reply_mapping(reply_message_id)
+
+    logger.info("消息处理完成")
 
-    # 先发送一个"思考中"的提示（可选）
+
+def process_single_message(data: P2ImMessageReceiveV1,
+                           merged: list = None) -> None:
+    """实际的消息处理逻辑（merged 为合并到本条消息的更早消息）"""
+    ctx = prepare_message(data, merged)
+    if ctx is None:
+        return
+
+    result = {'session_id': None}
+    reply_message_id = start_reply(ctx)
+
+    # 调用 Claude Agent HTTP 获取回复
     try:
-        if chat_type == "group":
-            typing_msg = "🤔 Claude正在思考中，请稍候..."
-            send_typing_indicator(data, typing_msg)
+        logger.info("正在调用 Claude Agent HTTP (用户: %s)", ctx['user_id'])
+        if STREAM_REPLY and reply_message_id:
+            with CLAUDE_SECONDS.time(mode="stream"):
+                result = ask_claude_stream(
+                    user_prompt=ctx['user_message'],
+                    user_id=ctx['user_id'],
+                    session_id=ctx['session_id'],
+                    on_chunk=make_stream_updater(reply_message_id)
+                )
+        else:
+            with CLAUDE_SECONDS.time(mode="sync"):
+                result = ask_claude_sync(
+                    user_prompt=ctx['user_message'],
+                    user_id=ctx['user_id'],
+                    session_id=ctx['session_id']
+                )
+
+        claude_response = handle_claude_result(ctx, result)
+
     except Exception as e:
-        print(f"发送思考提示失败: {str(e)}")
+        ERRORS.inc(stage="claude")
+        logger.exception("Claude 调用失败: %s", e)
+        claude_response = f"抱歉，AI 处理出现异常：{str(e)}"
+
+    finish_reply(ctx, claude_response, reply_message_id, result)
+
+
+async def process_single_message_async(
+        data: P2ImMessageReceiveV1,
+        agent_client: AsyncClaudeAgentClient,
+        merged: list = None) -> None:
+    """异步消息处理逻辑：Claude 调用在事件循环中等待，飞书 API 调用放到线程池"""
+    ctx = await asyncio.to_thread(prepare_message, data, merged)
+    if ctx is None:
+        return
+
+    result = {'session_id': None}
+    reply_message_id = await asyncio.to_thread(start_reply, ctx)
 
     # 调用 Claude Agent HTTP 获取回复
     try:
-        print(f"正在调用 Claude Agent HTTP (用户: {user_id})...")
-        result = ask_claude_sync(
-            user_prompt=user_message,
-            user_id=user_id,
-            session_id=session_id
-        )
+        logger.info("正在调用 Claude Agent HTTP (用户: %s)", ctx['user_id'])
+        stream = bool(STREAM_REPLY and reply_message_id)
+        with CLAUDE_SECONDS.time(mode="async"):
+            result = await ask_claude_async(
+                agent_client,
+                user_prompt=ctx['user_message'],
+                user_id=ctx['user_id'],
+                session_id=ctx['session_id'],
+                stream=stream,
+                on_chunk=(make_stream_updater(reply_message_id,
+                                              in_thread=True)
+                          if stream else None)
+            )
 
-        if result['error']:
-            print(f"Claude 调用出错: {result['error']}")
-            claude_response = f"抱歉，AI 处理出现错误：{result['error']}"
-        else:
-            claude_response = result['content']
-            preview = claude_response[:100]
-            print(f"Claude 回复: {preview}...")
-
-            # 保存会话映射
-            if result['session_id']:
-                # 如果有 root_id，先更新 root_id 的会话映射
-                if root_id:
-                    # root_id 是对话的根消息
-                    save_session_mapping(root_id, result['session_id'],
-                                         is_root=True)
-
-                # 将当前消息ID与会话ID关联（作为最近消息）
-                if message_id != root_id:
-                    save_session_mapping(message_id, result['session_id'],
-                                         is_root=False)
-
-                sess_id = result['session_id']
-                print(f"会话映射已保存，session_id: {sess_id}")
+        claude_response = await asyncio.to_thread(
+            handle_claude_result, ctx, result)
 
     except Exception as e:
-        print(f"Claude 调用失败: {str(e)}")
+        ERRORS.inc(stage="claude")
+        logger.exception("Claude 调用失败: %s", e)
         claude_response = f"抱歉，AI 处理出现异常：{str(e)}"
 
-    # 发送回复（使用引用回复）
-    reply_message_id = send_response(data, claude_response)
+    await asyncio.to_thread(finish_reply, ctx, claude_response,
+                            reply_message_id, result)
+
+
+class ThinkingIndicator:
+    """
+    群聊"思考中"提示
+
+    由定时器线程在 delay 秒后发送，与 Claude 调用并行，不占用处理线程；
+    回复在此之前完成时不再发送。reply 模式发送一条提示消息，由
+    finish_reply 编辑为最终回复；reaction 模式在用户消息上添加表情回应，
+    完成后在后台移除。
+    """
+
+    def __init__(self, data: P2ImMessageReceiveV1, mode: str,
+                 delay: float = 0):
+        self.data = data
+        self.mode = mode
+        self.message_id = None  # reply 模式下发出的提示消息ID
+        self.reaction_id = None  # reaction 模式下添加的表情回应ID
+        self._state = "pending"  # pending / sending / cancelled
+        self._lock = threading.Lock()
+        self._sent = threading.Event()
+        self._timer = threading.Timer(max(0.0, delay), self._send)
+        self._timer.daemon = True
+
+    def start(self) -> None:
+        self._timer.start()
+
+    def finish(self, timeout: float = 5) -> str:
+        """
+        结束提示：尚未发送时取消，正在发送时最多等待 timeout 秒
+
+        Returns:
+            str: reply 模式下已发出的提示消息ID，其他情况返回 None
+        """
+        with self._lock:
+            if self._state == "pending":
+                self._state = "cancelled"
+                self._timer.cancel()
+                THINKING_INDICATORS.inc(outcome="skipped")
+                return None
+
+        if not self._sent.wait(timeout):
+            logger.warning("思考中提示发送超时，直接发送回复")
+            return None
+
+        if self.reaction_id:
+            threading.Thread(
+                target=remove_reaction,
+                args=(self.data.event.message.message_id, self.reaction_id),
+                daemon=True
+            ).start()
+        return self.message_id
+
+    def _send(self) -> None:
+        with self._lock:
+            if self._state != "pending":
+                return
+            self._state = "sending"
+
+        try:
+            if self.mode == "reaction":
+                self.reaction_id = add_reaction(
+                    self.data.event.message.message_id,
+                    THINKING_REACTION_EMOJI)
+            else:
+                # 提示只尝试一次，失败时不影响最终回复
+                self.message_id = send_response(self.data, THINKING_REPLY,
+                                                max_retries=1)
+            THINKING_INDICATORS.inc(outcome="sent")
+        except Exception as e:
+            logger.warning("发送思考提示失败: %s", e)
+        finally:
+            self._sent.set()
+
+
+def make_stream_updater(reply_message_id: str, in_thread: bool = False):
+    """
+    创建流式回复的节流更新回调
+
+    Args:
+        reply_message_id: 占位回复消息ID
+        in_thread: 为 True 时（异步流程）节流判断在调用方线程进行，只有真正
+                   需要更新消息时才返回在线程池中执行更新的 awaitable
+
+    Returns:
+        callable: 接收累计文本的回调，按 STREAM_UPDATE_INTERVAL 节流更新消息；
+                  每更新 STREAM_BACKOFF_EDITS 次间隔加倍，最多更新
+                  STREAM_MAX_EDITS - 1 次，保留一次编辑用于最终回复
+    """
+    state = {'last_update': time.monotonic(), 'last_text': '', 'edits': 0}
+
+    def on_chunk(text: str):
+        if state['edits'] >= STREAM_MAX_EDITS - 1:
+            return None
+        now = time.monotonic()
+        interval = STREAM_UPDATE_INTERVAL * 2 ** (
+            state['edits'] // STREAM_BACKOFF_EDITS)
+        if now - state['last_update'] < interval:
+            return None
+        if text == state['last_text']:
+            return None
+        state['last_update'] = now
+        state['last_text'] = text
+        state['edits'] += 1
+        if in_thread:
+            return asyncio.to_thread(update_response, reply_message_id,
+                                     text + " ▌")
+        update_response(reply_message_id, text + " ▌")
+        return None
+
+    return on_chunk
+
+
+def update_response(reply_message_id: str, response_text: str) -> bool:
+    """
+    更新已发送的文本消息内容（用于流式回复）
+
+    Args:
+        reply_message_id: 需要更新的消息ID
+        response_text: 新的消息内容
+
+    Returns:
+        bool: 是否更新成功
+    """
+    content = json.dumps({"text": response_text})
+
+    try:
+        request = (
+            UpdateMessageRequest.builder()
+            .message_id(reply_message_id)
+            .request_body(
+                UpdateMessageRequestBody.builder()
+                .msg_type("text")
+                .content(content)
+                .build()
+            )
+            .build()
+        )
+        response = client.im.v1.message.update(request)
+
+        if response.success():
+            return True
+        logger.warning("消息更新失败: %s, %s", response.code, response.msg)
+
+    except Exception as e:
+        logger.warning("更新消息异常: %s", e)
+
+    return False
+
 
-    # 保存机器人回复消息的会话映射（用户可能会直接回复机器人的消息）
-    if reply_message_id and result.get('session_id'):
-        save_session_mapping(reply_message_id, result['session_id'],
-                             is_root=False)
-        msg = f"机器人回复消息ID {reply_message_id} 的会话映射已保存"
-        print(msg)
+def add_reaction(message_id: str, emoji_type: str) -> str:
+    """
+    在消息上添加表情回应
+
+    Returns:
+        str: 表情回应ID，失败返回 None
+    """
+    try:
+        request = (
+            CreateMessageReactionRequest.builder()
+            .message_id(message_id)
+            .request_body(
+                CreateMessageReactionRequestBody.builder()
+                .reaction_type(Emoji.builder().emoji_type(emoji_type).build())
+                .build()
+            )
+            .build()
+        )
+        response = client.im.v1.message_reaction.create(request)
+
+        if response.success():
+            return response.data.reaction_id if response.data else None
+        logger.warning("添加表情回应失败: %s, %s", response.code, response.msg)
 
-    print(f"消息 {message_id} 处理完成")
+    except Exception as e:
+        logger.warning("添加表情回应异常: %s", e)
+
+    return None
 
 
-def send_typing_indicator(data: P2ImMessageReceiveV1, message: str) -> None:
-    """发送处理中提示"""
+def remove_reaction(message_id: str, reaction_id: str) -> bool:
+    """
+    移除消息上的表情回应
+
+    Returns:
+        bool: 是否移除成功
+    """
     try:
-        send_response(data, message)
+        request = (
+            DeleteMessageReactionRequest.builder()
+            .message_id(message_id)
+            .reaction_id(reaction_id)
+            .build()
+        )
+        response = client.im.v1.message_reaction.delete(request)
+
+        if response.success():
+            return True
+        logger.warning("移除表情回应失败: %s, %s", response.code, response.msg)
+
     except Exception as e:
-        print(f"发送处理提示失败: {str(e)}")
+        logger.warning("移除表情回应异常: %s", e)
+
+    return False
+
+
+def reply_busy(data: P2ImMessageReceiveV1) -> None:
+    """在后台线程中回复繁忙提示，不阻塞事件回调"""
+    reply_in_background(data, BUSY_REPLY)
+
+
+def reply_in_background(data: P2ImMessageReceiveV1, content: str) -> None:
+    """在后台线程中回复提示（只尝试一次），不阻塞事件回调"""
+    threading.Thread(
+        target=send_response,
+        args=(data, content),
+        kwargs={"max_retries": 1},
+        daemon=True
+    ).start()
+
+
+def enqueue_coalesced(items: list) -> None:
+    """合并窗口结束：以最后一条消息为主消息放入处理队列"""
+    # 排队等待时间从合并后的消息入队时起算，不包含在合并窗口中等待的时间
+    now = time.monotonic()
+    for queued in items:
+        queued.enqueued_at = now
+    item = items[-1]
+    item.merged = items[:-1]
+    message_queue.put(item)
+    logger.debug("合并窗口结束，%d 条消息已加入处理队列", len(items))
 
 
-def process_message_worker():
-    """后台工作线程，处理消息队列"""
-    print("消息处理工作线程已启动")
+def start_processing(item: QueuedMessage) -> list:
+    """
+    消息出队开始处理：记录排队等待时间
+
+    Returns:
+        list: 需要处理的消息事件（按到达顺序，包含合并的更早消息），
+              为空表示消息排队期间已被丢弃，应跳过
+    """
+    events = []
+    for queued in item.merged + [item]:
+        if admission.start(queued):
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued.enqueued_at)
+            events.append(queued.data)
+    return events
+
+
+def dispatch_message_worker():
+    """分发线程，按优先级、公平份额键和对话键将消息交给调度器"""
+    logger.info("消息分发线程已启动")
     while True:
         try:
-            # 从队列中获取消息，超时1秒
-            data = message_queue.get(timeout=1)
-
-            # 处理单个消息
-            process_single_message(data)
+            item = message_queue.get(timeout=1)
+        except Empty:
+            continue
 
-            # 标记任务完成
+        try:
+            data = item.data
+            scheduler.put(
+                item,
+                priority=get_message_priority(data),
+                share_key=get_share_key(data),
+                conversation_key=get_conversation_key(data)
+            )
+        except Exception as e:
+            ERRORS.inc(stage="dispatch")
+            logger.exception("消息分发出错: %s", e)
+        finally:
             message_queue.task_done()
 
-        except Exception as e:
-            # 只有非空队列错误才打印
-            if "queue.Empty" not in str(type(e)) and "Empty" not in str(e):
-                print(f"消息处理出错: {str(e)}")
+
+async def _process_async(item: QueuedMessage, conversation_key: str,
+                         agent_client: AsyncClaudeAgentClient,
+                         inflight: asyncio.Semaphore) -> None:
+    """在事件循环中处理调度器取出的一条消息"""
+    try:
+        # 排队期间因过载被丢弃的消息直接跳过
+        events = start_processing(item)
+        if events:
+            message_id = events[-1].event.message.message_id
+            with correlation(message_id), MESSAGE_SECONDS.time():
+                await process_single_message_async(
+                    events[-1], agent_client, events[:-1])
+    except Exception as e:
+        ERRORS.inc(stage="process")
+        logger.exception("消息处理出错: %s", e)
+    finally:
+        complete_spooled([item])
+        # 允许处理该对话的下一条消息
+        scheduler.done(conversation_key)
+        inflight.release()
+
+
+async def async_message_loop():
+    """
+    异步消息处理循环：与工作线程池共用分发线程和公平调度器，
+    同一对话串行，不同对话按优先级与公平份额并发
+    """
+    agent_client = create_async_client()
+    inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+    running = set()  # 处理中的任务，保持引用直到完成
+    loop = asyncio.get_running_loop()
+    # 轮询调度器使用单独的线程，不与飞书 API 调用（asyncio.to_thread）争用
+    # 默认线程池，线程池占满时也能及时取出下一条消息
+    poller = ThreadPoolExecutor(max_workers=1,
+                                thread_name_prefix="scheduler-poll")
+    start_dispatcher()
+    logger.info("异步消息处理循环已启动，并发上限: %d", ASYNC_MAX_INFLIGHT)
+
+    try:
+        while True:
+            # 先占用并发名额再从调度器取消息，名额用完时消息留在调度器中，
+            # 由调度器决定下一条处理谁
+            await inflight.acquire()
+            picked = await loop.run_in_executor(poller, scheduler.get, 1)
+            if picked is None:
+                inflight.release()
+                continue
+
+            item, conversation_key = picked
+            task = asyncio.create_task(
+                _process_async(item, conversation_key, agent_client, inflight)
+            )
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        poller.shutdown(wait=False)
+        await agent_client.close()
+
+
+def process_message_worker(worker_index: int = 0):
+    """后台工作线程，从调度器获取消息并处理"""
+    logger.debug("消息处理工作线程 #%d 已启动", worker_index)
+    while True:
+        # 从调度器中获取消息，超时1秒
+        picked = scheduler.get(timeout=1)
+        if picked is None:
             continue
 
+        item, conversation_key = picked
+        try:
+            # 排队期间因过载被丢弃的消息直接跳过
+            events = start_processing(item)
+            if events:
+                # 处理单个消息（合并的消息只调用一次 Claude）
+                message_id = events[-1].event.message.message_id
+                with correlation(message_id), MESSAGE_SECONDS.time():
+                    process_single_message(events[-1], events[:-1])
+        except Exception as e:
+            ERRORS.inc(stage="process")
+            logger.exception("消息处理出错: %s", e)
+        finally:
+            complete_spooled([item])
+            # 允许处理该对话的下一条消息
+            scheduler.done(conversation_key)
 
-def send_response(data: P2ImMessageReceiveV1, response_text: str,
-                  max_retries: int = 3) -> str:
+
+def _reply_once(data: P2ImMessageReceiveV1, content: str,
+                idempotency_key: str, attempt: int, max_retries: int) -> str:
     """
-    发送回复消息到飞书，带重试机制
-    统一使用 reply API 来引用原始消息
+    调用一次飞书 reply API
 
     Returns:
-        str: 发送成功的消息ID，失败返回 None
+        str: 回复消息ID（成功但未返回ID时为空字符串），失败返回 None
     """
-    content = json.dumps({"text": response_text})
     message_id = data.event.message.message_id
-
-    for attempt in range(max_retries):
-        try:
-            # 统一使用 reply API，这样无论是私聊还是群聊都会引用原消息
-            request = (
-                ReplyMessageRequest.builder()
-                .message_id(message_id)
-                .request_body(
-                    ReplyMessageRequestBody.builder()
-                    .content(content)
-                    .msg_type("text")
-                    .build()
-                )
+    try:
+        # 统一使用 reply API，这样无论是私聊还是群聊都会引用原消息；
+        # 同一条回复的每次尝试使用相同的 uuid，飞书据此去重，不会重复发送
+        request = (
+            ReplyMessageRequest.builder()
+            .message_id(message_id)
+            .request_body(
+                ReplyMessageRequestBody.builder()
+                .content(content)
+                .msg_type("text")
+                .uuid(idempotency_key)
                 .build()
             )
-            response = client.im.v1.message.reply(request)
-
-            if response.success():
-                reply_msg_id = (response.data.message_id
-                                if response.data else None)
-                chat_type = data.event.message.chat_type
-                chat_type_str = '私聊' if chat_type == 'p2p' else '群聊'
-                attempt_str = f"{attempt + 1}/{max_retries}"
-                print(f"{chat_type_str}消息回复成功 (尝试 {attempt_str})")
-                print(f"  - 原消息ID: {message_id}")
-                print(f"  - 回复消息ID: {reply_msg_id}")
-                return reply_msg_id
-            else:
-                print(f"消息回复失败: {response.code}, {response.msg}")
+            .build()
+        )
+        response = client.im.v1.message.reply(request)
+
+        if response.success():
+            reply_msg_id = (response.data.message_id
+                            if response.data else None)
+            chat_type = data.event.message.chat_type
+            chat_type_str = '私聊' if chat_type == 'p2p' else '群聊'
+            logger.info("%s消息回复成功 (尝试 %d/%d, 原消息ID: %s, "
+                        "回复消息ID: %s)", chat_type_str, attempt,
+                        max_retries, message_id, reply_msg_id)
+            return reply_msg_id or ""
+        else:
+            logger.warning("消息回复失败: %s, %s", response.code, response.msg)
+
+    except Exception as e:
+        logger.warning("发送消息异常 (尝试 %d/%d): %s",
+                       attempt, max_retries, e)
+
+    return None
 
-        except Exception as e:
-            attempt_str = f"{attempt + 1}/{max_retries}"
-            print(f"发送消息异常 (尝试 {attempt_str}): {str(e)}")
 
-        # 重试前等待，使用指数退避
-        if attempt < max_retries - 1:
-            wait_time = 2 ** attempt
-            print(f"等待 {wait_time} 秒后重试...")
-            time.sleep(wait_time)
+def record_dead_letter(data: P2ImMessageReceiveV1, response_text: str,
+                       idempotency_key: str, attempts: int) -> None:
+    """记录最终发送失败的回复，便于排查或人工补发"""
+    message_id = data.event.message.message_id
+    SEND_DEAD_LETTERS.inc()
+    ERRORS.inc(stage="send")
+    logger.error("消息发送最终失败，已尝试 %d 次 (原消息ID: %s, 内容: %s)",
+                 attempts, message_id, log_content(response_text))
+    if not SEND_DEAD_LETTER_FILE:
+        return
+
+    entry = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "message_id": message_id,
+        "chat_id": data.event.message.chat_id,
+        "uuid": idempotency_key,
+        "attempts": attempts,
+        "text": response_text
+    }
+    try:
+        with _dead_letter_lock:
+            with open(SEND_DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning("写入失败回复记录出错: %s", e)
+
+
+def send_response(data: P2ImMessageReceiveV1, response_text: str,
+                  max_retries: int = None, on_sent=None) -> str:
+    """
+    发送回复消息到飞书，失败时在后台重试
+    统一使用 reply API 来引用原始消息
 
-    print(f"消息发送最终失败，已重试 {max_retries} 次")
+    首次发送在调用线程中进行；失败后交给后台重试调度器按带抖动的指数退避
+    重试，调用线程不等待，可以继续处理下一条消息。最终仍失败的回复写入
+    失败记录（SEND_DEAD_LETTER_FILE）。
+
+    Args:
+        data: 飞书消息事件
+        response_text: 回复内容
+        max_retries: 最多尝试次数（含首次），默认 SEND_RETRY_MAX_ATTEMPTS，
+                     为 1 时失败不重试
+        on_sent: 后台重试成功时以回复消息ID调用（可选）
+
+    Returns:
+        str: 首次发送成功时返回消息ID，失败返回 None（可能仍在后台重试）
+    """
+    if max_retries is None:
+        max_retries = SEND_RETRY_MAX_ATTEMPTS
+    content = json.dumps({"text": response_text})
+    idempotency_key = str(uuid.uuid4())
+    started = time.perf_counter()
+
+    reply_msg_id = _reply_once(data, content, idempotency_key, 1, max_retries)
+    if reply_msg_id is not None:
+        SEND_RESPONSE_SECONDS.observe(time.perf_counter() - started,
+                                      outcome="success")
+        return reply_msg_id or None
+
+    if max_retries <= 1:
+        logger.error("消息发送失败，不再重试")
+        SEND_RESPONSE_SECONDS.observe(time.perf_counter() - started,
+                                      outcome="failure")
+        ERRORS.inc(stage="send")
+        return None
+
+    SEND_RESPONSE_SECONDS.observe(time.perf_counter() - started,
+                                  outcome="deferred")
+    retry_state = {'attempt': 1}
+
+    def retry_send():
+        SEND_RESPONSE_RETRIES.inc()
+        retry_state['attempt'] += 1
+        return _reply_once(data, content, idempotency_key,
+                           retry_state['attempt'], max_retries)
+
+    def sent(reply_id):
+        if reply_id and on_sent is not None:
+            on_sent(reply_id)
+
+    reply_retry.submit(
+        retry_send,
+        on_success=sent,
+        on_give_up=lambda: record_dead_letter(
+            data, response_text, idempotency_key, max_retries),
+        max_attempts=max_retries,
+        name=f"回复消息 {data.event.message.message_id}"
+    )
     return None
 
 
@@ -288,7 +1328,7 @@ APP_ID = os.getenv("APP_ID", "")
 APP_SECRET = os.getenv("APP_SECRET", "")
 
 if not APP_ID or not APP_SECRET:
-    print("警告: APP_ID 或 APP_SECRET 未设置，请检查环境变量")
+    logger.warning("APP_ID 或 APP_SECRET 未设置，请检查环境变量")
 
 # 注册事件处理器
 event_handler = (
@@ -309,55 +1349,114 @@ wsClient = lark.ws.Client(
     lark.APP_ID,
     lark.APP_SECRET,
     event_handler=event_handler,
-    log_level=lark.LogLevel.DEBUG,
+    log_level=lark_log_level(),
 )
 
 
+def handle_shutdown_signal(signum, frame):
+    """收到终止信号时写入未持久化的会话映射后退出，排队中的消息留在暂存文件中"""
+    logger.info("收到信号 %s，正在保存会话映射并退出...", signum)
+    flush_session_store()
+    if ingress_spool is not None:
+        ingress_spool.close()
+    sys.exit(0)
+
+
+def start_worker_pool():
+    """启动后台消息处理工作线程池"""
+    for index in range(MESSAGE_WORKER_COUNT):
+        worker_thread = threading.Thread(
+            target=process_message_worker,
+            args=(index,),
+            name=f"message-worker-{index}",
+            daemon=True
+        )
+        worker_thread.start()
+
+    start_dispatcher()
+    logger.info("后台消息处理线程池已启动 (共 %d 个)", MESSAGE_WORKER_COUNT)
+
+
+def start_dispatcher():
+    """启动消息分发线程"""
+    dispatch_thread = threading.Thread(
+        target=dispatch_message_worker,
+        name="message-dispatcher",
+        daemon=True
+    )
+    dispatch_thread.start()
+
+
 def main():
     """启动机器人"""
-    print("=" * 60)
-    print("正在启动 Claude 飞书机器人...")
-    print("=" * 60)
+    logger.info("=" * 60)
+    logger.info("正在启动 Claude 飞书机器人...")
+    logger.info("=" * 60)
     app_id_display = (f"{APP_ID[:10]}..."
                       if len(APP_ID) > 10 else APP_ID)
-    print(f"APP_ID: {app_id_display}")
-    print(f"APP_SECRET: {'*' * 8}")
+    logger.info("APP_ID: %s", app_id_display)
+    logger.info("APP_SECRET: %s", "*" * 8)
 
     # 获取 Claude Agent HTTP 配置
     claude_agent_url = os.getenv("CLAUDE_AGENT_URL", "http://localhost:8000")
-    print(f"CLAUDE_AGENT_URL: {claude_agent_url}")
+    logger.info("CLAUDE_AGENT_URL: %s", claude_agent_url)
 
     # 初始化会话映射存储
-    print(f"SESSION_STORE_DIR: {SESSION_STORE_DIR}")
+    logger.info("SESSION_STORE_DIR: %s", SESSION_STORE_DIR)
+    logger.info("SESSION_STORE_BACKEND: %s", SESSION_STORE_BACKEND)
     init_session_store()
-    print(f"📂 已加载会话映射，当前数量: {get_session_count()}")
+    logger.info("📂 已加载会话映射，当前数量: %d", get_session_count())
+
+    # 预创建后端会话，新对话无需等待 create_session
+    start_session_pool()
+
+    # 恢复上次运行时已收到但未处理完成的消息，在启动工作线程后开始处理
+    if ingress_spool is not None:
+        logger.info("INGRESS_SPOOL_FILE: %s", INGRESS_SPOOL_FILE)
+        replayed = replay_spooled_messages()
+        if replayed:
+            logger.info("♻️ 已恢复 %d 条上次未处理完成的消息", replayed)
+
+    # 启动指标服务
+    if METRICS_PORT:
+        try:
+            metrics.start_metrics_server(METRICS_PORT, METRICS_HOST)
+            logger.info("📊 指标服务已启动: http://%s:%d/metrics",
+                        METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.warning("⚠️ 指标服务启动失败: %s", e)
+
+    # docker stop 发送 SIGTERM，退出前确保会话映射写盘
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
 
     # 检查 Claude Agent HTTP 服务健康状态
     try:
         agent_client = get_client()
         if agent_client.health_check():
-            print("✅ Claude Agent HTTP 服务连接正常")
+            logger.info("✅ Claude Agent HTTP 服务连接正常")
         else:
-            warning_msg = "⚠️ Claude Agent HTTP 服务不可用，请检查服务是否启动"
-            print(warning_msg)
+            logger.warning("⚠️ Claude Agent HTTP 服务不可用，请检查服务是否启动")
     except Exception as e:
-        print(f"⚠️ Claude Agent HTTP 服务检查失败: {str(e)}")
-
-    # 启动后台消息处理工作线程
-    worker_thread = threading.Thread(
-        target=process_message_worker,
-        daemon=True
-    )
-    worker_thread.start()
-    print("后台消息处理线程已启动")
-
-    print("=" * 60)
-    print("🚀 机器人启动完成！")
-    print("✅ 立即响应机制已启用，防止重复消息")
-    print("✅ 后台异步处理已启用")
-    print("✅ 消息引用回复已启用")
-    print("✅ 上下文关联已启用（通过 claude-agent-http 会话管理）")
-    print("=" * 60)
+        logger.warning("⚠️ Claude Agent HTTP 服务检查失败: %s", e)
+
+    if ASYNC_PIPELINE:
+        # 异步模式：单个事件循环线程处理全部消息
+        async_thread = threading.Thread(
+            target=lambda: asyncio.run(async_message_loop()),
+            name="message-async-loop",
+            daemon=True
+        )
+        async_thread.start()
+    else:
+        start_worker_pool()
+
+    logger.info("=" * 60)
+    logger.info("🚀 机器人启动完成！")
+    logger.info("✅ 立即响应机制已启用，防止重复消息")
+    logger.info("✅ 后台异步处理已启用（按会话并行，按用户公平调度）")
+    logger.info("✅ 消息引用回复已启用")
+    logger.info("✅ 上下文关联已启用（通过 claude-agent-http 会话管理）")
+    logger.info("=" * 60)
 
     # 启动 WebSocket 连接
     wsClient.start()
@@ -0,0 +1,131 @@
+"""按用户与会话的令牌桶限流模块"""
+
+import time
+from threading import Lock
+
+
+class _Bucket:
+    """单个令牌桶"""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+
+class KeyedTokenBucket:
+    """
+    按键区分的令牌桶
+
+    每个键的令牌以 rate 个/秒的速度恢复，最多积累 burst 个。rate 为 0 表示
+    不限流。已恢复满的桶在键数量超过 max_keys 时被清理，清理后等同于满桶。
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_keys = max_keys
+        self._buckets: dict = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def available(self, key: str, now: float) -> bool:
+        """是否至少有一个令牌（调用方负责加锁）"""
+        if not self.enabled:
+            return True
+        return self._refill(key, now).tokens >= 1
+
+    def consume(self, key: str, now: float) -> None:
+        """消耗一个令牌（调用方负责加锁）"""
+        if not self.enabled:
+            return
+        self._refill(key, now).tokens -= 1
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+
+    def retry_after(self, key: str, now: float) -> float:
+        """距离下一个令牌恢复的秒数（调用方负责加锁）"""
+        if not self.enabled:
+            return 0.0
+        bucket = self._refill(key, now)
+        return max(0.0, (1 - bucket.tokens) / self.rate)
+
+    def _refill(self, key: str, now: float) -> _Bucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = _Bucket(self.burst, now)
+            self._buckets[key] = bucket
+            return bucket
+
+        elapsed = now - bucket.updated
+        if elapsed > 0:
+            bucket.tokens = min(self.burst,
+                                bucket.tokens + elapsed * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def _prune(self, now: float):
+        """清理已恢复满的桶"""
+        full_after = self.burst / self.rate
+        for key in [k for k, b in self._buckets.items()
+                    if now - b.updated >= full_after]:
+            del self._buckets[key]
+
+
+class RateLimiter:
+    """
+    用户 + 会话两级限流
+
+    同时满足用户限额与会话限额时才放行，并各消耗一个令牌；任一超限时
+    不消耗令牌并计入对应的限流次数。
+    """
+
+    def __init__(self, user_per_minute: float = 0, user_burst: float = 1,
+                 chat_per_minute: float = 0, chat_burst: float = 1):
+        self.user_buckets = KeyedTokenBucket(user_per_minute / 60, user_burst)
+        self.chat_buckets = KeyedTokenBucket(chat_per_minute / 60, chat_burst)
+        self._lock = Lock()
+        self.allowed = 0  # 放行次数
+        self.throttled_user = 0  # 因用户限额被限流的次数
+        self.throttled_chat = 0  # 因会话限额被限流的次数
+
+    def acquire(self, user_id: str, chat_id: str):
+        """
+        尝试为一次 Claude 调用获取配额
+
+        Args:
+            user_id: 用户ID
+            chat_id: 会话ID
+
+        Returns:
+            tuple: (是否放行, 建议等待秒数)
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if not self.user_buckets.available(user_id, now):
+                self.throttled_user += 1
+                return False, self.user_buckets.retry_after(user_id, now)
+
+            if chat_id and not self.chat_buckets.available(chat_id, now):
+                self.throttled_chat += 1
+                return False, self.chat_buckets.retry_after(chat_id, now)
+
+            self.user_buckets.consume(user_id, now)
+            if chat_id:
+                self.chat_buckets.consume(chat_id, now)
+            self.allowed += 1
+
+        return True, 0.0
+
+    def stats(self) -> dict:
+        """获取限流统计信息"""
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "throttled_user": self.throttled_user,
+                "throttled_chat": self.throttled_chat
+            }
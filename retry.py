@@ -0,0 +1,170 @@
+"""后台延迟重试模块：失败的操作按带抖动的指数退避延迟重试，不阻塞调用线程"""
+
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    """等待重试的操作"""
+
+    __slots__ = ("func", "on_success", "on_give_up", "attempts",
+                 "max_attempts", "name")
+
+    def __init__(self, func, on_success, on_give_up, attempts: int,
+                 max_attempts: int, name: str):
+        self.func = func
+        self.on_success = on_success
+        self.on_give_up = on_give_up
+        self.attempts = attempts  # 已尝试次数
+        self.max_attempts = max_attempts
+        self.name = name
+
+
+class RetryScheduler:
+    """
+    延迟重试调度器
+
+    提交的操作放入按到期时间排序的延迟队列，由固定数量的后台线程在到期
+    后执行。func 返回 None 视为失败（抛出异常同样视为失败），在未达到
+    max_attempts 前按 base_delay * 2^n 退避（上限 max_delay，乘以 0.5~1.5
+    的随机抖动）后再次执行；成功时以返回值调用 on_success，最终失败时调用
+    on_give_up。
+    """
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 30.0,
+                 workers: int = 2):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.workers = max(1, workers)
+        self._heap: list = []  # (到期时间, 序号, _Job)
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._threads: list = []
+
+        self.retried = 0  # 执行的重试次数
+        self.succeeded = 0  # 重试后成功的操作数
+        self.gave_up = 0  # 重试后仍失败的操作数
+
+    def submit(self, func, on_success=None, on_give_up=None,
+               attempts: int = 1, max_attempts: int = 3,
+               name: str = "") -> bool:
+        """
+        提交一个已失败的操作，延迟后重试
+
+        Args:
+            func: 无参数的操作，返回 None 表示失败
+            on_success: 重试成功时以 func 的返回值调用（可选）
+            on_give_up: 达到最大尝试次数仍失败时调用（可选）
+            attempts: 已尝试次数
+            max_attempts: 最多尝试次数（含已尝试的次数）
+            name: 日志中显示的操作名称
+
+        Returns:
+            bool: False 表示已达到最大尝试次数，不再重试（on_give_up 已调用）
+        """
+        job = _Job(func, on_success, on_give_up, attempts, max_attempts, name)
+        if attempts >= max_attempts:
+            self._give_up(job)
+            return False
+
+        self._start()
+        self._schedule(job)
+        return True
+
+    def pending(self) -> int:
+        """等待重试的操作数"""
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self) -> dict:
+        """获取重试统计信息"""
+        with self._cond:
+            return {
+                "pending": len(self._heap),
+                "retried": self.retried,
+                "succeeded": self.succeeded,
+                "gave_up": self.gave_up
+            }
+
+    def delay(self, attempts: int) -> float:
+        """第 attempts 次失败后的等待时间（秒）"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * (0.5 + random.random())
+
+    def _start(self) -> None:
+        """按需启动后台线程"""
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker,
+                                          name=f"retry-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _schedule(self, job: _Job) -> None:
+        wait = self.delay(job.attempts)
+        logger.info("%s 第 %d 次尝试失败，%.1f 秒后重试",
+                    job.name or "操作", job.attempts, wait)
+        with self._cond:
+            heapq.heappush(self._heap,
+                           (time.monotonic() + wait, next(self._seq), job))
+            self._cond.notify()
+
+    def _next_job(self) -> _Job:
+        """等待并取出下一个到期的操作"""
+        with self._cond:
+            while True:
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        job = heapq.heappop(self._heap)[2]
+                        self.retried += 1
+                        return job
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _worker(self) -> None:
+        """后台线程：执行到期的重试"""
+        while True:
+            job = self._next_job()
+            job.attempts += 1
+            try:
+                result = job.func()
+            except Exception as e:
+                logger.warning("%s 重试异常 (尝试 %d/%d): %s", job.name or "操作",
+                               job.attempts, job.max_attempts, e)
+                result = None
+
+            if result is not None:
+                with self._cond:
+                    self.succeeded += 1
+                if job.on_success is not None:
+                    try:
+                        job.on_success(result)
+                    except Exception as e:
+                        logger.warning("%s 重试成功回调出错: %s",
+                                       job.name or "操作", e)
+            elif job.attempts >= job.max_attempts:
+                self._give_up(job)
+            else:
+                self._schedule(job)
+
+    def _give_up(self, job: _Job) -> None:
+        with self._cond:
+            self.gave_up += 1
+        if job.on_give_up is not None:
+            try:
+                job.on_give_up()
+            except Exception as e:
+                logger.warning("%s 最终失败回调出错: %s", job.name or "操作", e)
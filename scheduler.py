@@ -0,0 +1,173 @@
+"""消息调度模块：优先级 + 按用户/会话的加权公平调度"""
+
+import time
+import logging
+from collections import OrderedDict, deque
+from threading import Condition
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Flow:
+    """同一公平份额键（用户或会话）下排队的消息"""
+
+    __slots__ = ("items", "credits")
+
+    def __init__(self, weight: int):
+        self.items: deque = deque()
+        self.credits = weight  # 本轮还能连续取出的消息数
+
+
+class FairScheduler:
+    """
+    公平调度器
+
+    消息按优先级分类（数值越小越优先），同一优先级内按公平份额键（用户或
+    会话）加权轮询：每个键每轮最多连续取出 weight 条消息，避免单个用户连续
+    发送的大量消息挤占其他人。同一对话（conversation_key）的消息严格按入队
+    顺序逐条处理，前一条处理完成前后续消息不会被取出。
+    """
+
+    def __init__(self, weights: dict = None, default_weight: int = 1):
+        self.weights = weights or {}
+        self.default_weight = max(1, default_weight)
+        # 优先级 -> OrderedDict(公平份额键 -> _Flow)，按轮询顺序排列
+        self._classes: dict = {}
+        # 对话键 -> 排队中的消息序号（按入队顺序）
+        self._conversations: dict = {}
+        self._busy: set = set()  # 正在处理的对话键
+        self._size = 0
+        self._cond = Condition()
+
+    def put(self, item, priority: int, share_key: str,
+            conversation_key: str) -> None:
+        """
+        加入一条待处理消息
+
+        Args:
+            item: 排队消息（需有唯一的 seq 属性）
+            priority: 优先级，数值越小越优先
+            share_key: 公平份额键（用户ID或会话ID）
+            conversation_key: 对话键，同一对话内严格按顺序处理
+        """
+        with self._cond:
+            flows = self._classes.setdefault(priority, OrderedDict())
+            flow = flows.get(share_key)
+            if flow is None:
+                flow = _Flow(self._weight(share_key))
+                flows[share_key] = flow
+            flow.items.append((item, conversation_key))
+            self._conversations.setdefault(
+                conversation_key, deque()).append(item.seq)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, timeout: float = None):
+        """
+        取出下一条可处理的消息，并将其对话标记为处理中
+
+        Args:
+            timeout: 最长等待时间（秒），None 表示一直等待
+
+        Returns:
+            tuple: (消息, 对话键)，超时返回 None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                picked = self._pick()
+                if picked is not None:
+                    return picked
+
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+
+    def done(self, conversation_key: str) -> None:
+        """对话的当前消息处理完成，允许取出该对话的下一条消息"""
+        with self._cond:
+            self._busy.discard(conversation_key)
+            self._cond.notify_all()
+
+    def qsize(self) -> int:
+        """排队中的消息数"""
+        return self._size
+
+    def _weight(self, share_key: str) -> int:
+        return max(1, int(self.weights.get(share_key, self.default_weight)))
+
+    def _pick(self) -> Optional[tuple]:
+        """按优先级与加权轮询选出消息（调用方需持有 _cond）"""
+        for priority in sorted(self._classes):
+            flows = self._classes[priority]
+            for share_key in list(flows.keys()):
+                flow = flows[share_key]
+                entry = self._take_ready(flow)
+                if entry is None:
+                    continue
+
+                item, conversation_key = entry
+                flow.credits -= 1
+                if not flow.items:
+                    del flows[share_key]
+                elif flow.credits <= 0:
+                    # 本轮份额用完，移到轮询队尾
+                    flow.credits = self._weight(share_key)
+                    flows.move_to_end(share_key)
+
+                if not flows:
+                    del self._classes[priority]
+
+                self._busy.add(conversation_key)
+                self._size -= 1
+                return item, conversation_key
+
+        return None
+
+    def _take_ready(self, flow: _Flow) -> Optional[tuple]:
+        """
+        从 flow 中取出第一条可处理的消息：其对话不在处理中，且它是该对话
+        最早入队的消息（调用方需持有 _cond）
+        """
+        for index, (item, conversation_key) in enumerate(flow.items):
+            if conversation_key in self._busy:
+                continue
+            pending = self._conversations[conversation_key]
+            if pending[0] != item.seq:
+                continue
+
+            del flow.items[index]
+            pending.popleft()
+            if not pending:
+                del self._conversations[conversation_key]
+            return item, conversation_key
+
+        return None
+
+
+def parse_weights(value: str) -> dict:
+    """
+    解析权重配置
+
+    Args:
+        value: 形如 "ou_xxx:3,oc_yyy:2" 的字符串
+
+    Returns:
+        dict: 公平份额键 -> 权重
+    """
+    weights = {}
+    for part in (value or "").split(","):
+        key, _, weight = part.strip().rpartition(":")
+        if not key:
+            continue
+        try:
+            weights[key] = max(1, int(weight))
+        except ValueError:
+            logger.warning("⚠️ 无效的调度权重配置: %s", part)
+    return weights
@@ -0,0 +1,217 @@
+"""后端会话预创建池：新对话直接取用预先创建的会话，省去一次 create_session 调用"""
+
+import time
+import random
+import logging
+from collections import OrderedDict, deque
+from queue import Queue
+from threading import Lock, Thread
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPool:
+    """
+    后端会话预创建池
+
+    后台线程为每个池键预先创建 size 个后端会话，acquire 时立即取出一个并
+    异步补充。per_user 为 False 时所有用户共用一个池（会话以 pool_user 的
+    身份创建）；为 True 时按用户分别维护，用户第一次新建对话时登记，之后
+    的新对话即可命中，最多维护 max_users 个用户（按最近使用淘汰）。
+
+    创建超过 max_age 秒仍未使用的会话视为过期，不再交出并交给 close 关闭
+    （close 不应阻塞，acquire 在消息处理线程中调用）；close_all 关闭全部
+    未使用的会话（程序退出时调用）。
+    """
+
+    def __init__(self, create, close, size: int, per_user: bool = False,
+                 pool_user: str = "default", max_users: int = 100,
+                 max_age: float = 600):
+        """
+        Args:
+            create: 以 user_id 创建后端会话并返回 session_id 的函数
+            close: 关闭后端会话的函数
+            size: 每个池键保持的预创建会话数
+            per_user: 是否按用户分别预创建
+            pool_user: 共用池创建会话时使用的 user_id
+            max_users: 按用户预创建时最多维护的用户数
+            max_age: 预创建会话的最长保留时间（秒），0 表示不过期
+        """
+        self.create = create
+        self.close = close
+        self.size = size
+        self.per_user = per_user
+        self.pool_user = pool_user
+        self.max_users = max_users
+        self.max_age = max_age
+        # 池键 -> deque((session_id, 创建时间))，按最近使用排序
+        self._pools: OrderedDict = OrderedDict()
+        self._refilling: set = set()  # 已在补充队列中的池键
+        self._queue: Queue = Queue()
+        self._lock = Lock()
+        self._thread = None
+        self._closed = False
+
+        self.hits = 0  # 取到预创建会话的次数
+        self.misses = 0  # 池为空、需要同步创建的次数
+        self.created = 0  # 预创建的会话数
+        self.expired = 0  # 过期或被淘汰后关闭的未使用会话数
+
+    def start(self) -> None:
+        """启动后台补充线程，并为共用池预创建会话"""
+        with self._lock:
+            if self._thread is not None or self.size <= 0:
+                return
+            self._thread = Thread(target=self._worker,
+                                  name="session-pool", daemon=True)
+            self._thread.start()
+        if not self.per_user:
+            self._schedule(self.pool_user)
+
+    def acquire(self, user_id: str) -> Optional[str]:
+        """
+        取出一个预创建的会话（不阻塞）
+
+        Args:
+            user_id: 发起新对话的用户ID
+
+        Returns:
+            str: 预创建的 session_id，池为空时返回 None
+        """
+        if self.size <= 0:
+            return None
+
+        key = user_id if self.per_user else self.pool_user
+        session_id = None
+        stale = []
+        with self._lock:
+            if self._closed:
+                return None
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = deque()
+                self._pools[key] = pool
+                stale.extend(self._evict_users())
+            self._pools.move_to_end(key)
+
+            now = time.monotonic()
+            while pool:
+                candidate, created_at = pool.popleft()
+                if self.max_age and now - created_at > self.max_age:
+                    stale.append(candidate)
+                    continue
+                session_id = candidate
+                break
+
+            if session_id:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.expired += len(stale)
+
+        for stale_id in stale:
+            self._close(stale_id)
+        self._schedule(key)
+        return session_id
+
+    def available(self) -> int:
+        """可立即取用的预创建会话数"""
+        with self._lock:
+            return sum(len(pool) for pool in self._pools.values())
+
+    def stats(self) -> dict:
+        """获取预创建池统计信息"""
+        with self._lock:
+            return {
+                "available": sum(len(pool) for pool in self._pools.values()),
+                "keys": len(self._pools),
+                "hits": self.hits,
+                "misses": self.misses,
+                "created": self.created,
+                "expired": self.expired
+            }
+
+    def close_all(self) -> None:
+        """停止补充并关闭全部未使用的预创建会话"""
+        with self._lock:
+            self._closed = True
+            unused = [session_id for pool in self._pools.values()
+                      for session_id, _ in pool]
+            self._pools.clear()
+
+        for session_id in unused:
+            self._close(session_id)
+        if unused:
+            logger.info("已关闭 %d 个未使用的预创建会话", len(unused))
+
+    def _evict_users(self) -> list:
+        """超出用户数上限时淘汰最久未使用的用户（调用方需持有 _lock）"""
+        stale = []
+        while self.per_user and len(self._pools) > self.max_users:
+            _, pool = self._pools.popitem(last=False)
+            stale.extend(session_id for session_id, _ in pool)
+        return stale
+
+    def _schedule(self, key: str) -> None:
+        """将池键加入补充队列（已在队列中时忽略）"""
+        with self._lock:
+            if self._thread is None or self._closed or key in self._refilling:
+                return
+            self._refilling.add(key)
+        self._queue.put(key)
+
+    def _worker(self) -> None:
+        """后台线程：把队列中的池键补充到 size 个会话"""
+        failures = 0
+        while True:
+            key = self._queue.get()
+            try:
+                self._refill(key)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.warning("预创建会话失败 (连续 %d 次): %s", failures, e)
+                # 后端不可用时退避，避免持续请求
+                time.sleep(min(60, 2 ** failures) * (0.5 + random.random()))
+                with self._lock:
+                    self._refilling.discard(key)
+                self._schedule(key)
+                continue
+
+            with self._lock:
+                self._refilling.discard(key)
+
+    def _refill(self, key: str) -> None:
+        """为单个池键创建会话直到补满（在后台线程中执行）"""
+        while True:
+            with self._lock:
+                pool = self._pools.get(key)
+                if self._closed or (pool is not None
+                                    and len(pool) >= self.size):
+                    return
+                if pool is None and self.per_user:
+                    # 用户已被淘汰
+                    return
+
+            session_id = self.create(key)
+
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None and not self.per_user and not self._closed:
+                    pool = deque()
+                    self._pools[key] = pool
+                if pool is not None and not self._closed:
+                    pool.append((session_id, time.monotonic()))
+                    self.created += 1
+                    continue
+            # 创建期间用户被淘汰或池已关闭
+            self._close(session_id)
+            return
+
+    def _close(self, session_id: str) -> None:
+        """关闭未使用的会话，失败只记录日志"""
+        try:
+            self.close(session_id)
+        except Exception as e:
+            logger.warning("关闭预创建会话 %s 失败: %s", session_id, e)
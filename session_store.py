@@ -0,0 +1,1041 @@
+"""会话映射存储模块
+
+提供统一的 SessionStore 接口，以及两种实现：
+- JsonSessionStore: JSON 快照 + 追加日志（默认）
+- SqliteSessionStore: SQLite（WAL 模式），按 message_id / session_id 建索引
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from typing import Callable, Optional
+from pathlib import Path
+
+STORAGE_VERSION = "2.0"  # JSON 存储格式版本号
+_MAX_RECENT_MESSAGES = 3  # 每个会话保留的最近消息数（不含 root_id）
+# SQLite 存储中查询命中时刷新最近使用时间的最小间隔（秒），避免每次查询都写库
+_SQLITE_TOUCH_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def _copy_session(data: dict) -> dict:
+    """复制单个会话的数据"""
+    return {
+        "root_id": data.get("root_id"),
+        "recent": list(data.get("recent", [])),
+        "touched": data.get("touched")
+    }
+
+
+def migrate_legacy_format(old_data: dict) -> dict:
+    """
+    迁移旧格式到新格式
+    旧格式: {"mappings": [["msg_id", "session_id"], ...]}
+    新格式: {"version": "2.0", "sessions": {...}}
+    """
+    logger.info("🔄 检测到旧格式数据，开始迁移...")
+
+    # 转换数据结构
+    new_store = {"version": STORAGE_VERSION, "sessions": {}}
+    mappings = old_data.get('mappings', [])
+
+    # 按 session_id 分组
+    session_messages = {}
+    for msg_id, sess_id in mappings:
+        if sess_id not in session_messages:
+            session_messages[sess_id] = []
+        session_messages[sess_id].append(msg_id)
+
+    # 构建新格式
+    for sess_id, msg_ids in session_messages.items():
+        # 第一条消息作为 root_id（保守策略）
+        root_id = msg_ids[0] if msg_ids else None
+        # 最后3条作为 recent
+        recent = msg_ids[-_MAX_RECENT_MESSAGES:] if len(msg_ids) > 0 else []
+
+        new_store["sessions"][sess_id] = {
+            "root_id": root_id,
+            "recent": recent
+        }
+
+    total_sessions = len(new_store["sessions"])
+    total_messages = sum(len(msgs) for msgs in session_messages.values())
+    saved_messages = sum(
+        1 + len(s["recent"]) for s in new_store["sessions"].values()
+    )
+    logger.info("📊 迁移完成: %d 个会话, %d 条消息 -> %d 条消息",
+                total_sessions, total_messages, saved_messages)
+
+    return new_store
+
+
+class SessionStore(ABC):
+    """
+    会话映射存储接口
+
+    保存飞书消息ID与 claude-agent-http 会话ID的映射。会话按最近使用时间淘汰：
+    超出 max_sessions 时淘汰最久未使用的会话，超过 idle_ttl 秒未使用的会话
+    也会被淘汰（idle_ttl 为 0 表示不按空闲时间淘汰）。会话被淘汰时调用
+    on_evict(session_id) 通知调用方（例如关闭后端会话）。
+    """
+
+    def __init__(self, max_sessions: int = 1000,
+                 on_evict: Callable[[str], None] = None,
+                 idle_ttl: float = 0):
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict
+        self.idle_ttl = idle_ttl
+        self._evicted_capacity = 0  # 因超出容量淘汰的会话数
+        self._evicted_idle = 0  # 因空闲超时淘汰的会话数
+        self._last_eviction: Optional[float] = None
+
+    @abstractmethod
+    def load(self) -> None:
+        """加载持久化数据（程序启动时调用）"""
+
+    @abstractmethod
+    def get_session_id(self, message_id: str) -> Optional[str]:
+        """获取消息关联的会话ID，没有则返回 None"""
+
+    @abstractmethod
+    def save_mapping(self, message_id: str, session_id: str,
+                     is_root: bool = False) -> None:
+        """保存消息ID与会话ID的映射"""
+
+    @abstractmethod
+    def count(self) -> int:
+        """获取当前会话数量"""
+
+    def flush(self) -> None:
+        """将尚未持久化的变更立即写入磁盘"""
+
+    def close(self) -> None:
+        """刷新并释放资源"""
+        self.flush()
+
+    def stats(self) -> dict:
+        """
+        获取会话存储统计信息
+
+        Returns:
+            dict: 会话数量、容量配置及淘汰统计
+        """
+        return {
+            "sessions": self.count(),
+            "max_sessions": self.max_sessions,
+            "idle_ttl": self.idle_ttl,
+            "evicted_capacity": self._evicted_capacity,
+            "evicted_idle": self._evicted_idle,
+            "last_eviction": self._last_eviction
+        }
+
+    def _record_evictions(self, capacity: int, idle: int) -> None:
+        """累计淘汰统计"""
+        if not capacity and not idle:
+            return
+        self._evicted_capacity += capacity
+        self._evicted_idle += idle
+        self._last_eviction = time.time()
+        logger.info("🧹 已清理 %d 个旧会话 (容量 %d, 空闲 %d)",
+                    capacity + idle, capacity, idle)
+
+    def _notify_evicted(self, session_ids: list) -> None:
+        """通知调用方会话已被淘汰"""
+        if not self.on_evict:
+            return
+        for sess_id in session_ids:
+            try:
+                self.on_evict(sess_id)
+            except Exception:
+                pass
+
+
+class JsonSessionStore(SessionStore):
+    """
+    JSON 快照 + 追加日志存储
+
+    支持两种持久化模式：
+    - journal: 每次变更追加一条紧凑记录到日志文件，由后台线程写盘；日志
+      达到阈值后压缩为快照。启动时加载快照并回放日志。读取命中刷新的最近
+      使用时间按会话合并，随后台线程的下一批记录写入。
+    - coalesce: 变更只标记为脏，由后台线程最多每 flush_interval 秒写一次
+      完整快照，退出时再写一次。
+
+    快照均通过临时文件 + 重命名原子写入。会话按最近使用时间保存在
+    OrderedDict 中，访问与淘汰均为 O(1)。
+
+    存储结构:
+    {
+      "version": "2.0",
+      "sessions": {
+        "session_id": {
+          "root_id": "om_xxx",
+          "recent": ["om_yyy", "om_zzz"],
+          "touched": 1736668800.0
+        }
+      }
+    }
+    """
+
+    def __init__(self, store_dir: str, max_sessions: int = 1000,
+                 on_evict: Callable[[str], None] = None,
+                 idle_ttl: float = 0,
+                 compact_records: int = 5000,
+                 compact_interval: int = 600,
+                 persist_mode: str = "journal",
+                 flush_interval: float = 1.0):
+        super().__init__(max_sessions, on_evict, idle_ttl)
+        self.store_dir = store_dir
+        self.store_file = os.path.join(store_dir, "session_mapping.json")
+        self.journal_file = os.path.join(store_dir,
+                                         "session_mapping.journal")
+        self.compact_records = compact_records
+        self.compact_interval = compact_interval
+        self.persist_mode = persist_mode
+        self.flush_interval = flush_interval
+
+        self._store: dict = {"version": STORAGE_VERSION, "sessions": {}}
+        self._cache: dict = {}  # 内存缓存: message_id -> session_id
+        # 按最近使用时间排序: session_id -> 最近使用时间（最久未使用的在前）
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self._initialized = False
+
+        # 追加日志记录（在 _lock 内按变更顺序入队，由后台线程写盘）
+        # {"op": "root" | "recent" | "del" | "touch", "s": session_id,
+        #  "m": message_id, "t": 时间}
+        self._journal_queue: Queue = Queue()
+        self._journal_ready = Event()  # 有新记录入队时唤醒后台线程
+        # 尚未写盘的最近使用时间刷新（由 _lock 保护）: session_id -> 时间
+        self._pending_touches: dict = {}
+        self._io_lock = Lock()  # 保护日志与快照文件的写入
+        self._journal_records = 0  # 上次压缩后日志中的记录数
+        self._last_compact = 0.0
+        self._writer: Optional[Thread] = None
+
+        # coalesce 模式：上次写快照后是否有未持久化的变更
+        self._dirty = False
+        # 上次写快照后变更过的会话（由 _lock 保护），写快照时只复制这些会话
+        self._dirty_sessions: set = set()
+        # 最近一次写入的快照中的会话（由 _io_lock 保护）
+        self._persisted: dict = {}
+        self.flush_count = 0  # 已写入的快照次数
+
+    def _ensure_store_dir(self):
+        """确保存储目录存在"""
+        Path(self.store_dir).mkdir(parents=True, exist_ok=True)
+
+    def load(self) -> None:
+        """从文件加载会话映射，并启动后台日志写入线程"""
+        if self._initialized:
+            return
+
+        self._load_data()
+        self._initialized = True
+        self._start_writer()
+
+    def _load_data(self):
+        """加载快照、回放追加日志并构建内存缓存"""
+        self._ensure_store_dir()
+
+        try:
+            if os.path.exists(self.store_file):
+                with open(self.store_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+
+                if data.get('version') == STORAGE_VERSION:
+                    self._store = data
+                    session_count = len(self._store.get("sessions", {}))
+                    logger.info("✅ 已加载 %d 个会话 (v%s)",
+                                session_count, STORAGE_VERSION)
+                elif 'mappings' in data:
+                    # 旧格式，备份后迁移并立即保存
+                    self._backup_legacy(data)
+                    self._store = migrate_legacy_format(data)
+                    self._save_snapshot()
+                else:
+                    logger.warning("⚠️ 未知的存储格式，使用新格式")
+            else:
+                logger.info("📁 会话映射文件不存在，将创建新文件")
+
+        except Exception as e:
+            logger.warning("⚠️ 加载会话映射失败: %s，使用空映射", e)
+            self._store = {"version": STORAGE_VERSION, "sessions": {}}
+
+        # 回放快照之后的追加日志
+        self._replay_journal()
+
+        # 构建内存缓存
+        self._rebuild_cache()
+        logger.info("📦 内存缓存已构建: %d 条消息映射", len(self._cache))
+
+        # 之后写快照时只合并变更过的会话
+        self._persisted = self._copy_store()["sessions"]
+        self._dirty_sessions.clear()
+
+    def get_session_id(self, message_id: str) -> Optional[str]:
+        """获取消息关联的会话ID，命中时刷新会话的最近使用时间"""
+        self.load()
+
+        with self._lock:
+            # 先淘汰空闲超时的会话，避免返回已过期的会话
+            evicted = self._cleanup_old_sessions()
+            session_id = self._cache.get(message_id)
+            if session_id:
+                self._touch(session_id)
+                self._journal_touch(session_id)
+
+        self._notify_evicted(evicted)
+        return session_id
+
+    def save_mapping(self, message_id: str, session_id: str,
+                     is_root: bool = False) -> None:
+        """保存消息ID与会话ID的映射"""
+        self.load()
+        now = time.time()
+
+        with self._lock:
+            existing_session = self._cache.get(message_id)
+            if existing_session == session_id and not is_root:
+                # 映射已存在且相同，只刷新最近使用时间
+                self._touch(session_id, now)
+                self._journal_touch(session_id)
+                return
+
+            # 更新会话数据，并追加日志记录（由后台线程写盘）
+            if is_root:
+                self._set_root_id(session_id, message_id, now)
+                self._journal_append("root", session_id, message_id, now)
+            else:
+                self._add_recent_message(session_id, message_id, now)
+                self._journal_append("recent", session_id, message_id, now)
+
+            # 清理旧会话
+            evicted = self._cleanup_old_sessions()
+
+        self._notify_evicted(evicted)
+
+    def count(self) -> int:
+        """获取当前会话数量"""
+        self.load()
+        return len(self._store.get("sessions", {}))
+
+    def flush(self) -> None:
+        """将尚未写盘的变更立即写入文件"""
+        if self.persist_mode == "coalesce":
+            self._flush_dirty()
+            return
+
+        try:
+            with self._io_lock:
+                records = self._drain_journal_queue()
+                records.extend(self._drain_touches())
+                self._write_journal_records(records)
+        except Exception as e:
+            logger.error("⚠️ 写入会话日志失败: %s", e)
+
+    def _flush_dirty(self):
+        """coalesce 模式：有未持久化的变更时写入完整快照"""
+        try:
+            with self._io_lock:
+                with self._lock:
+                    if not self._dirty:
+                        return
+                    changed = self._take_dirty_sessions()
+                    self._dirty = False
+
+                try:
+                    self._persist_snapshot(changed)
+                except Exception:
+                    with self._lock:
+                        self._dirty = True
+                    raise
+
+                self.flush_count += 1
+                # 从 journal 模式切换过来时，旧日志已包含在快照中
+                if self._journal_records:
+                    open(self.journal_file, 'w').close()
+                    self._journal_records = 0
+        except Exception as e:
+            logger.error("⚠️ 保存会话映射失败: %s", e)
+
+    def snapshot(self) -> dict:
+        """返回当前会话存储的副本"""
+        self.load()
+
+        with self._lock:
+            return self._copy_store()
+
+    def _copy_store(self) -> dict:
+        """复制当前会话存储（调用方需持有 _lock）"""
+        sessions = self._store.get("sessions", {})
+        return {
+            "version": STORAGE_VERSION,
+            "sessions": {
+                sess_id: _copy_session(data)
+                for sess_id, data in sessions.items()
+            }
+        }
+
+    def _take_dirty_sessions(self) -> dict:
+        """
+        取出上次写快照后变更过的会话副本并清空脏集合（调用方需持有 _lock）
+
+        Returns:
+            dict: session_id -> 会话数据副本，已删除的会话为 None
+        """
+        sessions = self._store.get("sessions", {})
+        changed = {}
+        for sess_id in self._dirty_sessions:
+            data = sessions.get(sess_id)
+            changed[sess_id] = _copy_session(data) if data else None
+        self._dirty_sessions = set()
+        return changed
+
+    def _persist_snapshot(self, changed: dict):
+        """
+        将变更过的会话合并到上次的快照后写入文件
+
+        调用方需持有 _io_lock；序列化完整快照时不持有 _lock，不阻塞查询。
+        """
+        for sess_id, data in changed.items():
+            if data is None:
+                self._persisted.pop(sess_id, None)
+            else:
+                self._persisted[sess_id] = data
+        self._write_snapshot({"version": STORAGE_VERSION,
+                              "sessions": self._persisted})
+
+    def _backup_legacy(self, old_data: dict):
+        """备份旧格式文件"""
+        backup_file = self.store_file + ".backup"
+        try:
+            with open(backup_file, 'w', encoding='utf-8') as f:
+                json.dump(old_data, f, ensure_ascii=False, indent=2)
+            logger.info("✅ 已备份旧数据到: %s", backup_file)
+        except Exception as e:
+            logger.warning("⚠️ 备份失败: %s", e)
+
+    def _rebuild_cache(self):
+        """重建内存缓存与最近使用顺序"""
+        self._cache.clear()
+        self._lru.clear()
+
+        # 旧数据没有使用时间，视为加载时刚使用过（保持文件中的顺序）
+        now = time.time()
+        sessions = self._store.get("sessions", {})
+        for session_data in sessions.values():
+            if not session_data.get("touched"):
+                session_data["touched"] = now
+
+        ordered = sorted(sessions.items(), key=lambda item: item[1]["touched"])
+        for session_id, session_data in ordered:
+            self._lru[session_id] = session_data["touched"]
+
+            root_id = session_data.get("root_id")
+            if root_id:
+                self._cache[root_id] = session_id
+
+            for msg_id in session_data.get("recent", []):
+                self._cache[msg_id] = session_id
+
+    def _touch(self, session_id: str, now: float = None):
+        """刷新会话的最近使用时间（O(1)）"""
+        session_data = self._store.get("sessions", {}).get(session_id)
+        if session_data is None:
+            return
+
+        now = now or time.time()
+        session_data["touched"] = now
+        self._lru[session_id] = now
+        self._lru.move_to_end(session_id)
+        self._dirty_sessions.add(session_id)
+
+    def _add_recent_message(self, session_id: str, message_id: str,
+                            now: float = None):
+        """添加消息到 recent 数组，保持最多 _MAX_RECENT_MESSAGES 条"""
+        sessions = self._store.setdefault("sessions", {})
+
+        if session_id not in sessions:
+            sessions[session_id] = {"root_id": None, "recent": []}
+
+        recent = sessions[session_id].setdefault("recent", [])
+
+        # 如果消息已存在，移到末尾
+        if message_id in recent:
+            recent.remove(message_id)
+            recent.append(message_id)
+        else:
+            recent.append(message_id)
+            # 保持最多 N 条
+            if len(recent) > _MAX_RECENT_MESSAGES:
+                recent.pop(0)
+
+        # 更新内存缓存
+        self._cache[message_id] = session_id
+        self._touch(session_id, now)
+
+    def _set_root_id(self, session_id: str, root_id: str,
+                     now: float = None):
+        """设置会话的 root_id"""
+        sessions = self._store.setdefault("sessions", {})
+
+        if session_id not in sessions:
+            sessions[session_id] = {"root_id": root_id, "recent": []}
+        else:
+            sessions[session_id]["root_id"] = root_id
+
+        # 更新内存缓存
+        self._cache[root_id] = session_id
+        self._touch(session_id, now)
+
+    def _remove_session(self, session_id: str):
+        """从内存存储和缓存中删除会话"""
+        sessions = self._store.get("sessions", {})
+        session_data = sessions.pop(session_id, None)
+        self._lru.pop(session_id, None)
+        self._pending_touches.pop(session_id, None)
+        if not session_data:
+            return
+        self._dirty_sessions.add(session_id)
+
+        root_id = session_data.get("root_id")
+        if root_id and self._cache.get(root_id) == session_id:
+            del self._cache[root_id]
+
+        for msg_id in session_data.get("recent", []):
+            if self._cache.get(msg_id) == session_id:
+                del self._cache[msg_id]
+
+    def _cleanup_old_sessions(self) -> list:
+        """
+        淘汰空闲超时及超出容量的会话（调用方需持有 _lock）
+
+        最近使用顺序保存在 OrderedDict 中，每次淘汰只检查头部，均摊 O(1)。
+
+        Returns:
+            list: 被淘汰的会话ID
+        """
+        evicted = []
+
+        idle = 0
+        if self.idle_ttl > 0:
+            cutoff = time.time() - self.idle_ttl
+            while self._lru:
+                sess_id, touched = next(iter(self._lru.items()))
+                if touched >= cutoff:
+                    break
+                self._remove_session(sess_id)
+                self._journal_append("del", sess_id)
+                evicted.append(sess_id)
+                idle += 1
+
+        capacity = 0
+        while len(self._lru) > self.max_sessions:
+            sess_id = next(iter(self._lru))
+            self._remove_session(sess_id)
+            self._journal_append("del", sess_id)
+            evicted.append(sess_id)
+            capacity += 1
+
+        self._record_evictions(capacity, idle)
+        return evicted
+
+    def _write_snapshot(self, store: dict):
+        """原子地写入会话映射快照（临时文件 + 重命名）"""
+        self._ensure_store_dir()
+        tmp_file = self.store_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(store, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.store_file)
+
+    def _save_snapshot(self):
+        """保存完整会话映射快照，并清空已被快照包含的追加日志"""
+        try:
+            with self._io_lock:
+                self._write_snapshot(self._store)
+                open(self.journal_file, 'w').close()
+                self._journal_records = 0
+                self._last_compact = time.monotonic()
+        except Exception as e:
+            logger.error("⚠️ 保存会话映射失败: %s", e)
+
+    def _journal_append(self, op: str, session_id: str,
+                        message_id: str = None, now: float = None):
+        """记录一次会话映射变更（调用方需持有 _lock）"""
+        if self.persist_mode == "coalesce":
+            self._dirty = True
+            return
+
+        record = {"op": op, "s": session_id}
+        if message_id:
+            record["m"] = message_id
+        if now:
+            record["t"] = now
+        self._journal_queue.put(record)
+        self._journal_ready.set()
+
+    def _journal_touch(self, session_id: str):
+        """记录一次最近使用时间刷新，同一会话只保留最新的一次（调用方需持有 _lock）"""
+        touched = self._lru.get(session_id)
+        if touched is None:
+            return
+        if self.persist_mode == "coalesce":
+            self._dirty = True
+            return
+        self._pending_touches[session_id] = touched
+
+    def _drain_touches(self) -> list:
+        """取出尚未写盘的最近使用时间刷新，转为日志记录"""
+        with self._lock:
+            touches = self._pending_touches
+            self._pending_touches = {}
+        return [{"op": "touch", "s": session_id, "t": touched}
+                for session_id, touched in touches.items()]
+
+    def _apply_journal_record(self, record: dict):
+        """将一条日志记录应用到内存中的会话存储"""
+        op = record.get("op")
+        session_id = record.get("s")
+        message_id = record.get("m")
+        now = record.get("t")
+
+        if not session_id:
+            return
+
+        if op == "root" and message_id:
+            self._set_root_id(session_id, message_id, now)
+        elif op == "recent" and message_id:
+            self._add_recent_message(session_id, message_id, now)
+        elif op == "del":
+            self._remove_session(session_id)
+        elif op == "touch":
+            self._touch(session_id, now)
+
+    def _replay_journal(self):
+        """回放追加日志，恢复快照之后的变更"""
+        if not os.path.exists(self.journal_file):
+            return
+
+        replayed = 0
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃时可能残留不完整的最后一行
+                        logger.warning("⚠️ 跳过损坏的会话日志记录")
+                        continue
+                    self._apply_journal_record(record)
+                    replayed += 1
+        except Exception as e:
+            logger.error("⚠️ 回放会话日志失败: %s", e)
+
+        self._journal_records = replayed
+        if replayed:
+            logger.info("📜 已回放 %d 条会话日志记录", replayed)
+
+    def _drain_journal_queue(self) -> list:
+        """取出当前队列中的全部日志记录"""
+        records = []
+        while True:
+            try:
+                records.append(self._journal_queue.get_nowait())
+            except Empty:
+                return records
+
+    def _write_journal_records(self, records: list):
+        """追加写入日志记录（调用方需持有 _io_lock）"""
+        if not records:
+            return
+
+        self._ensure_store_dir()
+        lines = ''.join(
+            json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n'
+            for r in records
+        )
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+        self._journal_records += len(records)
+
+    def _compact_journal(self):
+        """将内存存储压缩为快照并清空日志（调用方需持有 _io_lock）"""
+        with self._lock:
+            # 队列中尚未写盘的记录都已反映在内存存储中，可直接丢弃
+            self._drain_journal_queue()
+            self._pending_touches.clear()
+            changed = self._take_dirty_sessions()
+
+        self._persist_snapshot(changed)
+        open(self.journal_file, 'w').close()
+        self._journal_records = 0
+        self._last_compact = time.monotonic()
+
+    def _should_compact(self) -> bool:
+        """判断是否需要压缩日志"""
+        if self._journal_records >= self.compact_records:
+            return True
+        elapsed = time.monotonic() - self._last_compact
+        return self._journal_records > 0 and elapsed >= self.compact_interval
+
+    def _writer_loop(self):
+        """后台日志写入线程：批量追加记录，并按阈值压缩"""
+        while True:
+            self._journal_ready.wait(timeout=1)
+            self._journal_ready.clear()
+
+            try:
+                with self._io_lock:
+                    # 在 _io_lock 内取出记录，与 flush() 并发时也按入队顺序写盘
+                    records = self._drain_journal_queue()
+                    records.extend(self._drain_touches())
+                    self._write_journal_records(records)
+                    if self._should_compact():
+                        self._compact_journal()
+            except Exception as e:
+                logger.error("⚠️ 写入会话日志失败: %s", e)
+
+    def _flusher_loop(self):
+        """coalesce 模式后台线程：最多每 flush_interval 秒写一次快照"""
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_dirty()
+
+    def _start_writer(self):
+        """启动后台写入线程"""
+        if self._writer is not None:
+            return
+
+        self._last_compact = time.monotonic()
+        if self.persist_mode == "coalesce":
+            # 回放过旧日志时需要写一次快照以清空日志
+            self._dirty = self._journal_records > 0
+            self._writer = Thread(target=self._flusher_loop,
+                                  name="session-flusher", daemon=True)
+        else:
+            self._writer = Thread(target=self._writer_loop,
+                                  name="session-journal", daemon=True)
+        self._writer.start()
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite 会话映射存储（WAL 模式）
+
+    messages 表以 message_id 为主键并按 session_id 建索引，sessions 表按
+    最近使用时间 updated_at 建索引，查询、写入与淘汰均为索引操作，不随会话
+    总数增长。与 JSON 存储一样，每个会话除 root_id 外只保留最近
+    _MAX_RECENT_MESSAGES 条消息映射（按插入顺序 rowid）。查询命中时距上次
+    刷新超过 _SQLITE_TOUCH_INTERVAL 秒才更新最近使用时间。
+    """
+
+    def __init__(self, db_path: str, max_sessions: int = 100000,
+                 on_evict: Callable[[str], None] = None,
+                 idle_ttl: float = 0,
+                 legacy_json_dir: str = None):
+        super().__init__(max_sessions, on_evict, idle_ttl)
+        self.db_path = db_path
+        self.legacy_json_dir = legacy_json_dir
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+        self._session_count = 0
+
+    def load(self) -> None:
+        """打开数据库并建表，首次使用时从 JSON 文件迁移"""
+        if self._conn is not None:
+            return
+
+        with self._lock:
+            if self._conn is not None:
+                return
+
+            Path(os.path.dirname(self.db_path) or ".").mkdir(
+                parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    root_id TEXT,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_session
+                    ON messages(session_id);
+                CREATE INDEX IF NOT EXISTS idx_sessions_updated
+                    ON sessions(updated_at);
+            """)
+            self._conn = conn
+            self._session_count = conn.execute(
+                "SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+            if self._session_count == 0 and self.legacy_json_dir:
+                legacy_files = ("session_mapping.json",
+                                "session_mapping.journal")
+                if any(os.path.exists(os.path.join(self.legacy_json_dir, f))
+                       for f in legacy_files):
+                    self._import_json(self.legacy_json_dir)
+
+        logger.info("✅ 已打开 SQLite 会话存储: %s (%d 个会话)",
+                    self.db_path, self._session_count)
+
+    def get_session_id(self, message_id: str) -> Optional[str]:
+        """获取消息关联的会话ID，命中时刷新会话的最近使用时间"""
+        self.load()
+        now = time.time()
+
+        with self._lock:
+            conn = self._conn
+            row = conn.execute(
+                "SELECT m.session_id, s.updated_at FROM messages m "
+                "JOIN sessions s ON s.session_id = m.session_id "
+                "WHERE m.message_id = ?",
+                (message_id,)
+            ).fetchone()
+            if not row:
+                return None
+
+            session_id, updated_at = row
+            if self.idle_ttl > 0 and updated_at < now - self.idle_ttl:
+                # 会话已空闲超时，顺带淘汰所有超时会话
+                conn.execute("BEGIN")
+                try:
+                    evicted = self._cleanup_old_sessions()
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    self._session_count = conn.execute(
+                        "SELECT COUNT(*) FROM sessions").fetchone()[0]
+                    raise
+                session_id = None
+            else:
+                evicted = []
+                if now - updated_at >= _SQLITE_TOUCH_INTERVAL:
+                    conn.execute(
+                        "UPDATE sessions SET updated_at = ? "
+                        "WHERE session_id = ?", (now, session_id))
+
+        self._notify_evicted(evicted)
+        return session_id
+
+    def save_mapping(self, message_id: str, session_id: str,
+                     is_root: bool = False) -> None:
+        """保存消息ID与会话ID的映射"""
+        self.load()
+        now = time.time()
+
+        with self._lock:
+            conn = self._conn
+            row = conn.execute(
+                "SELECT session_id FROM messages WHERE message_id = ?",
+                (message_id,)
+            ).fetchone()
+            if row and row[0] == session_id and not is_root:
+                # 映射已存在且相同，只刷新最近使用时间
+                conn.execute(
+                    "UPDATE sessions SET updated_at = ? WHERE session_id = ?",
+                    (now, session_id))
+                return
+
+            conn.execute("BEGIN")
+            try:
+                exists = conn.execute(
+                    "SELECT root_id FROM sessions WHERE session_id = ?",
+                    (session_id,)
+                ).fetchone()
+                if exists:
+                    if is_root:
+                        conn.execute(
+                            "UPDATE sessions SET root_id = ?, updated_at = ? "
+                            "WHERE session_id = ?",
+                            (message_id, now, session_id))
+                    else:
+                        conn.execute(
+                            "UPDATE sessions SET updated_at = ? "
+                            "WHERE session_id = ?", (now, session_id))
+                else:
+                    conn.execute(
+                        "INSERT INTO sessions (session_id, root_id, "
+                        "updated_at) VALUES (?, ?, ?)",
+                        (session_id, message_id if is_root else None, now))
+                    self._session_count += 1
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO messages (message_id, session_id) "
+                    "VALUES (?, ?)", (message_id, session_id))
+                if not is_root:
+                    self._prune_messages(session_id,
+                                         exists[0] if exists else None)
+
+                evicted = self._cleanup_old_sessions()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                self._session_count = conn.execute(
+                    "SELECT COUNT(*) FROM sessions").fetchone()[0]
+                raise
+
+        self._notify_evicted(evicted)
+
+    def count(self) -> int:
+        """获取当前会话数量"""
+        self.load()
+        return self._session_count
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _cleanup_old_sessions(self) -> list:
+        """
+        淘汰空闲超时及超出容量的会话（调用方需持有 _lock 并已开启事务）
+
+        Returns:
+            list: 被淘汰的会话ID
+        """
+        idle_evicted = []
+        if self.idle_ttl > 0:
+            idle_evicted = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE updated_at < ?",
+                (time.time() - self.idle_ttl,))]
+            self._delete_sessions(idle_evicted)
+
+        capacity_evicted = []
+        to_remove = self._session_count - self.max_sessions
+        if to_remove > 0:
+            capacity_evicted = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM sessions ORDER BY updated_at LIMIT ?",
+                (to_remove,))]
+            self._delete_sessions(capacity_evicted)
+
+        self._record_evictions(len(capacity_evicted), len(idle_evicted))
+        return idle_evicted + capacity_evicted
+
+    def _prune_messages(self, session_id: str, root_id: Optional[str]):
+        """只保留会话最近 _MAX_RECENT_MESSAGES 条非 root 消息（调用方需持有 _lock）"""
+        self._conn.execute(
+            "DELETE FROM messages WHERE session_id = ? "
+            "AND message_id IS NOT ? AND rowid NOT IN ("
+            "SELECT rowid FROM messages WHERE session_id = ? "
+            "AND message_id IS NOT ? ORDER BY rowid DESC LIMIT ?)",
+            (session_id, root_id, session_id, root_id, _MAX_RECENT_MESSAGES))
+
+    def _delete_sessions(self, session_ids: list):
+        """删除会话及其消息映射（调用方需持有 _lock）"""
+        for sess_id in session_ids:
+            self._conn.execute(
+                "DELETE FROM messages WHERE session_id = ?", (sess_id,))
+            self._conn.execute(
+                "DELETE FROM sessions WHERE session_id = ?", (sess_id,))
+        self._session_count -= len(session_ids)
+
+    def _import_json(self, json_dir: str):
+        """从 JSON 存储目录导入会话映射（调用方需持有 _lock）"""
+        try:
+            json_store = JsonSessionStore(json_dir)
+            json_store._load_data()
+            data = json_store._store
+        except Exception as e:
+            logger.warning("⚠️ 读取 JSON 会话映射失败: %s，跳过迁移", e)
+            return
+
+        imported = import_json_store(self._conn, data)
+        self._session_count = self._conn.execute(
+            "SELECT COUNT(*) FROM sessions").fetchone()[0]
+        logger.info("🔄 已从 %s 迁移 %d 个会话到 SQLite", json_dir, imported)
+
+
+def import_json_store(conn: sqlite3.Connection, data: dict) -> int:
+    """
+    将 v2.0 格式的会话存储写入 SQLite
+
+    Args:
+        conn: 已建表的 SQLite 连接
+        data: v2.0 格式的会话存储
+
+    Returns:
+        int: 导入的会话数量
+    """
+    sessions = data.get("sessions", {})
+    now = time.time()
+
+    conn.execute("BEGIN")
+    try:
+        # 没有使用时间的旧数据按文件中的顺序分配递增的更新时间
+        for offset, (sess_id, session_data) in enumerate(sessions.items()):
+            root_id = session_data.get("root_id")
+            touched = (session_data.get("touched")
+                       or now - len(sessions) + offset)
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, root_id, "
+                "updated_at) VALUES (?, ?, ?)",
+                (sess_id, root_id, touched))
+            message_ids = list(session_data.get("recent", []))
+            if root_id:
+                message_ids.insert(0, root_id)
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (message_id, session_id) "
+                "VALUES (?, ?)", [(msg_id, sess_id) for msg_id in message_ids])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return len(sessions)
+
+
+def migrate_json_to_sqlite(json_dir: str, db_path: str) -> int:
+    """
+    将 JSON 会话映射（快照 + 追加日志）迁移到 SQLite 数据库
+
+    Args:
+        json_dir: session_mapping.json 所在目录（支持 v2.0 及旧格式）
+        db_path: 目标 SQLite 数据库路径
+
+    Returns:
+        int: 迁移后数据库中的会话数量
+    """
+    store = SqliteSessionStore(db_path, max_sessions=2 ** 62)
+    store.load()
+    with store._lock:
+        store._import_json(json_dir)
+    count = store.count()
+    store.close()
+    return count
+
+
+# 迁移工具: python session_store.py <JSON 存储目录> <session_mapping.db>
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if len(sys.argv) != 3:
+        print("用法: python session_store.py "
+              "<JSON 存储目录> <session_mapping.db>")
+        sys.exit(1)
+
+    total = migrate_json_to_sqlite(sys.argv[1], sys.argv[2])
+    print(f"✅ 迁移完成，数据库中共有 {total} 个会话")
@@ -0,0 +1,246 @@
+"""入站消息暂存模块：已确认收到但尚未处理完成的消息追加写入磁盘，重启后恢复"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from threading import Condition
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class IngressSpool:
+    """
+    入站消息暂存文件
+
+    每行一条 JSON 记录：{"op": "add", "key": ..., "record": {...}} 表示收到
+    一条消息，{"op": "done", "key": ...} 表示处理完成。add 与 done 只把记录
+    放入内存队列后立即返回，不在调用线程（消息接收回调）中序列化或读写
+    磁盘；后台写入线程批量序列化并写入，fsync 每 fsync_interval 秒最多一次
+    （0 表示每批写入后 fsync）。进程崩溃时最多丢失尚未写入的一小批消息，
+    系统崩溃或断电时最多丢失最近 fsync_interval 秒内的消息；重启时最多
+    重复处理少量已完成的消息。
+
+    所有消息处理完成后文件被截断为空；文件中的记录数达到 compact_records
+    时只保留未完成的消息重写文件。open 读取上次运行遗留的未完成消息，
+    末尾写了一半的记录会被忽略。
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 0.2,
+                 compact_records: int = 10000):
+        """
+        Args:
+            path: 暂存文件路径
+            fsync_interval: 两次 fsync 之间的最短间隔（秒）
+            compact_records: 触发重写的文件记录数
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_records = compact_records
+        self._live: OrderedDict = OrderedDict()  # key -> record，未完成的消息
+        self._pending: list = []  # 等待写入的 (op, key, record)
+        self._queued = 0  # 已排队写入的记录序号
+        self._written = 0  # 已写入文件的记录序号
+        self._records = 0  # 文件中的记录数
+        self._cond = Condition()
+        self._file = None
+        self._thread = None
+        self._closed = False
+
+        self.appended = 0  # 写入的消息数
+        self.completed = 0  # 处理完成的消息数
+        self.syncs = 0  # fsync 次数
+        self.failures = 0  # 写入失败次数
+
+    def open(self) -> list:
+        """
+        读取上次运行遗留的未完成消息并开始写入（重复调用不会重复读取）
+
+        Returns:
+            list: 未完成消息的记录（按到达顺序），文件无法打开时返回空列表
+        """
+        with self._cond:
+            if self._thread is not None or self._closed:
+                return []
+            try:
+                self._live = self._read()
+                self._rewrite()
+            except OSError as e:
+                # 无法写入时停用暂存，消息仍正常处理
+                logger.error("⚠️ 无法打开暂存文件 %s，停用暂存: %s",
+                             self.path, e)
+                self._closed = True
+                return []
+            self._thread = threading.Thread(target=self._writer,
+                                            name="ingress-spool", daemon=True)
+            self._thread.start()
+            records = list(self._live.values())
+
+        if records:
+            logger.info("📥 暂存文件中有 %d 条未处理完成的消息", len(records))
+        return records
+
+    def add(self, key: str, record: dict) -> None:
+        """暂存一条消息（排队写入，不等待落盘）"""
+        self.open()
+        with self._cond:
+            if self._closed:
+                return
+            self._live[key] = record
+            self._enqueue("add", key, record)
+
+    def done(self, key: str) -> None:
+        """标记消息处理完成（排队写入，不等待落盘，未暂存的消息忽略）"""
+        with self._cond:
+            if self._closed or self._live.pop(key, None) is None:
+                return
+            self.completed += 1
+            self._enqueue("done", key, None)
+
+    def pending(self) -> int:
+        """未处理完成的消息数"""
+        with self._cond:
+            return len(self._live)
+
+    def stats(self) -> dict:
+        """获取暂存统计信息"""
+        with self._cond:
+            return {
+                "pending": len(self._live),
+                "records": self._records,
+                "appended": self.appended,
+                "completed": self.completed,
+                "syncs": self.syncs,
+                "failures": self.failures
+            }
+
+    def close(self, timeout: float = 5) -> None:
+        """写入排队中的记录后关闭文件（程序退出时调用）"""
+        with self._cond:
+            if self._thread is None or self._closed:
+                return
+            self._cond.wait_for(lambda: self._written >= self._queued,
+                                timeout=timeout)
+            if self._file is not None:
+                try:
+                    os.fsync(self._file.fileno())
+                except OSError as e:
+                    logger.warning("暂存文件 fsync 失败: %s", e)
+            self._closed = True
+            self._cond.notify_all()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _enqueue(self, op: str, key: str, record) -> None:
+        """排队写入一条记录（调用方需持有 _cond）"""
+        self._pending.append((op, key, record))
+        self._queued += 1
+        self._cond.notify_all()
+
+    @staticmethod
+    def _encode(op: str, key: str, record) -> str:
+        entry = {"op": op, "key": key}
+        if record is not None:
+            entry["record"] = record
+        return json.dumps(entry, ensure_ascii=False) + "\n"
+
+    def _read(self) -> OrderedDict:
+        """读取文件中未完成的消息"""
+        live: OrderedDict = OrderedDict()
+        if not os.path.exists(self.path):
+            return live
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("暂存文件中有无法解析的记录，已跳过")
+                    continue
+                if entry.get("op") == "add":
+                    live[entry["key"]] = entry["record"]
+                elif entry.get("op") == "done":
+                    live.pop(entry.get("key"), None)
+        return live
+
+    def _rewrite(self) -> None:
+        """只保留未完成的消息重写文件（调用方需持有 _cond）"""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for key, record in self._live.items():
+                f.write(self._encode("add", key, record))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_file, self.path)
+
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._records = len(self._live)
+
+    def _writer(self) -> None:
+        """后台线程：批量写入排队的记录，按 fsync_interval 合并 fsync"""
+        last_sync = 0.0
+        unsynced = False  # 是否有已写入但未 fsync 的 add 记录
+        while True:
+            with self._cond:
+                sync_due = last_sync + self.fsync_interval
+                self._cond.wait_for(
+                    lambda: self._pending or self._closed or (
+                        unsynced and time.monotonic() >= sync_due),
+                    timeout=(max(0.0, sync_due - time.monotonic())
+                             if unsynced else None))
+                if self._closed:
+                    return
+                batch = self._pending
+                self._pending = []
+                seq = self._queued
+
+            added = sum(1 for op, _, _ in batch if op == "add")
+            synced = False
+            try:
+                if batch:
+                    self._file.write("".join(self._encode(*entry)
+                                             for entry in batch))
+                    self._file.flush()
+                unsynced = unsynced or added > 0
+                if unsynced and time.monotonic() >= sync_due:
+                    os.fsync(self._file.fileno())
+                    last_sync = time.monotonic()
+                    unsynced = False
+                    synced = True
+                failed = False
+            except (OSError, ValueError) as e:
+                logger.error("写入暂存文件失败，%d 条消息重启后无法恢复: %s",
+                             added, e)
+                failed = True
+                unsynced = False
+
+            with self._cond:
+                self._written = seq
+                if failed:
+                    self.failures += 1
+                else:
+                    self._records += len(batch)
+                    self.appended += added
+                    if synced:
+                        self.syncs += 1
+                self._cond.notify_all()
+                if failed or self._pending:
+                    continue
+
+                try:
+                    if not self._live and self._records:
+                        # 全部处理完成：截断文件
+                        self._file.truncate(0)
+                        self._records = 0
+                    elif self._records >= self.compact_records:
+                        self._rewrite()
+                except OSError as e:
+                    logger.warning("整理暂存文件失败: %s", e)